@@ -4,9 +4,13 @@ __copyright__   = 'March 2018'
 import os
 import sys
 import numpy
-import pickle
 import argparse
 import platform
+import functools
+import queue
+import threading
+import time
+import hashlib
 from multiprocessing import freeze_support
 
 # add the web service folder to the sys path
@@ -14,6 +18,361 @@ DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(DIR_PATH, '..', 'service'))
 import settings
 import imutils
+import cpuutils
+import segmentutils
+import pipelineutils
+import hashindex
+import face_database
+
+def decode_images(dataset_base_path, hash_index, items):
+    """
+        Stage of the pipeline that reads the images
+        Arguments:
+            dataset_base_path: Base path of image dataset
+            hash_index: HashIndex object used to skip the near-duplicates of the images already
+                        ingested, or None to read all the images
+            items: list of tuples (index, img_path), where img_path is relative to dataset_base_path
+        Returns:
+            A list of tuples (index, img_path, img). img is None for the images skipped.
+    """
+    results = []
+    for index, img_path in items:
+        full_path = os.path.join(dataset_base_path, img_path)
+        if hash_index:
+            # the hash only needs a reduced decoding of the image
+            img_hash = imutils.image_hash(full_path)
+            if img_hash is not None:
+                original = hash_index.add(img_path, img_hash)
+                if original:
+                    print ('Skipping file %s, which is a duplicate of %s' % (full_path, original))
+                    results.append((index, img_path, None))
+                    continue
+        print ('Computing features for file %s' % (full_path))
+        results.append((index, img_path, imutils.acquire_image(full_path)))
+    return results
+
+
+def detect_faces(face_detector, items):
+    """
+        Stage of the pipeline that detects the faces in the images and crops them
+        Arguments:
+            face_detector: FaceDetectorRetinaFace object
+            items: list of tuples (index, img_path, img)
+        Returns:
+            A list of tuples (index, img_path, rois, crops)
+    """
+    results = []
+    all_detections = face_detector.detect_faces_batch([ img for index, img_path, img in items ])
+    for (index, img_path, img), detections in zip(items, all_detections):
+        rois = []
+        crops = []
+        if numpy.all(detections != None):
+            for det in detections:
+                # The coordinates should be already integers, but some basic
+                # conversion is need for compatibility with all face detectors.
+                # Plus we have to get rid of the detection score det[4]
+                det = [int(det[0]), int(det[1]), int(det[2]), int(det[3])]
+                rois.append(det)
+                # crop image to detected face area.
+                crops.append(img[det[1]:det[3], det[0]:det[2], :])
+        results.append((index, img_path, rois, crops))
+    return results
+
+
+def compute_features(feature_extractors, batch_size, items):
+    """
+        Stage of the pipeline that computes the features of the faces
+        Arguments:
+            feature_extractors: queue.Queue of FaceFeatureExtractor objects, one per thread of the stage
+            batch_size: maximum number of faces input to the feature extractor at once
+            items: list of tuples (index, img_path, rois, crops)
+        Returns:
+            A list of tuples (index, img_path, rois, feats)
+    """
+    all_crops = [ crop for index, img_path, rois, crops in items for crop in crops ]
+    all_feats = []
+    feature_extractor = feature_extractors.get()
+    try:
+        for start in range(0, len(all_crops), batch_size):
+            all_feats.extend(feature_extractor.feature_compute_batch(all_crops[start:start + batch_size]))
+    finally:
+        feature_extractors.put(feature_extractor)
+    results = []
+    offset = 0
+    for index, img_path, rois, crops in items:
+        results.append((index, img_path, rois, all_feats[offset:offset + len(crops)]))
+        offset = offset + len(crops)
+    return results
+
+
+def read_images_list(images_list, output_queue, stop_event, first_index=0):
+    """
+        Body of the thread that feeds the pipeline with the images in the list
+        Arguments:
+            images_list: Path to file containing the list of images
+            output_queue: queue where the tuples (index, img_path) are put
+            stop_event: threading.Event set when the pipeline fails, to stop feeding it
+            first_index: index of the first image to be processed. The previous images are skipped.
+    """
+    index = 0
+    with open(images_list) as fin:
+        for img_path in fin:
+            if stop_event.is_set():
+                break
+            img_path = img_path.replace('\n', '')
+            if len(img_path) > 0:
+                if index >= first_index:
+                    output_queue.put((index, img_path))
+                index = index + 1
+    output_queue.put(pipelineutils.END_OF_QUEUE)
+
+
+def feed_images(items, output_queue, stop_event):
+    """
+        Body of the thread that feeds the pipeline with a list of images
+        Arguments:
+            items: list of tuples (index, img_path)
+            output_queue: queue where the tuples are put
+            stop_event: threading.Event set when the pipeline fails, to stop feeding it
+    """
+    for item in items:
+        if stop_event.is_set():
+            break
+        output_queue.put(item)
+    output_queue.put(pipelineutils.END_OF_QUEUE)
+
+
+def add_pipeline_arguments(parser):
+    """
+        Adds the options of the pipeline to an argument parser
+        Arguments:
+            parser: argparse.ArgumentParser object
+    """
+    parser.add_argument('-c', dest='cores', default=None, help='Cores to run on, e.g. 0-3,6 (default: all the available cores). Useful to run several instances of this script side by side.')
+    parser.add_argument('--decode-threads', dest='decode_threads', type=int, default=4, help='Number of threads reading images (default: 4)')
+    parser.add_argument('--detection-threads', dest='detection_threads', type=int, default=1, help='Number of threads detecting faces (default: 1)')
+    parser.add_argument('--detection-batch', dest='detection_batch', type=int, default=8, help='Maximum number of images input to the face detector at once (default: 8)')
+    parser.add_argument('--features-threads', dest='features_threads', type=int, default=1, help='Number of threads computing features (default: 1)')
+    parser.add_argument('--features-batch', dest='features_batch', type=int, default=32, help='Maximum number of faces input to the feature extractor at once (default: 32)')
+    parser.add_argument('--queue-size', dest='queue_size', type=int, default=64, help='Maximum number of items waiting between two stages of the pipeline (default: 64)')
+    parser.add_argument('--dedup-index', dest='dedup_index', default=settings.INGESTION_DEDUP_INDEX, help='Path to the index of the hashes of the images ingested. If specified, the near-duplicates of the images in the index, or of previous images in the list, are skipped (default: %s)' % str(settings.INGESTION_DEDUP_INDEX))
+    parser.add_argument('--dedup-distance', dest='dedup_distance', type=int, default=settings.INGESTION_DEDUP_MAX_DISTANCE, help='Maximum number of different bits between the hashes of two duplicates, lower than %d (default: %d)' % (hashindex.HASH_BLOCKS, settings.INGESTION_DEDUP_MAX_DISTANCE))
+
+
+def create_models(features_threads):
+    """
+        Sets the cores to run on and creates the models used by the pipeline
+        Arguments:
+            features_threads: number of threads computing features
+        Returns:
+            A tuple with the FaceDetectorRetinaFace object and a queue.Queue of FaceFeatureExtractor
+            objects, one per thread computing features
+    """
+    # import face detector
+    import face_detection_retinaface
+    face_detector = face_detection_retinaface.FaceDetectorRetinaFace()
+
+    # import and create face feature extractors, one per thread, all sharing the same network
+    import face_features
+    feature_network = face_features.load_network()
+    feature_extractors = queue.Queue()
+    for idx in range(features_threads):
+        feature_extractors.put(face_features.FaceFeatureExtractor(network=feature_network))
+
+    return face_detector, feature_extractors
+
+
+def run_pipeline(args, face_detector, feature_extractors, reader, first_index, image_done):
+    """
+        Runs the pipeline over a sequence of images
+        Arguments:
+            args: options of the pipeline, as added by add_pipeline_arguments
+            face_detector: FaceDetectorRetinaFace object
+            feature_extractors: queue.Queue of FaceFeatureExtractor objects, one per thread computing features
+            reader: function receiving the input queue of the pipeline, where it must put the tuples
+                    (index, img_path) followed by the END_OF_QUEUE marker, and the threading.Event set
+                    when the pipeline fails, after which it must stop putting tuples. It runs in a
+                    separate thread.
+            first_index: index of the first image put in the queue by the reader
+            image_done: function called with the arguments (img_path, rois, feats) for each image, in
+                        the same order as the images were put in the queue
+        Returns:
+            A tuple with the number of images processed, the list of PipelineStage objects and the
+            time taken, in seconds. Check the 'error' field of the stages to find out whether the
+            pipeline failed.
+    """
+    # the near-duplicates are skipped while reading the images
+    hash_index = None
+    if args.dedup_index:
+        hash_index = hashindex.HashIndex(args.dedup_index, args.dedup_distance)
+
+    # build the pipeline: read images -> detect faces -> compute features -> write results
+    paths_queue = queue.Queue(args.queue_size)
+    images_queue = queue.Queue(args.queue_size)
+    faces_queue = queue.Queue(args.queue_size)
+    results_queue = queue.Queue(args.queue_size)
+    # once a stage fails, the images are no longer read and the other stages stop processing them
+    stop_event = threading.Event()
+    stages = [
+        pipelineutils.PipelineStage('decode', functools.partial(decode_images, args.dataset_base_path, hash_index),
+                                    paths_queue, images_queue, args.decode_threads, stop_event=stop_event),
+        pipelineutils.PipelineStage('detection', functools.partial(detect_faces, face_detector),
+                                    images_queue, faces_queue, args.detection_threads, args.detection_batch, stop_event),
+        pipelineutils.PipelineStage('features', functools.partial(compute_features, feature_extractors, args.features_batch),
+                                    faces_queue, results_queue, args.features_threads, args.features_batch, stop_event)
+    ]
+
+    t = time.time()
+    reader_thread = threading.Thread(target=reader, args=(paths_queue, stop_event))
+    reader_thread.daemon = True
+    reader_thread.start()
+    for stage in stages:
+        stage.start()
+
+    # keep the results in the same order as the images
+    pending_results = {}
+    next_index = first_index
+    num_images = 0
+    result = results_queue.get()
+    while result is not pipelineutils.END_OF_QUEUE:
+        pending_results[result[0]] = result
+        while next_index in pending_results:
+            index, img_path, rois, feats = pending_results.pop(next_index)
+            image_done(img_path, rois, feats)
+            next_index = next_index + 1
+            num_images = num_images + 1
+        result = results_queue.get()
+
+    for stage in stages:
+        stage.join()
+    total_time = time.time() - t
+    if hash_index:
+        print ('Skipped %d near-duplicate images' % hash_index.num_duplicates)
+        hash_index.close()
+    return num_images, stages, total_time
+
+
+def write_faces(writer, img_path, rois, feats):
+    """
+        Adds the faces of an image to a SegmentWriter
+        Arguments:
+            writer: SegmentWriter object
+            img_path: path of the image, relative to the base path of the dataset
+            rois: list of bounding-boxes of the faces
+            feats: list of feature vectors of the faces
+    """
+    for det, feat in zip(rois, feats):
+        if numpy.all(feat == None):
+            print ('Could not compute the features of a face in %s' % img_path)
+            continue
+        writer.add_face(img_path, det, feat)
+    writer.item_done()
+
+
+def print_report(num_images, num_faces, stages, total_time):
+    """
+        Prints the throughput of the pipeline and of each of its stages
+        Arguments:
+            num_images: number of images processed
+            num_faces: number of faces found
+            stages: list of PipelineStage objects
+            total_time: time taken by the pipeline, in seconds
+    """
+    print ('Processed %d images and %d faces in %f seconds: %f images per second, %f faces per second' %
+           (num_images, num_faces, total_time, num_images/max(total_time, 1e-6), num_faces/max(total_time, 1e-6)))
+    for stage in stages:
+        stage.report(total_time)
+
+
+def get_model_version():
+    """
+        Returns a string identifying the models used to compute the features. Files ingested with
+        a different version of the models are ingested again by an incremental ingestion.
+    """
+    return '%s:%s:%d' % (os.path.basename(settings.FACE_DETECTION_MODEL), os.path.basename(settings.FEATURES_MODEL_WEIGHTS),
+                         settings.FEATURES_VECTOR_SIZE)
+
+
+def get_file_identity(full_path, content_hash=False):
+    """
+        Returns a value that changes whenever a file is modified
+        Arguments:
+            full_path: Full path to the file
+            content_hash: boolean indicating whether to use the hash of the contents of the file, which
+                          is slower but not affected by copies that change the modification time
+        Returns:
+            A tuple with the size of the file and its modification time, or the SHA-1 of its contents.
+            Returns None if the file cannot be read.
+    """
+    try:
+        file_size = os.path.getsize(full_path)
+        if not content_hash:
+            return (file_size, os.stat(full_path).st_mtime_ns)
+        sha1 = hashlib.sha1()
+        with open(full_path, 'rb') as fin:
+            for block in iter(functools.partial(fin.read, 1024*1024), b''):
+                sha1.update(block)
+        return (file_size, sha1.hexdigest())
+    except OSError:
+        return None
+
+
+def plan_incremental_ingestion(dataset_base_path, images_list, ingested_files, content_hash, model_version):
+    """
+        Compares the images in a list with the ones ingested before, to find the ones to be ingested
+        and the ones whose faces must be removed from the database
+        Arguments:
+            dataset_base_path: Base path of image dataset
+            images_list: Path to file containing the list of images
+            ingested_files: dictionary with the identity and model version of each ingested image,
+                            as returned by segmentutils.load_ingested_files
+            content_hash: boolean indicating whether the identity of the images uses the hash of their contents
+            model_version: string returned by get_model_version
+        Returns:
+            A tuple with the list of pairs (img_path, identity) of the new or changed images, and the
+            set of paths of the changed images and of the images no longer in the list, or no longer found
+    """
+    to_ingest = []
+    to_remove = set()
+    listed = set()
+    with open(images_list) as fin:
+        for img_path in fin:
+            img_path = img_path.replace('\n', '')
+            if len(img_path) == 0 or img_path in listed:
+                continue
+            listed.add(img_path)
+            identity = get_file_identity(os.path.join(dataset_base_path, img_path), content_hash)
+            previous = ingested_files.get(img_path)
+            if identity is None:
+                print ('Could not read file %s' % os.path.join(dataset_base_path, img_path))
+                if previous:
+                    to_remove.add(img_path)
+            elif previous != (identity, model_version):
+                to_ingest.append((img_path, identity))
+                if previous:
+                    to_remove.add(img_path)
+    to_remove.update([ img_path for img_path in ingested_files if img_path not in listed ])
+    return to_ingest, to_remove
+
+
+def remove_images(database_file, paths):
+    """
+        Removes the faces of a set of images from a database, by marking them in its tombstones bitmap
+        Arguments:
+            database_file: Full path to the main database file
+            paths: set of image paths
+        Returns:
+            The number of faces removed
+    """
+    rows, num_rows = segmentutils.find_rows_by_path(database_file, paths)
+    if len(rows) > 0:
+        tombstones = numpy.zeros(num_rows, dtype=bool)
+        previous_tombstones = face_database.load_tombstones(database_file)[:num_rows]
+        tombstones[:len(previous_tombstones)] = previous_tombstones
+        tombstones[rows] = True
+        face_database.save_tombstones(database_file, tombstones)
+    return len(rows)
+
 
 if __name__ == '__main__':
     if 'Windows' in platform.system():
@@ -23,73 +382,70 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Face-backend features extractor')
     parser.add_argument('dataset_base_path', metavar='dataset_base_path', type=str, help='Base path of image dataset')
     parser.add_argument('images_list', metavar='images_list', type=str, help='Path to file containing the list of images to extract the features from. Image paths in the list should be paths relative to dataset_base_path')
-    parser.add_argument('-o', dest='output_file', default=settings.DATASET_FEATS_FILE, help='Output file (default: file specified in the settings). If the file exist the new features will be appended to it.')
+    parser.add_argument('-o', dest='output_file', default=settings.DATASET_FEATS_FILE, help='Output file (default: file specified in the settings). If the file exist the new features will be appended to it. An interrupted ingestion of the same images list is resumed.')
+    parser.add_argument('-i', dest='incremental', action='store_true', help='Only ingest the images that are new or changed since the previous incremental ingestion into the output file, and remove the faces of the images that changed or are no longer in the list')
+    parser.add_argument('--content-hash', dest='content_hash', action='store_true', help='In an incremental ingestion, detect the changed images by the hash of their contents instead of their modification time')
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
 
-    previous_database = None
-    if os.path.exists(args.output_file):
-        with open(args.output_file, 'rb') as fin:
-            previous_database = pickle.load(fin)
-        if isinstance(previous_database, list):
-            print ('ERROR: This script creates a dictionary-based database and cannot be used to add information to the existing list-based database found at %s. Aborting !.' % args.output_file)
-            sys.exit(1)
+    # use one thread per core, on the specified cores
+    if args.cores:
+        cpuutils.apply_cpu_plan(cpuutils.parse_core_list(args.cores))
+    else:
+        cpuutils.apply_cpu_plan(cpuutils.get_available_cores())
 
-    # import face detector
-    import face_detection_retinaface
-    face_detector = face_detection_retinaface.FaceDetectorRetinaFace()
+    # the features are appended to the output file in segments, without loading the existing ones
+    if not args.incremental:
+        writer = segmentutils.SegmentWriter(args.output_file, os.path.abspath(args.images_list))
+        reader = functools.partial(read_images_list, args.images_list, first_index=writer.processed)
+    else:
+        writer = segmentutils.SegmentWriter(args.output_file, os.path.abspath(args.images_list) + ' (incremental)')
+        model_version = get_model_version()
+        ingested_files = segmentutils.load_ingested_files(args.output_file)
+        to_ingest, to_remove = plan_incremental_ingestion(args.dataset_base_path, args.images_list, ingested_files,
+                                                          args.content_hash, model_version)
+        if writer.processed == 0 and args.dedup_index and len(to_remove) > 0:
+            # the duplicates of the images removed were never ingested, so ingest them now. They are
+            # forgotten before planning again, so that a resumed ingestion finds the same plan.
+            hash_index = hashindex.HashIndex(args.dedup_index, args.dedup_distance)
+            orphans = [ img_path for img_path in hash_index.remove(to_remove) if img_path in ingested_files ]
+            hash_index.close()
+            if len(orphans) > 0:
+                print ('Found %d duplicates of images to be removed, which will be ingested' % len(orphans))
+                for img_path in orphans:
+                    ingested_files.pop(img_path)
+                segmentutils.save_atomically(ingested_files, segmentutils.get_ingested_files_file(args.output_file))
+                to_ingest, to_remove = plan_incremental_ingestion(args.dataset_base_path, args.images_list, ingested_files,
+                                                                  args.content_hash, model_version)
+        print ('Found %d new or changed images, %d images to be removed' % (len(to_ingest), len(to_remove)))
+        if len(ingested_files) == 0 and os.path.exists(args.output_file):
+            # the database was not built incrementally, so the faces of any image could be in it already
+            to_remove.update([ img_path for img_path, identity in to_ingest ])
+        # the faces are removed before ingesting the images again. Do not remove the faces of a
+        # resumed ingestion, which were removed already and might include the new ones.
+        if writer.processed == 0 and len(to_remove) > 0:
+            print ('Removed %d faces from %s' % (remove_images(args.output_file, to_remove), args.output_file))
+        reader = functools.partial(feed_images, [ (index, img_path) for index, (img_path, identity) in enumerate(to_ingest) if index >= writer.processed ])
 
-    # import and create face feature extractor
-    import face_features
-    feature_extractor = face_features.FaceFeatureExtractor()
+    face_detector, feature_extractors = create_models(args.features_threads)
 
     # Compute features for all image paths in args.images_list
-    all_feats = {'paths': [], 'rois': [], 'feats': []}
-    with open(args.images_list) as fin:
-        for img_path in fin:
-            img_path = img_path.replace('\n', '')
-            if len(img_path) > 0:
-                full_path = os.path.join(args.dataset_base_path, img_path)
-                print ('Computing features for file %s' % (full_path))
-
-                # read image
-                img = imutils.acquire_image(full_path)
-
-                # run face detector
-                detections = face_detector.detect_faces(img)
-
-                if numpy.all(detections != None):
-
-                    for det in detections:
-
-                        # The coordinates should be already integers, but some basic
-                        # conversion is need for compatibility with all face detectors.
-                        # Plus we have to get rid of the detection score det[4]
-                        det = [int(det[0]), int(det[1]), int(det[2]), int(det[3])]
-
-                        # crop image to detected face area.
-                        crop_img = img[det[1]:det[3], det[0]:det[2], :]
-
-                        # compute feature
-                        feat = feature_extractor.feature_compute(crop_img)
-
-                        # Append to previous results
-                        all_feats['paths'].append(img_path)
-                        all_feats['rois'].append(det)
-                        all_feats['feats'].append(feat)
-
-        # load previous database file, if present
-        if previous_database:
-            # convert back to list before appending
-            previous_database['feats'] = list(previous_database['feats'])
-            # append new elements to previous database
-            for idx in range(len(all_feats['paths'])):
-                previous_database['feats'].append(all_feats['feats'][idx])
-                previous_database['paths'].append(all_feats['paths'][idx])
-                previous_database['rois'].append(all_feats['rois'][idx])
-            all_feats = previous_database
-
-        # convert to format used in the backend
-        all_feats['feats'] = numpy.array(all_feats['feats'])
-        # save to database file
-        with open(args.output_file, 'wb') as fout:
-            pickle.dump(all_feats, fout, pickle.HIGHEST_PROTOCOL)
+    num_images, stages, total_time = run_pipeline(args, face_detector, feature_extractors, reader,
+                                                  writer.processed, functools.partial(write_faces, writer))
+    if any([ stage.error for stage in stages ]):
+        # keep the last checkpoint, so the ingestion can be resumed
+        print ('ERROR: The pipeline failed. Run this script again to resume from the last checkpoint. Aborting !.')
+        sys.exit(1)
+
+    # save the remaining features
+    writer.close()
+
+    if args.incremental:
+        # record the images ingested, so that the next incremental ingestion skips them
+        for img_path in to_remove:
+            ingested_files.pop(img_path, None)
+        for img_path, identity in to_ingest:
+            ingested_files[img_path] = (identity, model_version)
+        segmentutils.save_atomically(ingested_files, segmentutils.get_ingested_files_file(args.output_file))
+
+    print_report(num_images, writer.num_faces, stages, total_time)
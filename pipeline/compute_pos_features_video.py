@@ -4,66 +4,385 @@ __copyright__   = 'April 2018'
 import os
 import sys
 import numpy
-import pickle
 import argparse
 import platform
+import multiprocessing
+import queue
 from multiprocessing import freeze_support
 import shutil
 import string
 import re
 
-MIN_IOU = 0.5
+FEATURES_BATCH_SIZE = 32
 
-def get_iou(bb1, bb2):
-    """
-    Calculate the Intersection over Union (IoU) of two bounding boxes.
-    Taken from https://stackoverflow.com/questions/25349178/calculating-percentage-of-bounding-box-overlap-for-image-detector-evaluation
-    Arguments:
-        bb1 : list[x1,y1,x2,y2]
-            The (x1, y1) position is at the top left corner,
-            the (x2, y2) position is at the bottom right corner
-        bb2 : dict
-        Keys: list[x1,y1,x2,y2]
-            The (x, y) position is at the top left corner,
-            the (x2, y2) position is at the bottom right corner
-    Returns:
-        A float number in [0, 1]
-    """
-    assert bb1[0] < bb1[2]
-    assert bb1[1] < bb1[3]
-    assert bb2[0] < bb2[2]
-    assert bb2[1] < bb2[3]
-
-    # determine the coordinates of the intersection rectangle
-    x_left = max(bb1[0], bb2[0])
-    y_top = max(bb1[1], bb2[1])
-    x_right = min(bb1[2], bb2[2])
-    y_bottom = min(bb1[3], bb2[3])
-
-    if x_right < x_left or y_bottom < y_top:
-        return 0.0
-
-    # The intersection of two axis-aligned bounding boxes is always an
-    # axis-aligned bounding box
-    intersection_area = (x_right - x_left) * (y_bottom - y_top)
-
-    # compute the area of both AABBs
-    bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
-    bb2_area = (bb2[2] - bb2[0]) * (bb2[3] - bb2[1])
-
-    # compute the intersection over union by taking the intersection
-    # area and dividing it by the sum of prediction + ground-truth
-    # areas - the intersection area
-    iou = intersection_area / float(bb1_area + bb2_area - intersection_area)
-    assert iou >= 0.0
-    assert iou <= 1.0
-    return iou
+# models used by process_shot_job(), created once per process
+shot_face_detector = None
+shot_feature_extractor = None
 
 # add the web service folder to the sys path
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(DIR_PATH, '..', 'service'))
 import settings
 import imutils
+import cpuutils
+import segmentutils
+import shotutils
+import tracker
+
+
+def get_destination_folder(video_name):
+    """
+        Returns the name of the sub-folder of the dataset folder where the frames of a video are saved
+        Arguments:
+            video_name: name of the video, or of the folder with its frames
+        Returns:
+            The name of the sub-folder, made only of letters, digits and underscores
+    """
+    if video_name.endswith(os.path.sep):
+        video_name = video_name[:-1]
+    pattern = re.compile('[^a-zA-Z0-9_]')
+    string_accepted = pattern.sub('', string.printable)
+    video_name = video_name.split(os.path.sep)[-1]
+    return ''.join(filter(lambda afunc: afunc in string_accepted, video_name))
+
+
+def face_quality(crop, score):
+    """
+        Estimates the quality of a face for the computation of features, from its detection score,
+        its size and its sharpness, measured as the variance of the Laplacian of the crop
+        Arguments:
+            crop: MxNx3 array with the crop of the face
+            score: detection score of the face
+        Returns:
+            A float number. Larger numbers mean better quality. Only meant to compare faces of the same track.
+    """
+    gray = crop.astype(numpy.float32).mean(axis=2)
+    sharpness = 0.0
+    if gray.shape[0] > 2 and gray.shape[1] > 2:
+        laplacian = 4*gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:]
+        sharpness = float(laplacian.var())
+    return float(score) * numpy.sqrt(gray.shape[0] * gray.shape[1]) * numpy.log1p(sharpness)
+
+
+class ShotProcessor(object):
+    """
+        Class computing the face tracks of a shot, and their features, while the frames of the shot are
+        read one at a time. Only the information of the active tracks is kept, and the crops of the faces
+        are input to the feature extractor in batches as soon as there are enough of them. Therefore,
+        the memory used does not depend on the length of the shot.
+
+        If a features budget is specified, the features of a track are computed from that number of
+        faces at most, so that the cost of the feature extraction depends on the number of tracks and
+        not on their length. The faces are chosen by their quality, as estimated by face_quality(),
+        while spreading them over the duration of the track. To do so, each track keeps the best face
+        of up to twice the budget of consecutive periods of the track, and the periods are merged in
+        pairs when there are too many of them.
+
+        If a detection interval larger than one is specified, the face detector only runs on key frames:
+        every that number of frames, or when the colour histogram of the frame changed too much since the
+        last key frame. In the other frames, the faces of the active tracks are followed by matching
+        their templates from the last key frame. If a face is not found with enough confidence, the
+        detector is run on the frame.
+    """
+
+    def __init__(self, face_detector, feature_extractor, keep_frames=False, batch_size=FEATURES_BATCH_SIZE, face_tracker=None,
+                 features_budget=settings.VIDEO_TRACK_FEATURES_BUDGET, detection_interval=settings.VIDEO_DETECTION_INTERVAL,
+                 detection_change_threshold=settings.VIDEO_DETECTION_CHANGE_THRESHOLD,
+                 propagation_min_confidence=settings.VIDEO_PROPAGATION_MIN_CONFIDENCE):
+        """
+            Initializes the processor
+            Arguments:
+                face_detector: FaceDetectorRetinaFace object
+                feature_extractor: FaceFeatureExtractor object
+                keep_frames: boolean indicating whether to keep the frame chosen to represent each track,
+                             e.g. to save it when the frame is not stored in a file
+                batch_size: maximum number of faces input to the feature extractor at once
+                face_tracker: FaceTracker object. If None, a tracker configured with the settings is used.
+                features_budget: maximum number of faces per track used to compute the features of the track.
+                                 If zero, all the faces are used.
+                detection_interval: number of frames between key frames, where the face detector is run
+                detection_change_threshold: change of the colour histogram since the last key frame, as a
+                                            fraction of the number of pixel values, that makes a frame a key frame
+                propagation_min_confidence: minimum NCC to follow a face by template matching
+        """
+        self.face_detector = face_detector
+        self.feature_extractor = feature_extractor
+        self.keep_frames = keep_frames
+        self.batch_size = batch_size
+        self.features_budget = features_budget
+        self.detection_interval = detection_interval
+        self.detection_change_threshold = detection_change_threshold
+        self.propagation_min_confidence = propagation_min_confidence
+        self.frames_since_detection = detection_interval
+        self.key_frame_hist = None
+        self.templates = {}
+        if face_tracker == None:
+            face_tracker = tracker.FaceTracker(settings.VIDEO_TRACKING_MIN_IOU, settings.VIDEO_TRACKING_MATCHING, settings.VIDEO_TRACKING_MAX_GAP)
+        self.face_tracker = face_tracker
+        self.active_tracks = {}
+        self.closed_tracks = []
+
+
+    def add_frame(self, frame_key, img):
+        """
+            Detects the faces in the next frame of the shot and adds them to the tracks
+            Arguments:
+                frame_key: value identifying the frame, e.g. its file name. It is returned with the results.
+                img: MxNx3 array with the contents of the frame in RGB format, or None if the frame
+                     could not be read, in which case it is taken as a frame without faces
+        """
+        if img is None:
+            face_tracks, ended_tracks = self.face_tracker.update([])
+            for number in ended_tracks:
+                self.close_track_(self.active_tracks.pop(number))
+                self.templates.pop(number, None)
+            return
+
+        gray = None
+        hist = None
+        if self.detection_interval > 1:
+            gray = tracker.to_gray(img)
+            hist = shotutils.hist_col(img, shotutils.HIST_BINS)
+            if not self.is_key_frame_(hist):
+                propagated = self.propagate_faces_(gray)
+                if propagated is not None:
+                    self.frames_since_detection = self.frames_since_detection + 1
+                    for number in self.face_tracker.propagate(propagated):
+                        self.close_track_(self.active_tracks.pop(number))
+                        self.templates.pop(number, None)
+                    for number in propagated:
+                        self.add_face_(self.active_tracks[number], frame_key, img, propagated[number])
+                    return
+
+        detections = self.face_detector.detect_faces(img)
+        if detections is None:
+            detections = []
+        face_tracks, ended_tracks = self.face_tracker.update(detections)
+        for number in ended_tracks:
+            self.close_track_(self.active_tracks.pop(number))
+            self.templates.pop(number, None)
+        for det, number in zip(detections, face_tracks):
+            if number not in self.active_tracks:
+                self.active_tracks[number] = {'number': number, 'crops': [], 'num_faces': 0, 'num_detections': 0,
+                                              'period_length': 1, 'candidates': {},
+                                              'feats_accumulator': numpy.zeros(settings.FEATURES_VECTOR_SIZE),
+                                              'best_score': -100000, 'best_frame_key': None, 'best_det': None, 'best_img': None}
+            self.add_face_(self.active_tracks[number], frame_key, img, det)
+            if gray is not None:
+                self.templates[number] = (tracker.extract_template(gray, det), det[4])
+        self.frames_since_detection = 0
+        self.key_frame_hist = hist
+
+
+    def is_key_frame_(self, hist):
+        """
+            Decides whether the face detector must be run on a frame
+            Arguments:
+                hist: colour histogram of the frame
+            Returns:
+                True if it is a key frame, False otherwise
+        """
+        if self.frames_since_detection + 1 >= self.detection_interval or self.key_frame_hist is None:
+            return True
+        change = numpy.abs(hist - self.key_frame_hist).sum() / float(hist.sum())
+        return change > self.detection_change_threshold
+
+
+    def propagate_faces_(self, gray):
+        """
+            Follows the faces of the active tracks in a new frame, by template matching
+            Arguments:
+                gray: grayscale version of the frame
+            Returns:
+                A dictionary with the new detection, in the form [x1,y1,x2,y2,score], of each track
+                number, or None if a face could not be followed with enough confidence
+        """
+        propagated = {}
+        for number, box in self.face_tracker.get_boxes().items():
+            if number not in self.templates:
+                continue
+            template, score = self.templates[number]
+            new_box, confidence = tracker.match_template(gray, template, box)
+            if confidence < self.propagation_min_confidence:
+                return None
+            propagated[number] = new_box + [score]
+        return propagated
+
+
+    def add_face_(self, track, frame_key, img, det):
+        """
+            Adds a face to a track
+            Arguments:
+                track: dictionary with the information of the track
+                frame_key: value identifying the frame of the face
+                img: frame of the face
+                det: detection of the face, in the form [x1,y1,x2,y2,score]
+        """
+        score = det[4]
+
+        # The coordinates should be already integers, but some basic
+        # conversion is need for compatibility with all face detectors.
+        # Plus we have to get rid of the detection score det[4]
+        det = [int(det[0]), int(det[1]), int(det[2]), int(det[3])]
+
+        # crop image to detected face area, copying it so that the frame can be released
+        crop_img = numpy.array(img[det[1]:det[3], det[0]:det[2], :])
+        if self.features_budget > 0:
+            self.add_candidate_(track, crop_img, face_quality(crop_img, score))
+        else:
+            track['crops'].append(crop_img)
+            if len(track['crops']) >= self.batch_size:
+                self.compute_features_(track)
+        track['num_detections'] = track['num_detections'] + 1
+
+        if score > track['best_score']:
+            track['best_score'] = score
+            track['best_frame_key'] = frame_key
+            track['best_det'] = det
+            if self.keep_frames:
+                track['best_img'] = img
+
+
+    def add_candidate_(self, track, crop_img, quality):
+        """
+            Keeps a face of a track if it is the best one so far in its period of the track
+            Arguments:
+                track: dictionary with the information of the track
+                crop_img: crop of the face
+                quality: quality of the face
+        """
+        period = track['num_detections'] // track['period_length']
+        candidate = track['candidates'].get(period, None)
+        if candidate is None or quality > candidate[0]:
+            track['candidates'][period] = (quality, crop_img)
+        if len(track['candidates']) > 2*self.features_budget:
+            # merge the periods in pairs, keeping the best face of each pair
+            track['period_length'] = track['period_length'] * 2
+            candidates = {}
+            for period, candidate in track['candidates'].items():
+                if period//2 not in candidates or candidate[0] > candidates[period//2][0]:
+                    candidates[period//2] = candidate
+            track['candidates'] = candidates
+
+
+    def select_candidates_(self, track):
+        """
+            Chooses the faces of a track used to compute its features, within the features budget:
+            the track is split in as many parts as the budget, and the best face of each part is chosen
+            Arguments:
+                track: dictionary with the information of the track
+        """
+        chosen = {}
+        for period, candidate in track['candidates'].items():
+            part = min(self.features_budget - 1, period * track['period_length'] * self.features_budget // max(track['num_detections'], 1))
+            if part not in chosen or candidate[0] > chosen[part][0]:
+                chosen[part] = candidate
+        track['crops'] = [ chosen[part][1] for part in sorted(chosen) ]
+        track['candidates'] = {}
+
+
+    def compute_features_(self, track):
+        """
+            Computes the features of the faces of a track waiting in memory, and adds them to the
+            accumulated features of the track
+            Arguments:
+                track: dictionary with the information of the track
+        """
+        for feat in self.feature_extractor.feature_compute_batch(track['crops']):
+            if feat is None:
+                print ('Could not compute the features of a face in %s' % str(track['best_frame_key']))
+                continue
+            track['feats_accumulator'] = track['feats_accumulator'] + feat
+            track['num_faces'] = track['num_faces'] + 1
+        track['crops'] = []
+
+
+    def close_track_(self, track):
+        """
+            Finishes a track, computing the average of the features of its faces
+            Arguments:
+                track: dictionary with the information of the track
+        """
+        if self.features_budget > 0:
+            self.select_candidates_(track)
+        self.compute_features_(track)
+        if track['num_faces'] == 0:
+            return
+
+        # average and normalize
+        feats_average = track['feats_accumulator'] / track['num_faces']
+        feats_average_norm = numpy.linalg.norm(feats_average)
+        feats_average_norm = feats_average/max(feats_average_norm, 0.00001)
+
+        # make sure we save a simple 1D vector
+        feats_average_1D = numpy.reshape(feats_average_norm, settings.FEATURES_VECTOR_SIZE)
+        self.closed_tracks.append((track['number'], track['best_frame_key'], track['best_det'], feats_average_1D, track['best_img']))
+
+
+    def finish(self):
+        """
+            Finishes all the tracks of the shot
+            Returns:
+                A list of tuples (frame_key, det, feat, img), one per track, in the order the tracks were
+                started. frame_key identifies the frame chosen to represent the track, det is the
+                bounding-box of the face in that frame, feat is the feature vector of the track and img
+                is the chosen frame, or None if the frames are not kept.
+        """
+        for number in self.face_tracker.finish():
+            self.close_track_(self.active_tracks.pop(number))
+        results = [ result[1:] for result in sorted(self.closed_tracks, key=lambda result: result[0]) ]
+        self.closed_tracks = []
+        return results
+
+
+def load_shot_models(shared_network=None):
+    """
+        Creates the models used by process_shot_job() in the current process
+        Arguments:
+            shared_network: feature extraction model with its weights in shared memory, or None
+                            if the process must load its own model
+    """
+    global shot_face_detector, shot_feature_extractor
+    import face_detection_retinaface
+    import face_features
+    shot_face_detector = face_detection_retinaface.FaceDetectorRetinaFace()
+    shot_feature_extractor = face_features.FaceFeatureExtractor(network=shared_network)
+
+
+def init_shot_worker(worker_cores_queue, all_worker_cores, shared_network):
+    """
+        Initializes a process of the pool of shot workers. Makes the process use the cores assigned
+        to it and creates its models, which stay in memory for all the shots processed by the worker.
+        Arguments:
+            worker_cores_queue: queue with the list of cores of each worker
+            all_worker_cores: list of the cores of all workers, used when the queue is empty
+            shared_network: feature extraction model with its weights in shared memory, or None
+                            if the worker must load its own model
+    """
+    try:
+        # wait a bit, the items put in the queue by the parent process might not have arrived yet
+        cores = worker_cores_queue.get(True, 5)
+    except queue.Empty:
+        cores = all_worker_cores
+    cpuutils.apply_cpu_plan(cores)
+    load_shot_models(shared_network)
+
+
+def process_shot_job(job):
+    """
+        Computes the face tracks of a shot, and their features, with the models of the current process
+        Arguments:
+            job: tuple (video_frames_path, frame_names) with the folder of the frames and the list of
+                 file names of the frames of the shot
+        Returns:
+            The list of results of ShotProcessor.finish(), where the frames are identified by their file names
+    """
+    video_frames_path, frame_names = job
+    shot_processor = ShotProcessor(shot_face_detector, shot_feature_extractor)
+    for img_name in frame_names:
+        shot_processor.add_frame(img_name, imutils.acquire_image(os.path.join(video_frames_path, img_name)))
+    return shot_processor.finish()
+
 
 if __name__ == '__main__':
     if 'Windows' in platform.system():
@@ -74,7 +393,9 @@ if __name__ == '__main__':
     parser.add_argument('video_frames_path', metavar='video_frames_path', type=str, help='Base path of video frames')
     parser.add_argument('shot_boundaries', metavar='shot_boundaries', type=str, help='Path to file containing the list of shot boundaries for the video')
     parser.add_argument('dataset_base_path', metavar='dataset_base_path', type=str, help='Base path of image dataset')
-    parser.add_argument('-o', dest='output_file', default=settings.DATASET_FEATS_FILE, help='Output file (default: file specified in the settings). If the file exist the new features will be appended to it.')
+    parser.add_argument('-o', dest='output_file', default=settings.DATASET_FEATS_FILE, help='Output file (default: file specified in the settings). If the file exist the new features will be appended to it. An interrupted ingestion of the same video is resumed.')
+    parser.add_argument('-c', dest='cores', default=None, help='Cores to run on, e.g. 0-3,6 (default: all the available cores). Useful to run several instances of this script side by side.')
+    parser.add_argument('-w', dest='workers', type=int, default=1, help='Number of worker processes computing the face tracks of different shots at the same time, each one running on a separate set of cores (default: 1)')
     args = parser.parse_args()
 
     if not os.path.exists(args.video_frames_path) or not os.path.exists(args.shot_boundaries):
@@ -87,193 +408,59 @@ if __name__ == '__main__':
     if len(video_frames_list) == 0:
         print ('ERROR: There are no frames in the video frames path. Aborting !.')
         sys.exit(1)
+    # position of each frame in the list
+    frames_index = { img_name: index for index, img_name in enumerate(video_frames_list) }
 
-    # load previous database, if present
-    previous_database = None
-    if os.path.exists(args.output_file):
-        with open(args.output_file, 'rb') as fin:
-            previous_database = pickle.load(fin)
-        if isinstance(previous_database, list):
-            print ('ERROR: This script creates a dictionary-based database and cannot be used to add information to the existing list-based database found at %s. Aborting !.' % args.output_file)
-            sys.exit(1)
-
-    # import the face detector
-    import face_detection_retinaface
-    face_detector = face_detection_retinaface.FaceDetectorRetinaFace()
-
-    # import and create face feature extractor
-    import face_features
-    feature_extractor = face_features.FaceFeatureExtractor()
+    # the features are appended to the output file in segments, without loading the existing ones
+    writer = segmentutils.SegmentWriter(args.output_file, os.path.abspath(args.video_frames_path) + ' ' + os.path.abspath(args.shot_boundaries))
 
     # acquire shots list
-    shots_list = []
-    with open(args.shot_boundaries) as fshots:
-        for line in fshots:
-            if len(line) > 0:
-                line = line.replace('\n', '')
-                ashot = line.split(' ')
-                shots_list.append(ashot)
+    shots_list = shotutils.read_shots(args.shot_boundaries)
 
     # create final sub-folder in the dataset folder
-    destination_frames_path = args.video_frames_path
-    if destination_frames_path.endswith(os.path.sep):
-        destination_frames_path = destination_frames_path[:-1]
-
-    pattern = re.compile('[^a-zA-Z0-9_]')
-    string_accepted = pattern.sub('', string.printable)
-    destination_frames_path = destination_frames_path.split(os.path.sep)[-1]
-    destination_frames_path = ''.join(filter(lambda afunc: afunc in string_accepted, destination_frames_path))
+    destination_frames_path = get_destination_folder(args.video_frames_path)
     if not os.path.exists(os.path.join(args.dataset_base_path, destination_frames_path)):
         os.makedirs(os.path.join(args.dataset_base_path, destination_frames_path))
 
-    # go through list of shots computing tracks and features
-    all_feats = {'paths': [], 'rois': [], 'feats': []}
-    for shot in shots_list:
-
-        # all files should be in jpeg format (and with extension .jpg), because we must have split
-        # the video before, using exactly this format and extension
-        shot_begin = shot[0] + '.jpg'
-        shot_end = shot[1] + '.jpg'
-        shot_begin_index = video_frames_list.index(shot_begin)
-        shot_end_index = video_frames_list.index(shot_end)
-        shot_detections = []
-        shot_tracks = []
-        shot_images = []
-
-        #####
-        # Compute face detections in shot
-        #####
-        for index in range(shot_begin_index, shot_end_index+1):
-            img_name = video_frames_list[index]
-            full_path = os.path.join(args.video_frames_path, img_name)
-
-            # read image
-            img = imutils.acquire_image(full_path)
-            shot_images.append(img)
-
-            # run face detector
-            detections = face_detector.detect_faces(img)
-            shot_detections.append(detections)
-            if numpy.all(detections != None):
-                shot_tracks.append([-1] * len(detections)) # init all tracks number with -1 ...
-            else:
-                shot_tracks.append(None) # ... or None if there are no detections
+    # use one thread per core, on the specified cores
+    cores = cpuutils.parse_core_list(args.cores) if args.cores else cpuutils.get_available_cores()
+    if args.workers > 1:
+        # the shots are independent, so process several of them at the same time, each one in
+        # a worker with its own cores. The weights of the feature extractor are loaded only once.
+        import face_features
+        shared_network = face_features.load_shared_network()
+        cpu_plan = cpuutils.plan_cpu_usage(args.workers, 0, cores)
+        worker_cores_queue = multiprocessing.Queue()
+        for worker_cores in cpu_plan['workers']:
+            worker_cores_queue.put(worker_cores)
+        worker_pool = multiprocessing.Pool(processes=args.workers, initializer=init_shot_worker,
+                                           initargs=(worker_cores_queue, cores, shared_network))
+        cpuutils.apply_cpu_plan(cpu_plan['main'])
+        shots_map = worker_pool.imap
+    else:
+        cpuutils.apply_cpu_plan(cores)
+        load_shot_models()
+        shots_map = map
+
+    # go through list of shots computing tracks and features, skipping the shots
+    # processed by a previous run that was interrupted. All files should be in jpeg format
+    # (and with extension .jpg), because we must have split the video before, using exactly
+    # this format and extension
+    jobs = ( (args.video_frames_path, video_frames_list[frames_index[shot[0] + '.jpg']:frames_index[shot[1] + '.jpg'] + 1])
+             for shot in shots_list[writer.processed:] )
+
+    # the results are received in the same order as the shots
+    for shot_results in shots_map(process_shot_job, jobs):
 
         #####
-        # Compute face tracks in shot
+        # Save the face tracks of the shot.
+        # Also copy those frames representing the tracks to their final sub-folder in the dataset folder
         #####
 
-        # The code below uses two pointers to the array of images: index A and index B.
-        # Index A points to the current image
-        # Index B is used for comparing the faces in A with the faces in the rest of the images in the shot
-
-        face_track_counter = 0
-        map_track_images_det = {}
-        # iterate through images with pointer A
-        for index_image_A in range(len(shot_detections)):
-            if shot_detections[index_image_A]: # check for a non-empty list
-                image_A_detections = shot_detections[index_image_A]
-                image_A_tracks = shot_tracks[index_image_A]
-
-                # iterate through faces in image pointed by A
-                for index_faces_A in range(len(image_A_detections)):
-                    image_A_face_det = image_A_detections[index_faces_A]
-                    if image_A_tracks[index_faces_A] < 0: # only take into account faces with no-assigned tracks
-                        image_A_tracks[index_faces_A] = face_track_counter
-                        # save track info
-                        if face_track_counter not in map_track_images_det.keys():
-                            map_track_images_det[face_track_counter] = []
-                        map_track_images_det[face_track_counter].append([index_image_A, image_A_face_det])
-                        index_image_B = index_image_A + 1 # start index B in the next image
-
-                         # iterate through images with pointer B (B>A)
-                        while index_image_B < len(shot_detections):
-                            if shot_detections[index_image_B]: # check for a non-empty list
-                                image_B_detections = shot_detections[index_image_B]
-                                image_B_tracks = shot_tracks[index_image_B]
-                                found_match = False
-
-                                # iterate through faces in image pointed by B
-                                for index_faces_B in range(len(image_B_detections)):
-                                    if image_B_tracks[index_faces_B] < 0: # only take into account faces with no-assigned tracks
-                                        image_B_face_det = image_B_detections[index_faces_B]
-                                        #print ("compare %s against %s" % (str(image_A_face_det), str(image_B_face_det)))
-                                        the_iou = get_iou(image_A_face_det, image_B_face_det)
-                                        if the_iou > MIN_IOU:
-                                            # found match, moving to next image
-                                            found_match = True
-                                            # save track info
-                                            image_B_tracks[index_faces_B] = face_track_counter  # save track number
-                                            map_track_images_det[face_track_counter].append([index_image_B, image_B_face_det])
-                                            image_A_face_det = image_B_face_det # update tracking face
-                                            break
-                                # end for
-
-                                if found_match:
-                                    # move to next image
-                                    index_image_B = index_image_B + 1
-                                else:
-                                    # stop tracking and move to next image with index A, increase track counter
-                                    face_track_counter = face_track_counter + 1
-                                    break
-                            else:
-                                # an empty list means a break in the track
-                                # stop tracking and move to next image with index A, increase track counter
-                                face_track_counter = face_track_counter + 1
-                                break
-                        # end while
-
-                        # if we reached the end, increase track counter
-                        if index_image_B == len(shot_detections):
-                            face_track_counter = face_track_counter + 1
-
-        #####
-        # Compute average feature per track, per image.
-        # Also copy those frames representing the track to their final sub-folder in the dataset folder
-        #####
-
-        for track in map_track_images_det:
-            det_pair_list = map_track_images_det[track]
-            feats_accumulator = numpy.zeros((1, settings.FEATURES_VECTOR_SIZE))
-            best_score = -100000
-            chosen_image_path = None
-            chosen_det = None
-            for det_pair in det_pair_list:
-                img_index = det_pair[0]
-                img_path = video_frames_list[img_index + shot_begin_index]
-                img = shot_images[img_index]
-                det = det_pair[1]
-                score = det[4]
-
-                # The coordinates should be already integers, but some basic
-                # conversion is need for compatibility with all face detectors.
-                # Plus we have to get rid of the detection score det[4]
-                det = [int(det[0]), int(det[1]), int(det[2]), int(det[3])]
-
-                # crop image to detected face area.
-                crop_img = img[det[1]:det[3], det[0]:det[2], :]
-
-                # compute feature
-                feat = feature_extractor.feature_compute(crop_img)
-                feats_accumulator = feats_accumulator + feat
-
-                if score > best_score:
-                    best_score = score
-                    chosen_image_path = img_path
-                    chosen_det = det
-
-            # average and normalize
-            feats_average = feats_accumulator / len(det_pair_list)
-            feats_average_norm = numpy.linalg.norm(feats_average)
-            feats_average_norm = feats_average/max(feats_average_norm, 0.00001)
-
-            # make sure we save a simple 1D vector
-            feats_average_1D = numpy.reshape(feats_average_norm, settings.FEATURES_VECTOR_SIZE)
+        for chosen_image_path, chosen_det, feat, img in shot_results:
 
             # append to previous results
-            all_feats['paths'].append(destination_frames_path + os.path.sep + chosen_image_path)
-            all_feats['rois'].append(chosen_det)
-            all_feats['feats'].append(feats_average_1D)
+            writer.add_face(destination_frames_path + os.path.sep + chosen_image_path, chosen_det, feat)
 
             # copy chosen frame to final destination in dataset folder
             chose_image_path_in_datasets = os.path.join(args.dataset_base_path, destination_frames_path, chosen_image_path)
@@ -282,21 +469,12 @@ if __name__ == '__main__':
                 # print final frame path within the dataset folder, for other process to pick up
                 print (destination_frames_path + os.path.sep + chosen_image_path)
 
-    # after processing all shots, save the results ...
-
-    # if there is a previous database file ...
-    if previous_database:
-        # ... convert back to list before appending
-        previous_database['feats'] = list(previous_database['feats'])
-        # append new elements to previous database
-        for idx in range(len(all_feats['paths'])):
-            previous_database['feats'].append(all_feats['feats'][idx])
-            previous_database['paths'].append(all_feats['paths'][idx])
-            previous_database['rois'].append(all_feats['rois'][idx])
-        all_feats = previous_database
-
-    # convert to format used in the backend
-    all_feats['feats'] = numpy.array(all_feats['feats'])
-    # save to database file
-    with open(args.output_file, 'wb') as fout:
-        pickle.dump(all_feats, fout, pickle.HIGHEST_PROTOCOL)
+        # all the tracks of the shot are done
+        writer.item_done()
+
+    if args.workers > 1:
+        worker_pool.close()
+        worker_pool.join()
+
+    # after processing all shots, save the remaining results
+    writer.close()
@@ -6,13 +6,15 @@ import sys
 import argparse
 import platform
 import numpy
-from scipy.spatial import distance as df
+import multiprocessing
 from multiprocessing import freeze_support
 
-# add the web service folder to the sys path
+# add the web service and pipeline folders to the sys path
 dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join( dir_path, '..', '..', 'service'))
+sys.path.append(os.path.join( dir_path, '..'))
 import imutils
+import shotutils
 
 # Program constants
 MIN_SHOT_LENGTH = 1
@@ -21,21 +23,38 @@ HIST_BINS = 32
 HIST_THRESH = 0.2
 FRAMES_PER_SECOND = 25
 CONVERT_TO_SECONDS = False
+DECODING_SCALE = 1.0
+FRAMES_PER_JOB = 250
 
-def hist_col(im_data, bins):
+def compute_histograms(job):
     """
-    Computes a histogram per image channel (assuming RGB pixels in the image data)
+    Computes the histograms of a chunk of consecutive frames. Used by the processes computing the
+    histograms of different chunks of frames in parallel.
     Arguments:
-       im_data: 3D image data, the last dimension should hold the pixel values in a linear array of length 3.
-       bins: Number of bins in the histogram
+       job: tuple (frame_paths, bins, scale) with the list of full paths to the frames, the number of
+            bins in the histograms and the factor applied to the size of the frames before computing
+            the histograms
     Returns:
-       a 1D array containing the histogram counts for each bin, for each pixel channel
+       A tuple with a 2D array with the histogram of each frame, as returned by shotutils.hist_col(),
+       and the number of pixels of the first frame before and after reducing its size. If a frame could
+       not be read, the path to the frame is returned instead of the array.
     """
-    all_counts = []
-    for channel_idx in range(3):
-        counts, bin_edges = numpy.histogram(im_data[:,:,channel_idx], bins=bins, range=(0.0,255.0))
-        all_counts.extend(counts)
-    return all_counts
+    frame_paths, bins, scale = job
+    hists = numpy.zeros((len(frame_paths), 3*bins), dtype=numpy.int64)
+    num_pixels = None
+    for idx, full_path in enumerate(frame_paths):
+        if scale == 1.0:
+            img = imutils.acquire_image(full_path)
+            original_size = None if numpy.all(img==None) else (img.shape[1], img.shape[0])
+        else:
+            img, original_size = imutils.acquire_image_reduced(full_path, scale)
+        if numpy.all(img==None):
+            return full_path, None
+        if num_pixels == None:
+            num_pixels = (original_size[0] * original_size[1], img.shape[1] * img.shape[0])
+        hists[idx] = shotutils.hist_col(img, bins)
+    return hists, num_pixels
+
 
 if __name__ == '__main__':
     if 'Windows' in platform.system():
@@ -51,6 +70,8 @@ if __name__ == '__main__':
     parser.add_argument('-f', dest='frames_per_second', default=FRAMES_PER_SECOND, type=int, help='Frames per second in source video (default: 25)')
     parser.add_argument('-r', dest='min_shot_score', default=MIN_SHOT_SCORE, type=int, help='Minimum qualifying shot score (default: 100000)')
     parser.add_argument('-s', dest='convert_to_seconds', action='store_true', help='If used, the shot boundary indexes will be converted to seconds (default: shot boundaries indexes are not converted)')
+    parser.add_argument('-d', dest='decoding_scale', default=DECODING_SCALE, type=float, help='Factor applied to the size of the frames before computing their histograms, e.g. 0.25. JPEG frames are decoded directly at the reduced size. The thresholds are adjusted to the reduced size, but the boundaries might differ slightly from the ones found at full size (default: 1.0)')
+    parser.add_argument('-j', dest='processes', default=multiprocessing.cpu_count(), type=int, help='Number of processes computing histograms in parallel (default: number of CPUs)')
     args = parser.parse_args()
 
     # check input frames path
@@ -65,54 +86,52 @@ if __name__ == '__main__':
         print ('ERROR: There are no frames in %s . Aborting !.' % args.input_frames_dir)
         sys.exit(1)
 
-    # init useful vars
-    hist_cur = None
-    hist_prev =  None
-    hist_thresh_adjusted = -1
-    im_width = -1
-    im_height = -1
-    last_shot_integer_start_num = 0
-    last_shot_begin_in_real_world = 0
-    last_shot_string_start_num = ''
+    # compute the histograms of all frames, splitting the frames in chunks processed in parallel
+    jobs = []
+    for start in range(0, len(video_frames_list), FRAMES_PER_JOB):
+        frame_paths = [ os.path.join( args.input_frames_dir, img_name ) for img_name in video_frames_list[start:start + FRAMES_PER_JOB] ]
+        jobs.append((frame_paths, args.hist_bins, args.decoding_scale))
+    if args.processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=min(args.processes, len(jobs)))
+        results = pool.map(compute_histograms, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [ compute_histograms(job) for job in jobs ]
+    for hists, num_pixels in results:
+        if num_pixels == None:
+            print ('ERROR: Could not read %s. Aborting !' % hists)
+            sys.exit(1)
+    all_hists = numpy.concatenate([ hists for hists, num_pixels in results ])
+
+    # the l1-distance between the histograms of consecutive frames, including the frames at the
+    # borders of the chunks. The first frame has no previous frame, so its distance is zero.
+    all_shot_scores = numpy.zeros(len(video_frames_list), dtype=numpy.int64)
+    all_shot_scores[1:] = numpy.abs(all_hists[1:] - all_hists[:-1]).sum(axis=1)
+
+    # use first frame info to init some vars. The thresholds are relative to the number of
+    # pixels, so adjust them if the size of the frames was reduced.
+    original_pixels, reduced_pixels = results[0][1]
+    hist_thresh_adjusted = args.hist_thresh * reduced_pixels * 3
+    min_shot_score = args.min_shot_score * reduced_pixels / float(original_pixels)
+    first_frame_number = video_frames_list[0].split('.')[0]
+    last_shot_begin_in_real_world = int(first_frame_number)
+    last_shot_integer_start_num = int(first_frame_number)
+    last_shot_string_start_num = first_frame_number
 
     # go through images
     all_shots = []
-    for img_name in video_frames_list:
+    for frame_idx, img_name in enumerate(video_frames_list):
 
-        full_path = os.path.join( args.input_frames_dir, img_name )
         string_frame_number = img_name.split('.')[0]
         integer_frame_number = int(string_frame_number)
 
-        # read image
-        img = imutils.acquire_image(full_path)
-        if numpy.all(img==None):
-            print ('ERROR: Could not read %s. Aborting !' % full_path)
-            sys.exit(1)
-
-        if im_width<0 and im_height<0:
-            # use first frame info to init some vars
-            im_width = img.shape[1]
-            im_height = img.shape[0]
-            hist_thresh_adjusted =  args.hist_thresh * im_width *im_height * 3
-            last_shot_begin_in_real_world = integer_frame_number
-            last_shot_integer_start_num = integer_frame_number
-            last_shot_string_start_num = string_frame_number
-
-        shot_score = 0
-        newshot = False
-
-        # calculate histogram of current image
-        hist_cur = hist_col(img, bins=args.hist_bins)
-
-        if hist_prev != None:
-            # compute shot score (l1-distance between histograms of previous and current images) ...
-            shot_score = df.cityblock(hist_cur, hist_prev)
-            # ... and compare against threshold
-            if shot_score > hist_thresh_adjusted:
-                newshot = True
+        # compare the shot score (l1-distance between histograms of previous and current images) against threshold
+        shot_score = int(all_shot_scores[frame_idx])
+        newshot = frame_idx > 0 and shot_score > hist_thresh_adjusted
 
         # if we have found a new shot boundary and it qualifies for saving ...
-        if newshot and ( integer_frame_number - last_shot_integer_start_num >= args.min_shot_length) and shot_score >= args.min_shot_score:
+        if newshot and ( integer_frame_number - last_shot_integer_start_num >= args.min_shot_length) and shot_score >= min_shot_score:
 
             #print "newshot ! significant change between %d and %d" % (integer_frame_number-1, integer_frame_number)
             #print "shot_score ", shot_score
@@ -150,9 +169,6 @@ if __name__ == '__main__':
                 last_shot_integer_start_num = integer_frame_number
                 last_shot_string_start_num = string_frame_number
 
-        # make the current histogram the previous one
-        hist_prev = hist_cur
-
     # add the last shot, if necessary
     num_files = len(video_frames_list)
     if last_shot_integer_start_num <= num_files:
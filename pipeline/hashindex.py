@@ -0,0 +1,156 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import threading
+import sqlite3
+
+# number of bits of the hashes, and number of blocks of bits the hashes are split in for the lookup
+HASH_BITS = 64
+HASH_BLOCKS = 4
+
+
+def hamming_distance(hash_a, hash_b):
+    """
+        Returns the number of different bits between two hashes
+    """
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class HashIndex(object):
+    """
+        Class storing the perceptual hashes of the images ingested, in a SQLite database, to find the
+        near-duplicates of new images across ingestions. Each hash is split in HASH_BLOCKS blocks of
+        bits, and each block is indexed. Two hashes differing in less than HASH_BLOCKS bits have at
+        least one identical block, so all the near-duplicates of an image are found by looking up
+        its blocks, without comparing its hash with all the others.
+
+        The duplicates are not ingested, but they are recorded with the image they are a copy of,
+        so that they can be traced back to the faces of that image.
+    """
+
+    def __init__(self, index_file, max_distance, timeout=60.0):
+        """
+            Opens the index, creating the file if it does not exist
+            Arguments:
+                index_file: Full path to the SQLite file of the index
+                max_distance: maximum number of different bits between the hashes of two duplicates.
+                              It must be lower than HASH_BLOCKS.
+                timeout: number of seconds to wait for the lock of the file held by another process
+        """
+        if max_distance >= HASH_BLOCKS:
+            raise Exception('The maximum distance between duplicates must be lower than %d' % HASH_BLOCKS)
+        self.max_distance = max_distance
+        self.block_bits = HASH_BITS // HASH_BLOCKS
+        self.num_duplicates = 0
+        # the index is used by all the threads reading images
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index_file, timeout=timeout, isolation_level=None, check_same_thread=False)
+        blocks = ', '.join([ 'block%d INTEGER' % block for block in range(HASH_BLOCKS) ])
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, hash INTEGER, %s)' % blocks)
+        for block in range(HASH_BLOCKS):
+            self.connection.execute('CREATE INDEX IF NOT EXISTS hashes_block%d ON hashes (block%d)' % (block, block))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS duplicates (path TEXT PRIMARY KEY, original TEXT, distance INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS duplicates_original ON duplicates (original)')
+
+
+    def close(self):
+        """
+            Closes the connection to the index file
+        """
+        self.connection.close()
+
+
+    def get_blocks(self, img_hash):
+        """
+            Splits a hash in its blocks of bits
+            Arguments:
+                img_hash: hash, as a non-negative integer
+            Returns:
+                A list with the value of each block
+        """
+        mask = (1 << self.block_bits) - 1
+        return [ (img_hash >> (block * self.block_bits)) & mask for block in range(HASH_BLOCKS) ]
+
+
+    def add(self, img_path, img_hash):
+        """
+            Looks for a near-duplicate of an image in the index, and adds the image to it
+            Arguments:
+                img_path: path of the image, relative to the base path of the dataset
+                img_hash: perceptual hash of the image, as a non-negative integer
+            Returns:
+                The path of the image it is a duplicate of, or None if it is not a duplicate. In the
+                latter case, the image is added to the index.
+        """
+        blocks = self.get_blocks(img_hash)
+        # SQLite integers are signed
+        stored_hash = img_hash - (1 << HASH_BITS) if img_hash >= (1 << (HASH_BITS - 1)) else img_hash
+        condition = ' OR '.join([ 'block%d = ?' % block for block in range(HASH_BLOCKS) ])
+        with self.lock:
+            # lock the file from the start, so that two processes do not both take an image and
+            # its duplicate as originals
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                original = None
+                rows = self.connection.execute('SELECT path, hash FROM hashes WHERE %s' % condition, blocks).fetchall()
+                for path, candidate_hash in rows:
+                    # an image ingested again, e.g. when resuming an ingestion, is not a duplicate of itself
+                    if path == img_path:
+                        continue
+                    distance = hamming_distance(img_hash, candidate_hash % (1 << HASH_BITS))
+                    if distance <= self.max_distance and (original is None or distance < original[1]):
+                        original = (path, distance)
+                if original:
+                    self.connection.execute('INSERT OR REPLACE INTO duplicates (path, original, distance) VALUES (?, ?, ?)',
+                                            (img_path, original[0], original[1]))
+                    self.num_duplicates = self.num_duplicates + 1
+                else:
+                    self.connection.execute('INSERT OR REPLACE INTO hashes (path, hash, %s) VALUES (?, ?, %s)' %
+                                            (', '.join([ 'block%d' % block for block in range(HASH_BLOCKS) ]), ', '.join(['?'] * HASH_BLOCKS)),
+                                            [img_path, stored_hash] + blocks)
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return original[0] if original else None
+
+
+    def get_original(self, img_path):
+        """
+            Returns the path of the image a duplicate was found to be a copy of, or None if the
+            image is not a known duplicate
+            Arguments:
+                img_path: path of the image, relative to the base path of the dataset
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT original FROM duplicates WHERE path = ?', (img_path,)).fetchone()
+        return row[0] if row else None
+
+
+    def remove(self, paths):
+        """
+            Removes images from the index, e.g. when their faces are removed from the database. The
+            duplicates of the removed images are removed from the index as well, since their faces are
+            not in the database. They must be ingested again, which adds them to the index either as
+            originals or as duplicates of another image.
+            Arguments:
+                paths: iterable of image paths, relative to the base path of the dataset
+            Returns:
+                The list of paths of the duplicates of the removed images, not including the removed images
+        """
+        paths = set(paths)
+        orphans = set()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                for img_path in paths:
+                    rows = self.connection.execute('SELECT path FROM duplicates WHERE original = ?', (img_path,)).fetchall()
+                    orphans.update([ row[0] for row in rows ])
+                orphans = orphans - paths
+                self.connection.executemany('DELETE FROM hashes WHERE path = ?', [ (img_path,) for img_path in paths ])
+                self.connection.executemany('DELETE FROM duplicates WHERE path = ?', [ (img_path,) for img_path in paths | orphans ])
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return sorted(orphans)
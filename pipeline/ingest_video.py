@@ -0,0 +1,179 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import os
+import sys
+import argparse
+import platform
+import numpy
+from multiprocessing import freeze_support
+
+# add the web service folder to the sys path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(DIR_PATH, '..', 'service'))
+import settings
+import imutils
+import cpuutils
+import segmentutils
+import shotutils
+import videoutils
+import compute_pos_features_video
+
+
+def detect_shots(video_file, shot_detector, scale):
+    """
+        Decodes a video at a reduced scale, splitting it in shots and measuring how much the content
+        of the frames changes within each shot
+        Arguments:
+            video_file: Full path to the video file
+            shot_detector: ShotDetector object, with a minimum shot score relative to the original frames
+            scale: factor applied to the size of the decoded frames
+        Returns:
+            A tuple with the list of shots, as pairs (first_frame, last_frame), and an array with the
+            change of the colour histogram of each frame with respect to the previous frame, as a
+            fraction of the pixel values
+    """
+    reader = videoutils.VideoReader(video_file, scale=scale)
+    # the histograms of smaller frames have smaller differences
+    shot_detector.min_shot_score = shot_detector.min_shot_score * reader.pixels_ratio
+    pixel_values = float(reader.width * reader.height * 3)
+    shot_starts = [0]
+    changes = []
+    for frame_number, img in reader.frames():
+        new_shot, shot_score = shot_detector.add_frame(frame_number, img)
+        if new_shot:
+            shot_starts.append(frame_number)
+        changes.append(shot_score / pixel_values)
+    num_frames = len(changes)
+    if num_frames == 0:
+        return [], numpy.zeros(0)
+    shots = [ (first, last - 1) for first, last in zip(shot_starts, shot_starts[1:] + [num_frames]) ]
+    return shots, numpy.array(changes)
+
+
+def read_frames(video_file, shots, samples):
+    """
+        Generator reading a video and returning only the sampled frames of each shot
+        Arguments:
+            video_file: Full path to the video file
+            shots: list of shots, as pairs (first_frame, last_frame)
+            samples: list with the set of frame numbers sampled in each shot
+        Returns:
+            Tuples (shot_index, frame_number, img) for the frames returned. When a shot starts,
+            a tuple (shot_index, None, None) is returned first, so that shots without any of the
+            returned frames are not missed.
+    """
+    reader = videoutils.VideoReader(video_file)
+    shot_index = 0
+    yield shot_index, None, None
+    for frame_number, img in reader.frames():
+        while shot_index < len(shots) - 1 and frame_number > shots[shot_index][1]:
+            shot_index = shot_index + 1
+            yield shot_index, None, None
+        if shot_index < len(shots) and frame_number in samples[shot_index]:
+            yield shot_index, frame_number, img
+    # the decoding of the video is deterministic, but do not lose shots if it ends earlier
+    while shot_index < len(shots) - 1:
+        shot_index = shot_index + 1
+        yield shot_index, None, None
+
+
+def save_shot(writer, shot_processor, dataset_base_path, destination_frames_path):
+    """
+        Saves the face tracks of a shot, and the frames chosen to represent them
+        Arguments:
+            writer: SegmentWriter object
+            shot_processor: ShotProcessor object created with keep_frames=True, with all the frames of the shot
+            dataset_base_path: Base path of image dataset
+            destination_frames_path: sub-folder of the dataset folder where the frames are saved
+    """
+    for frame_number, chosen_det, feat, img in shot_processor.finish():
+        chosen_image_path = '%05d.jpg' % frame_number
+
+        # append to previous results
+        writer.add_face(destination_frames_path + os.path.sep + chosen_image_path, chosen_det, feat)
+
+        # save chosen frame to final destination in dataset folder
+        chose_image_path_in_datasets = os.path.join(dataset_base_path, destination_frames_path, chosen_image_path)
+        if not os.path.exists(chose_image_path_in_datasets):
+            imutils.save_image(img, chose_image_path_in_datasets)
+            # print final frame path within the dataset folder, for other process to pick up
+            print (destination_frames_path + os.path.sep + chosen_image_path)
+
+    # all the tracks of the shot are done
+    writer.item_done()
+
+
+if __name__ == '__main__':
+    if 'Windows' in platform.system():
+        freeze_support() # a requirement for windows execution
+
+    # check arguments before continuing
+    parser = argparse.ArgumentParser(description='Face-backend features extractor for videos. The video is decoded once, without temporary files, and split in shots on the fly.')
+    parser.add_argument('video_file', metavar='video_file', type=str, help='Full path to the video file')
+    parser.add_argument('dataset_base_path', metavar='dataset_base_path', type=str, help='Base path of image dataset. The frames representing the face tracks are saved to a sub-folder named after the video.')
+    parser.add_argument('-o', dest='output_file', default=settings.DATASET_FEATS_FILE, help='Output file (default: file specified in the settings). If the file exist the new features will be appended to it. An interrupted ingestion of the same video is resumed.')
+    parser.add_argument('-c', dest='cores', default=None, help='Cores to run on, e.g. 0-3,6 (default: all the available cores). Useful to run several instances of this script side by side.')
+    parser.add_argument('--sampling-rate', dest='sampling_rate', type=float, default=settings.VIDEO_SAMPLING_RATE, help='Frames per second of video in which faces are detected, where the content does not change (default: %s)' % str(settings.VIDEO_SAMPLING_RATE))
+    parser.add_argument('--max-sampling-rate', dest='max_sampling_rate', type=float, default=settings.VIDEO_MAX_SAMPLING_RATE, help='Maximum frames per second of video in which faces are detected, where the content changes (default: %s)' % str(settings.VIDEO_MAX_SAMPLING_RATE))
+    parser.add_argument('--sampling-change', dest='sampling_change', type=float, default=settings.VIDEO_SAMPLING_CHANGE, help='Change of the colour histogram, as a fraction of the pixel values, that adds one sampled frame (default: %s)' % str(settings.VIDEO_SAMPLING_CHANGE))
+    parser.add_argument('--min-frames-per-shot', dest='min_frames_per_shot', type=int, default=settings.VIDEO_MIN_FRAMES_PER_SHOT, help='Minimum number of sampled frames in each shot (default: %d)' % settings.VIDEO_MIN_FRAMES_PER_SHOT)
+    parser.add_argument('-d', dest='detection_scale', type=float, default=settings.VIDEO_SHOT_DETECTION_SCALE, help='Scale of the frames decoded for the shot boundary detection (default: %s)' % str(settings.VIDEO_SHOT_DETECTION_SCALE))
+    parser.add_argument('-m', dest='min_shot_length', default=shotutils.MIN_SHOT_LENGTH, type=int, help='Minimum shot length, in frames (default: %d)' % shotutils.MIN_SHOT_LENGTH)
+    parser.add_argument('-b', dest='hist_bins', default=shotutils.HIST_BINS, type=int, help='Number of histograms bins used for the shot detection (default: %d)' % shotutils.HIST_BINS)
+    parser.add_argument('-t', dest='hist_thresh', default=shotutils.HIST_THRESH, type=float, help='Histograms threshold used for the shot detection (default: %s)' % str(shotutils.HIST_THRESH))
+    parser.add_argument('-r', dest='min_shot_score', default=shotutils.MIN_SHOT_SCORE, type=int, help='Minimum qualifying shot score (default: %d)' % shotutils.MIN_SHOT_SCORE)
+    args = parser.parse_args()
+
+    # use one thread per core, on the specified cores
+    if args.cores:
+        cpuutils.apply_cpu_plan(cpuutils.parse_core_list(args.cores))
+    else:
+        cpuutils.apply_cpu_plan(cpuutils.get_available_cores())
+
+    if not os.path.exists(args.video_file):
+        print ('ERROR: The video %s is not found. Aborting !.' % args.video_file)
+        sys.exit(1)
+
+    # the features are appended to the output file in segments, without loading the existing ones
+    writer = segmentutils.SegmentWriter(args.output_file, os.path.abspath(args.video_file))
+
+    # import the face detector
+    import face_detection_retinaface
+    face_detector = face_detection_retinaface.FaceDetectorRetinaFace()
+
+    # import and create face feature extractor
+    import face_features
+    feature_extractor = face_features.FaceFeatureExtractor()
+
+    # create final sub-folder in the dataset folder
+    destination_frames_path = compute_pos_features_video.get_destination_folder(os.path.basename(args.video_file))
+    if not os.path.exists(os.path.join(args.dataset_base_path, destination_frames_path)):
+        os.makedirs(os.path.join(args.dataset_base_path, destination_frames_path))
+
+    # first, split the video in shots with a fast decoding of smaller frames, and choose the
+    # frames of each shot where the faces are detected, according to the changes of their content
+    shot_detector = shotutils.ShotDetector(args.hist_bins, args.hist_thresh, args.min_shot_length, args.min_shot_score)
+    shots, changes = detect_shots(args.video_file, shot_detector, args.detection_scale)
+    sampler = shotutils.AdaptiveFrameSampler(videoutils.probe_video(args.video_file)['fps'], args.sampling_rate,
+                                             args.max_sampling_rate, args.sampling_change, args.min_frames_per_shot)
+    samples = [ set(sampler.select(first, last, changes[first:last + 1])) for first, last in shots ]
+    print ('%d shots, %d sampled frames out of %d' % (len(shots), sum([ len(shot_samples) for shot_samples in samples ]), len(changes)))
+
+    # then go through the shots computing tracks and features, one frame at a time, skipping
+    # the shots processed by a previous run that was interrupted
+    current_shot = 0
+    shot_processor = compute_pos_features_video.ShotProcessor(face_detector, feature_extractor, keep_frames=True)
+    for shot_index, frame_number, img in read_frames(args.video_file, shots, samples):
+        if shot_index != current_shot:
+            if current_shot >= writer.processed:
+                save_shot(writer, shot_processor, args.dataset_base_path, destination_frames_path)
+            current_shot = shot_index
+            shot_processor = compute_pos_features_video.ShotProcessor(face_detector, feature_extractor, keep_frames=True)
+        if img is not None and shot_index >= writer.processed:
+            shot_processor.add_frame(frame_number, img)
+    if len(shots) > 0 and current_shot >= writer.processed:
+        save_shot(writer, shot_processor, args.dataset_base_path, destination_frames_path)
+
+    # after processing all shots, save the remaining results
+    writer.close()
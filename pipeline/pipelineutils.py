@@ -0,0 +1,137 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import threading
+import queue
+import time
+
+# marker put in a queue after the last item
+END_OF_QUEUE = None
+
+
+class PipelineStage(object):
+    """
+        Class implementing one stage of a processing pipeline. The stage takes the items from an input
+        queue, processes them in batches with a number of threads, and puts the results in an output
+        queue. Use bounded queues between stages, so that a slow stage makes the previous ones wait
+        instead of accumulating items in memory.
+
+        The END_OF_QUEUE marker must be put in the input queue after the last item. The stage puts it
+        in the output queue once all its threads have finished.
+    """
+
+    def __init__(self, name, function, input_queue, output_queue, num_threads=1, batch_size=1, stop_event=None):
+        """
+            Initializes the stage
+            Arguments:
+                name: name of the stage, used in the reports
+                function: function receiving a list of items from the input queue and returning a
+                          list of items for the output queue. It must be thread-safe if num_threads > 1.
+                input_queue: queue.Queue with the input items
+                output_queue: queue.Queue for the output items, or None if the stage does not produce any
+                num_threads: number of threads running the function
+                batch_size: maximum number of items passed to the function at once. The stage does not
+                            wait for a batch to be full, it takes whatever items are in the input queue.
+                stop_event: threading.Event shared by the stages of the pipeline, or None. The stage sets
+                            it when it fails, and stops processing items once it is set.
+        """
+        self.name = name
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.num_threads = num_threads
+        self.batch_size = batch_size
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running_threads = 0
+        self.num_items = 0
+        self.busy_time = 0.0
+        self.error = None
+        self.stop_event = stop_event
+
+
+    def start(self):
+        """
+            Starts the threads of the stage
+        """
+        self.running_threads = self.num_threads
+        for idx in range(self.num_threads):
+            thread = threading.Thread(target=self.run_)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def join(self):
+        """
+            Waits for all the threads of the stage to finish
+        """
+        for thread in self.threads:
+            thread.join()
+
+
+    def get_batch_(self):
+        """
+            Takes the next batch of items from the input queue
+            Returns:
+                A tuple with the list of items and a boolean indicating whether the end of the queue was found
+        """
+        items = []
+        item = self.input_queue.get()
+        while item is not END_OF_QUEUE:
+            items.append(item)
+            if len(items) == self.batch_size:
+                return items, False
+            try:
+                item = self.input_queue.get_nowait()
+            except queue.Empty:
+                return items, False
+        # let the other threads of the stage find the end of the queue as well
+        self.input_queue.put(END_OF_QUEUE)
+        return items, True
+
+
+    def run_(self):
+        """
+            Body of the threads of the stage
+        """
+        end_found = False
+        while not end_found:
+            items, end_found = self.get_batch_()
+            if len(items) == 0 or self.error or (self.stop_event and self.stop_event.is_set()):
+                # after an error, keep draining the input queue so that the previous stages do not block
+                continue
+            try:
+                t = time.time()
+                results = self.function(items)
+                elapsed = time.time() - t
+                with self.lock:
+                    self.num_items = self.num_items + len(items)
+                    self.busy_time = self.busy_time + elapsed
+                if self.output_queue:
+                    for result in results:
+                        self.output_queue.put(result)
+            except Exception as e:
+                print ('Exception in pipeline stage %s: %s' % (self.name, str(e)))
+                self.error = e
+                if self.stop_event:
+                    # let the other stages stop processing the remaining items
+                    self.stop_event.set()
+
+        with self.lock:
+            self.running_threads = self.running_threads - 1
+            last_thread = self.running_threads == 0
+        if last_thread and self.output_queue:
+            self.output_queue.put(END_OF_QUEUE)
+
+
+    def report(self, total_time):
+        """
+            Prints the statistics of the stage
+            Arguments:
+                total_time: time taken by the whole pipeline, in seconds
+        """
+        rate = self.num_items/self.busy_time if self.busy_time > 0 else 0.0
+        utilization = self.busy_time/(total_time*self.num_threads) if total_time > 0 else 0.0
+        print ('Stage %s: %d items, %d threads, busy for %f seconds (%.1f%% of the time), %f items per second per thread' %
+               (self.name, self.num_items, self.num_threads, self.busy_time, 100.0*utilization, rate))
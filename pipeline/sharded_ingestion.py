@@ -0,0 +1,293 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import os
+import sys
+import pickle
+import argparse
+import platform
+import functools
+import time
+import numpy
+import multiprocessing
+from multiprocessing import freeze_support
+
+# add the web service folder to the sys path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(DIR_PATH, '..', 'service'))
+import settings
+import cpuutils
+import segmentutils
+import workqueue
+import compute_pos_features
+
+# seconds between checks of the queue while other workers hold the remaining chunks
+QUEUE_POLL_INTERVAL = 10
+
+
+def read_images(images_list):
+    """
+        Reads the list of images of an ingestion
+        Arguments:
+            images_list: Path to file containing the list of images
+        Returns:
+            The list of image paths, skipping empty lines
+    """
+    with open(images_list) as fin:
+        return [ img_path.replace('\n', '') for img_path in fin if len(img_path.replace('\n', '')) > 0 ]
+
+
+def get_shard_file(output_file, chunk_id):
+    """
+        Returns the path to the sub-database storing the features of a chunk. The sub-databases are
+        stored next to the output file, so that they can be listed by name in the output file.
+        Arguments:
+            output_file: Full path to the main database file
+            chunk_id: id of the chunk
+        Returns:
+            The full path to the sub-database file
+    """
+    return output_file.replace('.pkl', '_shard_%06d.pkl' % chunk_id)
+
+
+class ChunkCollector(object):
+    """
+        Class collecting the faces of a chunk in memory, with the same interface as a SegmentWriter.
+        It also renews the lease of the chunk regularly, so that the chunk is not given to another
+        worker while it is being processed.
+    """
+
+    def __init__(self, queue, chunk_id, worker, lease_duration):
+        """
+            Initializes the collector
+            Arguments:
+                queue: WorkQueue object
+                chunk_id: id of the chunk
+                worker: string identifying the worker holding the lease of the chunk
+                lease_duration: number of seconds the lease is extended for at each renewal
+        """
+        self.queue = queue
+        self.chunk_id = chunk_id
+        self.worker = worker
+        self.lease_duration = lease_duration
+        self.last_renewal = time.time()
+        self.lease_lost = False
+        self.content = {'paths': [], 'rois': [], 'feats': []}
+
+
+    def add_face(self, path, roi, feat):
+        """
+            Adds a face of the chunk
+            Arguments:
+                path: path of the image of the face, relative to the base path of the dataset
+                roi: bounding-box of the face, as a list [x1,y1,x2,y2]
+                feat: feature vector of the face
+        """
+        self.content['paths'].append(path)
+        self.content['rois'].append(roi)
+        self.content['feats'].append(feat)
+
+
+    def item_done(self):
+        """
+            Records that all the faces of an image have been added. Renews the lease if needed.
+        """
+        if not self.lease_lost and time.time() - self.last_renewal > self.lease_duration/4:
+            self.lease_lost = not self.queue.renew(self.chunk_id, self.worker, self.lease_duration)
+            self.last_renewal = time.time()
+
+
+def init_queue(args):
+    """
+        Creates the work queue of a sharded ingestion
+        Arguments:
+            args: command-line arguments of the 'init' command
+    """
+    if not args.output_file.endswith('.pkl'):
+        raise Exception('The name of the output file %s must end with .pkl' % args.output_file)
+    queue = workqueue.WorkQueue(args.queue_file)
+    if queue.get_info('images_list'):
+        raise Exception('The work queue %s already exists' % args.queue_file)
+    num_images = len(read_images(args.images_list))
+    queue.set_info('images_list', os.path.abspath(args.images_list))
+    queue.set_info('output_file', os.path.abspath(args.output_file))
+    num_chunks = queue.add_chunks(num_images, args.chunk_size)
+    print ('Created work queue %s with %d chunks of up to %d images, out of %d images' % (args.queue_file, num_chunks, args.chunk_size, num_images))
+    queue.close()
+
+
+def run_worker(args, cores):
+    """
+        Processes chunks from the work queue until all the chunks have been processed
+        Arguments:
+            args: command-line arguments of the 'work' command
+            cores: list of cores for the worker
+    """
+    cpuutils.apply_cpu_plan(cores)
+    queue = workqueue.WorkQueue(args.queue_file)
+    images = read_images(queue.get_info('images_list'))
+    output_file = queue.get_info('output_file')
+    worker = workqueue.get_worker_id()
+    face_detector, feature_extractors = compute_pos_features.create_models(args.features_threads)
+
+    while True:
+        chunk = queue.lease(worker, args.lease_duration, args.max_attempts)
+        if chunk == None:
+            counts = queue.count_by_status()
+            if counts.get(workqueue.CHUNK_LEASED, 0) == 0:
+                break
+            # other workers hold the remaining chunks. Wait, in case their leases expire.
+            time.sleep(QUEUE_POLL_INTERVAL)
+            continue
+
+        chunk_id, first_item, last_item = chunk
+        print ('Worker %s processing chunk %d (images %d to %d)' % (worker, chunk_id, first_item, last_item - 1))
+        collector = ChunkCollector(queue, chunk_id, worker, args.lease_duration)
+        items = [ (index, images[index]) for index in range(first_item, last_item) ]
+        num_images, stages, total_time = compute_pos_features.run_pipeline(args, face_detector, feature_extractors,
+                                                                           functools.partial(compute_pos_features.feed_images, items),
+                                                                           first_item, functools.partial(compute_pos_features.write_faces, collector))
+        errors = [ str(stage.error) for stage in stages if stage.error ]
+        if len(errors) > 0:
+            print ('ERROR: Chunk %d failed. It will be retried.' % chunk_id)
+            queue.release(chunk_id, worker, '; '.join(errors), args.max_attempts)
+            continue
+        if collector.lease_lost:
+            print ('WARNING: The lease of chunk %d expired while it was being processed. Discarding its results.' % chunk_id)
+            continue
+
+        shard_file = get_shard_file(output_file, chunk_id)
+        content = collector.content
+        content['feats'] = numpy.array(content['feats'])
+        segmentutils.save_atomically(content, shard_file)
+        if not queue.complete(chunk_id, worker, shard_file, len(content['paths'])):
+            print ('WARNING: The lease of chunk %d expired before its results were saved' % chunk_id)
+            continue
+        compute_pos_features.print_report(num_images, len(content['paths']), stages, total_time)
+
+    queue.close()
+
+
+def start_workers(args):
+    """
+        Starts the workers of a sharded ingestion on this machine and waits for them to finish
+        Arguments:
+            args: command-line arguments of the 'work' command
+    """
+    cores = cpuutils.parse_core_list(args.cores) if args.cores else cpuutils.get_available_cores()
+    if args.workers == 1:
+        run_worker(args, cores)
+        return
+    # give each worker a separate set of cores
+    cpu_plan = cpuutils.plan_cpu_usage(args.workers, 0, cores)
+    processes = []
+    for worker_cores in cpu_plan['workers']:
+        process = multiprocessing.Process(target=run_worker, args=(args, worker_cores))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+
+def merge_shards(args):
+    """
+        Adds the sub-databases of the processed chunks to the output database, which becomes a
+        list-based database if it was not already one
+        Arguments:
+            args: command-line arguments of the 'merge' command
+    """
+    queue = workqueue.WorkQueue(args.queue_file)
+    output_file = queue.get_info('output_file')
+    counts = queue.count_by_status()
+    unfinished = sum([ counts.get(status, 0) for status in [workqueue.CHUNK_PENDING, workqueue.CHUNK_LEASED, workqueue.CHUNK_FAILED] ])
+    if unfinished > 0 and not args.partial:
+        raise Exception('%d chunks have not been processed yet. Use --partial to merge the processed chunks anyway.' % unfinished)
+
+    chunks = queue.get_chunks(workqueue.CHUNK_DONE)
+    if len(chunks) == 0:
+        print ('There are no processed chunks to merge')
+        return
+
+    # other processes might be adding entries to the output database at the same time
+    with segmentutils.database_lock(output_file):
+        entries = segmentutils.convert_to_list_database(output_file)
+        new_entries = []
+        new_num_rows = []
+        for chunk in chunks:
+            # the sub-databases are next to the output file, so list them by name
+            entry = os.path.basename(chunk['output'])
+            if chunk['num_rows'] == 0 or entry in entries:
+                # skip empty chunks and chunks added by a previous merge that was interrupted
+                continue
+            new_entries.append(entry)
+            new_num_rows.append(chunk['num_rows'])
+
+        feats_size = None
+        feats_dtype = None
+        if len(entries) == 0 and len(new_entries) > 0:
+            with open(segmentutils.get_entry_path(output_file, new_entries[0]), 'rb') as fin:
+                feats = pickle.load(fin)['feats']
+            feats_size = feats.shape[-1]
+            feats_dtype = feats.dtype.name
+        segmentutils.append_entries(output_file, entries, new_entries, new_num_rows, feats_size, feats_dtype)
+    queue.set_status([ chunk['id'] for chunk in chunks ], workqueue.CHUNK_MERGED)
+    print ('Merged %d sub-databases with %d faces into %s' % (len(new_entries), sum(new_num_rows), output_file))
+    queue.close()
+
+
+def print_status(args):
+    """
+        Prints the status of the chunks in the work queue
+        Arguments:
+            args: command-line arguments of the 'status' command
+    """
+    queue = workqueue.WorkQueue(args.queue_file)
+    if args.retry_failed:
+        print ('Made %d failed chunks available again' % queue.retry_failed())
+    counts = queue.count_by_status()
+    for status in [workqueue.CHUNK_PENDING, workqueue.CHUNK_LEASED, workqueue.CHUNK_DONE, workqueue.CHUNK_FAILED, workqueue.CHUNK_MERGED]:
+        print ('%s: %d chunks' % (status, counts.get(status, 0)))
+    for chunk in queue.get_chunks(workqueue.CHUNK_FAILED):
+        print ('Chunk %d (images %d to %d) failed after %d attempts: %s' % (chunk['id'], chunk['first_item'], chunk['last_item'] - 1, chunk['attempts'], chunk['error']))
+    queue.close()
+
+
+if __name__ == '__main__':
+    if 'Windows' in platform.system():
+        freeze_support() # a requirement for windows execution
+
+    parser = argparse.ArgumentParser(description='Sharded face-backend features extractor. Several workers, on one or several machines, process chunks of a list of images and the results are merged at the end.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    init_parser = subparsers.add_parser('init', help='Create the work queue')
+    init_parser.add_argument('queue_file', metavar='queue_file', type=str, help='Path to the work queue file to be created')
+    init_parser.add_argument('images_list', metavar='images_list', type=str, help='Path to file containing the list of images to extract the features from. Image paths in the list should be paths relative to the dataset_base_path of the workers')
+    init_parser.add_argument('-o', dest='output_file', default=settings.DATASET_FEATS_FILE, help='Output file (default: file specified in the settings). The sub-databases of the chunks are saved next to it.')
+    init_parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=settings.INGESTION_CHUNK_SIZE, help='Number of images per chunk (default: %d)' % settings.INGESTION_CHUNK_SIZE)
+
+    work_parser = subparsers.add_parser('work', help='Process chunks from the work queue until all of them have been processed')
+    work_parser.add_argument('queue_file', metavar='queue_file', type=str, help='Path to the work queue file')
+    work_parser.add_argument('dataset_base_path', metavar='dataset_base_path', type=str, help='Base path of image dataset')
+    work_parser.add_argument('-w', dest='workers', type=int, default=1, help='Number of worker processes on this machine, each one running on a separate set of cores (default: 1)')
+    work_parser.add_argument('--lease-duration', dest='lease_duration', type=int, default=settings.INGESTION_LEASE_DURATION, help='Seconds a chunk is leased for (default: %d)' % settings.INGESTION_LEASE_DURATION)
+    work_parser.add_argument('--max-attempts', dest='max_attempts', type=int, default=settings.INGESTION_MAX_ATTEMPTS, help='Maximum number of times a chunk is leased (default: %d)' % settings.INGESTION_MAX_ATTEMPTS)
+    compute_pos_features.add_pipeline_arguments(work_parser)
+
+    merge_parser = subparsers.add_parser('merge', help='Add the sub-databases of the processed chunks to the output file')
+    merge_parser.add_argument('queue_file', metavar='queue_file', type=str, help='Path to the work queue file')
+    merge_parser.add_argument('--partial', dest='partial', action='store_true', default=False, help='Merge the processed chunks even if some chunks have not been processed')
+
+    status_parser = subparsers.add_parser('status', help='Print the status of the chunks')
+    status_parser.add_argument('queue_file', metavar='queue_file', type=str, help='Path to the work queue file')
+    status_parser.add_argument('--retry-failed', dest='retry_failed', action='store_true', default=False, help='Make the failed chunks available again')
+
+    args = parser.parse_args()
+    if args.command == 'init':
+        init_queue(args)
+    elif args.command == 'work':
+        start_workers(args)
+    elif args.command == 'merge':
+        merge_shards(args)
+    elif args.command == 'status':
+        print_status(args)
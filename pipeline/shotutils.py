@@ -0,0 +1,156 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import numpy
+
+# default parameters of the shot boundary detection, the same used by detect_shots
+MIN_SHOT_LENGTH = 1
+MIN_SHOT_SCORE = 100000
+HIST_BINS = 32
+HIST_THRESH = 0.2
+
+
+def hist_col(im_data, bins):
+    """
+    Computes a histogram per image channel (assuming RGB pixels in the image data). The result is
+    the same as calling numpy.histogram(channel, bins=bins, range=(0.0,255.0)) for each channel,
+    but all channels are counted at once.
+    Arguments:
+       im_data: 3D image data, the last dimension should hold the pixel values in a linear array of length 3.
+       bins: Number of bins in the histogram
+    Returns:
+       a 1D array containing the histogram counts for each bin, for each pixel channel
+    """
+    # the value 255 belongs to the last bin, as with numpy.histogram
+    bin_indexes = numpy.minimum((im_data[:, :, :3].astype(numpy.int32) * bins) // 255, bins - 1)
+    bin_indexes = bin_indexes + numpy.arange(3, dtype=numpy.int32) * bins
+    return numpy.bincount(bin_indexes.ravel(), minlength=3*bins).astype(numpy.int64)
+
+
+def read_shots(shot_boundaries):
+    """
+        Reads a shot boundaries file, as produced by detect_shots
+        Arguments:
+            shot_boundaries: Path to the shot boundaries file
+        Returns:
+            A list of pairs of strings [first_frame, last_frame], one per shot
+    """
+    shots_list = []
+    with open(shot_boundaries) as fshots:
+        for line in fshots:
+            if len(line) > 0:
+                line = line.replace('\n', '')
+                ashot = line.split(' ')
+                shots_list.append(ashot)
+    return shots_list
+
+
+class ShotDetector(object):
+    """
+        Class detecting shot boundaries in a stream of frames, with the same method as detect_shots:
+        a new shot starts when the l1-distance between the colour histograms of two consecutive
+        frames is larger than a fraction of the number of pixel values in a frame.
+    """
+
+    def __init__(self, hist_bins=HIST_BINS, hist_thresh=HIST_THRESH, min_shot_length=MIN_SHOT_LENGTH, min_shot_score=MIN_SHOT_SCORE):
+        """
+            Initializes the detector
+            Arguments:
+                hist_bins: number of histograms bins
+                hist_thresh: histograms threshold, as a fraction of the number of pixel values in a frame
+                min_shot_length: minimum shot length, in frames
+                min_shot_score: minimum l1-distance between histograms for a shot boundary
+        """
+        self.hist_bins = hist_bins
+        self.hist_thresh = hist_thresh
+        self.min_shot_length = min_shot_length
+        self.min_shot_score = min_shot_score
+        self.hist_prev = None
+        self.hist_thresh_adjusted = -1
+        self.shot_start = None
+
+
+    def add_frame(self, frame_number, img):
+        """
+            Processes the next frame of the stream
+            Arguments:
+                frame_number: number of the frame
+                img: MxNx3 array with the contents of the frame in RGB format
+            Returns:
+                A tuple with a boolean indicating whether a new shot starts at this frame, and the
+                l1-distance between the histograms of this frame and the previous one (zero for the
+                first frame)
+        """
+        hist_cur = hist_col(img, bins=self.hist_bins)
+        if self.hist_prev is None:
+            # use first frame info to init some vars
+            self.hist_thresh_adjusted = self.hist_thresh * img.shape[1] * img.shape[0] * 3
+            self.shot_start = frame_number
+            self.hist_prev = hist_cur
+            return False, 0
+
+        # compute shot score (l1-distance between histograms of previous and current images)
+        shot_score = int(numpy.abs(hist_cur - self.hist_prev).sum())
+        self.hist_prev = hist_cur
+        newshot = (shot_score > self.hist_thresh_adjusted and shot_score >= self.min_shot_score and
+                   frame_number - self.shot_start >= self.min_shot_length)
+        if newshot:
+            self.shot_start = frame_number
+        return newshot, shot_score
+
+
+class AdaptiveFrameSampler(object):
+    """
+        Class choosing the frames of a shot where faces are detected. Frames are sampled at a base rate
+        in static parts of the shot, and more densely where the content of the frames changes, up to a
+        maximum rate. To do so, the time elapsed and the accumulated change of the colour histograms
+        both advance a counter, and a frame is sampled every time the counter goes through a unit,
+        starting from half a unit. Every shot gets a minimum number of frames, however short it is.
+    """
+
+    def __init__(self, fps, base_rate, max_rate, change_per_sample, min_frames_per_shot):
+        """
+            Initializes the sampler
+            Arguments:
+                fps: number of frames per second of the video
+                base_rate: number of frames sampled per second when the content of the frames does not change
+                max_rate: maximum number of frames sampled per second
+                change_per_sample: accumulated change of the colour histograms, as a fraction of the
+                                   pixel values, that is worth one additional sample
+                min_frames_per_shot: minimum number of frames sampled in each shot
+        """
+        self.frames_per_sample = fps / float(base_rate)
+        self.min_spacing = max(1, int(round(fps / float(max_rate))))
+        self.change_per_sample = change_per_sample
+        self.min_frames_per_shot = min_frames_per_shot
+
+
+    def select(self, first_frame, last_frame, changes):
+        """
+            Chooses the frames of a shot to be sampled
+            Arguments:
+                first_frame: number of the first frame of the shot
+                last_frame: number of the last frame of the shot
+                changes: array with the change of the colour histogram of each frame of the shot with
+                         respect to the previous frame, as a fraction of the pixel values
+            Returns:
+                A sorted list of frame numbers
+        """
+        num_frames = last_frame - first_frame + 1
+        changes = numpy.asarray(changes, dtype=numpy.float64).copy()
+        if len(changes) > 0:
+            # the change at the start of the shot is the shot boundary itself
+            changes[0] = 0
+        counter = numpy.arange(num_frames) / self.frames_per_sample + numpy.cumsum(changes) / self.change_per_sample + 0.5
+        # a frame is sampled when the counter goes through a unit
+        crossings = numpy.flatnonzero(numpy.floor(counter[1:]) > numpy.floor(counter[:-1])) + 1
+        selected = []
+        for index in crossings:
+            if len(selected) == 0 or index - selected[-1] >= self.min_spacing:
+                selected.append(int(index))
+
+        min_frames = min(self.min_frames_per_shot, num_frames)
+        if len(selected) < min_frames:
+            # spread the minimum number of frames evenly over the shot
+            selected = sorted(set([ int((idx + 0.5) * num_frames / min_frames) for idx in range(min_frames) ]))
+        return [ first_frame + index for index in selected ]
@@ -0,0 +1,271 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.optimize import linear_sum_assignment
+
+# methods used to match the active tracks with the faces of a new frame
+MATCHING_FIRST = 'first'     # each track, in the order the tracks were started, takes the first unassigned face
+MATCHING_GREEDY = 'greedy'   # the pairs (track, face) are assigned by decreasing IoU
+MATCHING_OPTIMAL = 'optimal' # the assignment maximizing the sum of the IoUs is used
+MATCHING_METHODS = [MATCHING_FIRST, MATCHING_GREEDY, MATCHING_OPTIMAL]
+
+# maximum size, in pixels, of the templates used to follow a face between frames
+TEMPLATE_MAX_SIZE = 32
+# size of the region searched for a face in the next frame, relative to the size of the face
+TEMPLATE_SEARCH_FACTOR = 0.5
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+        Computes the Intersection over Union (IoU) of all the pairs of bounding-boxes of two sets
+        Arguments:
+            boxes_a: Nx4 array of bounding-boxes in the form [x1,y1,x2,y2], where (x1,y1) is the top left
+                     corner and (x2,y2) is the bottom right corner. Extra columns are ignored.
+            boxes_b: Mx4 array of bounding-boxes, in the same form
+        Returns:
+            A NxM array with the IoU of each pair of bounding-boxes, in [0, 1]
+    """
+    boxes_a = numpy.asarray(boxes_a, dtype=numpy.float64)[:, :4]
+    boxes_b = numpy.asarray(boxes_b, dtype=numpy.float64)[:, :4]
+    x_left = numpy.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y_top = numpy.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x_right = numpy.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y_bottom = numpy.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection_area = numpy.clip(x_right - x_left, 0, None) * numpy.clip(y_bottom - y_top, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union_area = area_a[:, None] + area_b[None, :] - intersection_area
+    return intersection_area / numpy.maximum(union_area, 1e-12)
+
+
+def match_boxes(ious, min_iou, matching):
+    """
+        Matches the rows of an IoU matrix with its columns
+        Arguments:
+            ious: NxM array with the IoU of each pair (row, column)
+            min_iou: pairs with an IoU lower or equal than this value are never matched
+            matching: one of the MATCHING_METHODS
+        Returns:
+            A list of pairs (row, column)
+    """
+    if ious.shape[0] == 0 or ious.shape[1] == 0:
+        return []
+    valid = ious > min_iou
+    pairs = []
+    if matching == MATCHING_FIRST:
+        assigned = numpy.zeros(ious.shape[1], dtype=bool)
+        for row in range(ious.shape[0]):
+            candidates = numpy.flatnonzero(valid[row] & ~assigned)
+            if len(candidates) > 0:
+                assigned[candidates[0]] = True
+                pairs.append((row, int(candidates[0])))
+    elif matching == MATCHING_GREEDY:
+        rows, columns = numpy.nonzero(valid)
+        order = numpy.argsort(-ious[rows, columns], kind='stable')
+        used_rows = set()
+        used_columns = set()
+        for row, column in zip(rows[order], columns[order]):
+            if row not in used_rows and column not in used_columns:
+                used_rows.add(row)
+                used_columns.add(column)
+                pairs.append((int(row), int(column)))
+    elif matching == MATCHING_OPTIMAL:
+        # invalid pairs get a null IoU, and are discarded after the assignment
+        rows, columns = linear_sum_assignment(-numpy.where(valid, ious, 0.0))
+        pairs = [ (int(row), int(column)) for row, column in zip(rows, columns) if valid[row, column] ]
+    else:
+        raise Exception('Unknown matching method %s' % matching)
+    return pairs
+
+
+def to_gray(img):
+    """
+        Converts an image to grayscale, for template matching
+        Arguments:
+            img: MxNx3 array with an image in RGB format
+        Returns:
+            A MxN array of float32 values
+    """
+    return img.astype(numpy.float32).mean(axis=2)
+
+
+def extract_template(gray, box):
+    """
+        Extracts the template of a face, subsampled so that it is not larger than TEMPLATE_MAX_SIZE
+        Arguments:
+            gray: grayscale frame, as returned by to_gray()
+            box: bounding-box of the face, in the form [x1,y1,x2,y2]
+        Returns:
+            A tuple with the template, the subsampling step and the size (width, height) of the face
+    """
+    x1, y1, x2, y2 = [ int(value) for value in box[:4] ]
+    step = max(1, int(numpy.ceil(max(x2 - x1, y2 - y1) / float(TEMPLATE_MAX_SIZE))))
+    return gray[y1:y2:step, x1:x2:step], step, (x2 - x1, y2 - y1)
+
+
+def match_template(gray, template, box):
+    """
+        Finds a face in a new frame by looking for the position of its template with the highest
+        normalized cross-correlation (NCC), in a region around its previous position
+        Arguments:
+            gray: grayscale frame, as returned by to_gray()
+            template: tuple returned by extract_template()
+            box: previous bounding-box of the face, in the form [x1,y1,x2,y2]
+        Returns:
+            A tuple with the new bounding-box of the face, as a list [x1,y1,x2,y2], and the NCC at
+            that position, in [-1, 1]. The NCC is -1 if the face cannot be searched for.
+    """
+    template, step, (width, height) = template
+    if template.shape[0] < 2 or template.shape[1] < 2:
+        return list(box[:4]), -1.0
+    radius = int(TEMPLATE_SEARCH_FACTOR * max(width, height))
+    region_x = max(0, int(box[0]) - radius)
+    region_y = max(0, int(box[1]) - radius)
+    region = gray[region_y:min(gray.shape[0], int(box[1]) + height + radius):step,
+                  region_x:min(gray.shape[1], int(box[0]) + width + radius):step]
+    if region.shape[0] < template.shape[0] or region.shape[1] < template.shape[1]:
+        return list(box[:4]), -1.0
+
+    windows = sliding_window_view(region, template.shape)
+    template = template - template.mean()
+    windows = windows - windows.mean(axis=(2, 3), keepdims=True)
+    numerator = (windows * template).sum(axis=(2, 3))
+    denominator = numpy.sqrt((windows ** 2).sum(axis=(2, 3)) * (template ** 2).sum())
+    ncc = numerator / numpy.maximum(denominator, 1e-6)
+    row, column = numpy.unravel_index(numpy.argmax(ncc), ncc.shape)
+    x1 = region_x + column * step
+    y1 = region_y + row * step
+    return [x1, y1, min(gray.shape[1], x1 + width), min(gray.shape[0], y1 + height)], float(ncc[row, column])
+
+
+class FaceTracker(object):
+    """
+        Class grouping the face detections of consecutive frames in tracks. The faces of a new frame are
+        matched with the last face of the active tracks according to their IoU. A track ends when it is
+        not matched in more than max_gap consecutive frames. With the MATCHING_FIRST method and no gaps,
+        the tracks are the same ones found by the original tracking of compute_pos_features_video.py.
+    """
+
+    def __init__(self, min_iou=0.5, matching=MATCHING_FIRST, max_gap=0):
+        """
+            Initializes the tracker
+            Arguments:
+                min_iou: a face is only added to a track if its IoU with the last face of the track is larger than this value
+                matching: one of the MATCHING_METHODS
+                max_gap: maximum number of consecutive frames in which a track can be missing before it ends
+        """
+        if matching not in MATCHING_METHODS:
+            raise Exception('Unknown matching method %s' % matching)
+        self.min_iou = min_iou
+        self.matching = matching
+        self.max_gap = max_gap
+        self.track_numbers = []
+        self.track_boxes = numpy.zeros((0, 4))
+        self.track_gaps = []
+        self.track_counter = 0
+
+
+    def update(self, boxes):
+        """
+            Adds the faces of the next frame to the tracks
+            Arguments:
+                boxes: list or Nx4 array with the bounding-boxes of the faces in the frame, in the form
+                       [x1,y1,x2,y2]. Extra columns (e.g. the detection score) are ignored.
+            Returns:
+                A tuple with the list of track numbers of each face, and the list of numbers of the
+                tracks that ended in this frame
+        """
+        if len(boxes) > 0:
+            boxes = numpy.array([ box[:4] for box in boxes ], dtype=numpy.float64)
+        else:
+            boxes = numpy.zeros((0, 4))
+        pairs = match_boxes(iou_matrix(self.track_boxes, boxes), self.min_iou, self.matching)
+
+        face_tracks = [ None ] * len(boxes)
+        columns = {}
+        for row, column in pairs:
+            face_tracks[column] = self.track_numbers[row]
+            columns[row] = column
+
+        # keep the tracks matched or within the maximum gap, in the order they were started
+        ended_tracks = []
+        track_numbers = []
+        track_boxes = []
+        track_gaps = []
+        for row, number in enumerate(self.track_numbers):
+            if row in columns:
+                track_numbers.append(number)
+                track_boxes.append(boxes[columns[row]])
+                track_gaps.append(0)
+            elif self.track_gaps[row] < self.max_gap:
+                track_numbers.append(number)
+                track_boxes.append(self.track_boxes[row])
+                track_gaps.append(self.track_gaps[row] + 1)
+            else:
+                ended_tracks.append(number)
+
+        # the faces not matched with any track start new tracks
+        for column in range(len(boxes)):
+            if face_tracks[column] is None:
+                face_tracks[column] = self.track_counter
+                track_numbers.append(self.track_counter)
+                track_boxes.append(boxes[column])
+                track_gaps.append(0)
+                self.track_counter = self.track_counter + 1
+
+        self.track_numbers = track_numbers
+        self.track_boxes = numpy.array(track_boxes).reshape((-1, 4))
+        self.track_gaps = track_gaps
+        return face_tracks, ended_tracks
+
+
+    def propagate(self, track_boxes):
+        """
+            Moves the active tracks to the positions found for them without a face detector, e.g.
+            by template matching. The tracks not moved are considered missing in the frame.
+            Arguments:
+                track_boxes: dictionary with the new bounding-box of each track number
+            Returns:
+                The list of numbers of the tracks that ended in this frame
+        """
+        ended_tracks = []
+        track_numbers = []
+        track_boxes_list = []
+        track_gaps = []
+        for row, number in enumerate(self.track_numbers):
+            if number in track_boxes:
+                track_numbers.append(number)
+                track_boxes_list.append(numpy.asarray(track_boxes[number][:4], dtype=numpy.float64))
+                track_gaps.append(0)
+            elif self.track_gaps[row] < self.max_gap:
+                track_numbers.append(number)
+                track_boxes_list.append(self.track_boxes[row])
+                track_gaps.append(self.track_gaps[row] + 1)
+            else:
+                ended_tracks.append(number)
+        self.track_numbers = track_numbers
+        self.track_boxes = numpy.array(track_boxes_list).reshape((-1, 4))
+        self.track_gaps = track_gaps
+        return ended_tracks
+
+
+    def get_boxes(self):
+        """
+            Returns a dictionary with the last bounding-box of each active track number
+        """
+        return { number: self.track_boxes[row] for row, number in enumerate(self.track_numbers) }
+
+
+    def finish(self):
+        """
+            Ends all the active tracks
+            Returns:
+                The list of numbers of the tracks that were active
+        """
+        ended_tracks = self.track_numbers
+        self.track_numbers = []
+        self.track_boxes = numpy.zeros((0, 4))
+        self.track_gaps = []
+        return ended_tracks
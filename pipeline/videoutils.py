@@ -0,0 +1,110 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import json
+import subprocess
+import tempfile
+import numpy
+
+# executables used to read the videos. They must be in the PATH.
+FFMPEG_BINARY = 'ffmpeg'
+FFPROBE_BINARY = 'ffprobe'
+
+
+def parse_ratio(ratio, default):
+    """
+        Parses a ratio in the format used by ffprobe, e.g. '30000/1001' or '4:3'
+        Arguments:
+            ratio: string with the ratio
+            default: value returned if the ratio is missing or invalid
+        Returns:
+            The ratio as a float number
+    """
+    try:
+        numerator, denominator = ratio.replace(':', '/').split('/')
+        if float(numerator) > 0 and float(denominator) > 0:
+            return float(numerator) / float(denominator)
+    except Exception:
+        pass
+    return default
+
+
+def probe_video(video_file):
+    """
+        Reads the properties of the first video stream of a video file
+        Arguments:
+            video_file: Full path to the video file
+        Returns:
+            A dictionary with the fields 'width' and 'height', with the size of the frames after
+            correcting the sample aspect ratio, and 'fps', with the number of frames per second
+    """
+    command = [FFPROBE_BINARY, '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'stream=width,height,sample_aspect_ratio,avg_frame_rate,r_frame_rate',
+               '-of', 'json', video_file]
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if output.returncode != 0:
+        raise Exception('Could not read the video %s: %s' % (video_file, output.stderr.decode('utf-8', 'replace')))
+    streams = json.loads(output.stdout.decode('utf-8'))['streams']
+    if len(streams) == 0:
+        raise Exception('There is no video stream in %s' % video_file)
+    stream = streams[0]
+    # same correction as the filter 'scale=iw:ih*(1/sar)' used when extracting frames with ffmpeg
+    sample_aspect_ratio = parse_ratio(stream.get('sample_aspect_ratio', ''), 1.0)
+    fps = parse_ratio(stream.get('avg_frame_rate', ''), 0.0)
+    if fps == 0.0:
+        fps = parse_ratio(stream.get('r_frame_rate', ''), 25.0)
+    return {'width': int(stream['width']), 'height': int(round(int(stream['height']) / sample_aspect_ratio)), 'fps': fps}
+
+
+class VideoReader(object):
+    """
+        Class decoding the frames of a video with a single ffmpeg process, which sends the raw
+        RGB pixels through a pipe. No temporary files are written.
+    """
+
+    def __init__(self, video_file, scale=1.0):
+        """
+            Initializes the reader
+            Arguments:
+                video_file: Full path to the video file
+                scale: factor applied to the size of the frames, e.g. 0.25 to decode frames four
+                       times smaller in each dimension
+        """
+        self.video_file = video_file
+        properties = probe_video(video_file)
+        self.fps = properties['fps']
+        self.width = max(1, int(round(properties['width'] * scale)))
+        self.height = max(1, int(round(properties['height'] * scale)))
+        # ratio between the number of pixels of the decoded frames and the original ones
+        self.pixels_ratio = (self.width * self.height) / float(properties['width'] * properties['height'])
+
+
+    def frames(self):
+        """
+            Generator returning the frames of the video, in order
+            Returns:
+                Tuples (frame_number, img), where the frame numbers start at 0 and img is an
+                MxNx3 array with the contents of the frame in RGB format
+        """
+        command = [FFMPEG_BINARY, '-loglevel', 'error', '-i', self.video_file, '-vsync', 'vfr',
+                   '-vf', 'scale=%d:%d' % (self.width, self.height), '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+        frame_size = self.width * self.height * 3
+        # the errors go to a file rather than to a pipe, since a full pipe that is not being read
+        # would block ffmpeg, and with it the reading of the frames
+        with tempfile.TemporaryFile() as ferr:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=ferr, bufsize=frame_size)
+            try:
+                frame_number = 0
+                while True:
+                    data = process.stdout.read(frame_size)
+                    if len(data) < frame_size:
+                        break
+                    yield frame_number, numpy.frombuffer(data, dtype=numpy.uint8).reshape((self.height, self.width, 3))
+                    frame_number = frame_number + 1
+            finally:
+                process.stdout.close()
+                return_code = process.wait()
+            ferr.seek(0)
+            error = ferr.read()
+        if return_code != 0:
+            raise Exception('Could not decode the video %s: %s' % (self.video_file, error.decode('utf-8', 'replace')))
@@ -0,0 +1,224 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import os
+import contextlib
+import sqlite3
+import socket
+import time
+
+# status of the chunks of work
+CHUNK_PENDING = 'pending'
+CHUNK_LEASED = 'leased'
+CHUNK_DONE = 'done'
+CHUNK_FAILED = 'failed'
+CHUNK_MERGED = 'merged'
+
+
+def get_worker_id():
+    """
+        Returns a string identifying the current process, unique across the machines sharing a work queue
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """
+        Class implementing a queue of chunks of work stored in a SQLite database, so that it can be
+        shared by several processes without a server. A worker leases a chunk for a limited time and
+        must complete it, or renew the lease, before the lease expires. Chunks whose lease expired
+        (e.g. because the worker crashed) or that were released after an error are leased again,
+        up to a maximum number of attempts.
+
+        SQLite relies on file locks, which are not reliable on some network filesystems (e.g. old
+        NFS versions). In that case, keep the queue file on a local disk of the machine running
+        the workers.
+    """
+
+    def __init__(self, queue_file, timeout=60.0):
+        """
+            Opens the work queue, creating the file if it does not exist
+            Arguments:
+                queue_file: Full path to the SQLite file of the queue
+                timeout: number of seconds to wait for the lock of the file held by another process
+        """
+        self.queue_file = queue_file
+        self.connection = sqlite3.connect(queue_file, timeout=timeout, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS chunks ('
+                                'id INTEGER PRIMARY KEY, first_item INTEGER, last_item INTEGER, '
+                                'status TEXT, worker TEXT, lease_expiration REAL, attempts INTEGER DEFAULT 0, '
+                                'output TEXT, num_rows INTEGER, error TEXT)')
+
+
+    def close(self):
+        """
+            Closes the connection to the queue file
+        """
+        self.connection.close()
+
+
+    def set_info(self, key, value):
+        """
+            Stores a value shared by all the users of the queue
+            Arguments:
+                key: name of the value
+                value: string to be stored
+        """
+        self.connection.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', (key, value))
+
+
+    def get_info(self, key):
+        """
+            Returns a value stored with set_info, or None if there is no such value
+            Arguments:
+                key: name of the value
+        """
+        row = self.connection.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+
+    def add_chunks(self, num_items, chunk_size):
+        """
+            Splits a number of items of work in chunks and adds them to the queue
+            Arguments:
+                num_items: total number of items
+                chunk_size: maximum number of items per chunk
+            Returns:
+                The number of chunks added
+        """
+        chunks = [ (first, min(first + chunk_size, num_items), CHUNK_PENDING) for first in range(0, num_items, chunk_size) ]
+        with self.transaction_():
+            self.connection.executemany('INSERT INTO chunks (first_item, last_item, status) VALUES (?, ?, ?)', chunks)
+        return len(chunks)
+
+
+    @contextlib.contextmanager
+    def transaction_(self):
+        """
+            Runs a transaction that locks the queue for writing from the start,
+            so that two workers never lease the same chunk
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+
+    def lease(self, worker, lease_duration, max_attempts):
+        """
+            Leases the next available chunk, i.e. a pending chunk or a chunk whose lease expired
+            Arguments:
+                worker: string identifying the worker
+                lease_duration: number of seconds the chunk is leased for
+                max_attempts: maximum number of times a chunk can be leased. Expired chunks that
+                              reached this number are marked as failed.
+            Returns:
+                A tuple (chunk_id, first_item, last_item), or None if there are no chunks available
+        """
+        now = time.time()
+        with self.transaction_():
+            self.connection.execute('UPDATE chunks SET status = ?, error = ? WHERE status = ? AND lease_expiration < ? AND attempts >= ?',
+                                    (CHUNK_FAILED, 'lease expired', CHUNK_LEASED, now, max_attempts))
+            row = self.connection.execute('SELECT id, first_item, last_item FROM chunks WHERE status = ? OR (status = ? AND lease_expiration < ?) ORDER BY id LIMIT 1',
+                                          (CHUNK_PENDING, CHUNK_LEASED, now)).fetchone()
+            if row == None:
+                return None
+            self.connection.execute('UPDATE chunks SET status = ?, worker = ?, lease_expiration = ?, attempts = attempts + 1 WHERE id = ?',
+                                    (CHUNK_LEASED, worker, now + lease_duration, row[0]))
+        return row
+
+
+    def renew(self, chunk_id, worker, lease_duration):
+        """
+            Extends the lease of a chunk
+            Arguments:
+                chunk_id: id of the chunk
+                worker: string identifying the worker holding the lease
+                lease_duration: number of seconds the lease is extended for, counted from now
+            Returns:
+                True if the lease was extended, False if the worker no longer holds the lease
+        """
+        cursor = self.connection.execute('UPDATE chunks SET lease_expiration = ? WHERE id = ? AND worker = ? AND status = ?',
+                                         (time.time() + lease_duration, chunk_id, worker, CHUNK_LEASED))
+        return cursor.rowcount > 0
+
+
+    def complete(self, chunk_id, worker, output, num_rows):
+        """
+            Marks a leased chunk as done
+            Arguments:
+                chunk_id: id of the chunk
+                worker: string identifying the worker holding the lease
+                output: path to the result of the chunk
+                num_rows: number of rows in the result
+            Returns:
+                True if the chunk was marked as done, False if the worker no longer holds the lease
+        """
+        cursor = self.connection.execute('UPDATE chunks SET status = ?, output = ?, num_rows = ?, error = NULL WHERE id = ? AND worker = ? AND status = ?',
+                                         (CHUNK_DONE, output, num_rows, chunk_id, worker, CHUNK_LEASED))
+        return cursor.rowcount > 0
+
+
+    def release(self, chunk_id, worker, error, max_attempts):
+        """
+            Gives up a leased chunk after an error, so that it can be leased again
+            Arguments:
+                chunk_id: id of the chunk
+                worker: string identifying the worker holding the lease
+                error: description of the error
+                max_attempts: maximum number of times a chunk can be leased. If the chunk reached
+                              this number, it is marked as failed instead.
+        """
+        self.connection.execute('UPDATE chunks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ? WHERE id = ? AND worker = ? AND status = ?',
+                                (max_attempts, CHUNK_FAILED, CHUNK_PENDING, error, chunk_id, worker, CHUNK_LEASED))
+
+
+    def retry_failed(self):
+        """
+            Makes the failed chunks available again, resetting their number of attempts
+            Returns:
+                The number of chunks made available
+        """
+        cursor = self.connection.execute('UPDATE chunks SET status = ?, attempts = 0 WHERE status = ?', (CHUNK_PENDING, CHUNK_FAILED))
+        return cursor.rowcount
+
+
+    def get_chunks(self, status=None):
+        """
+            Returns the chunks in the queue, sorted by id
+            Arguments:
+                status: if specified, only the chunks with this status are returned
+            Returns:
+                A list of dictionaries with the fields of the chunks
+        """
+        query = 'SELECT id, first_item, last_item, status, worker, attempts, output, num_rows, error FROM chunks'
+        params = ()
+        if status:
+            query = query + ' WHERE status = ?'
+            params = (status,)
+        rows = self.connection.execute(query + ' ORDER BY id', params).fetchall()
+        fields = ['id', 'first_item', 'last_item', 'status', 'worker', 'attempts', 'output', 'num_rows', 'error']
+        return [ dict(zip(fields, row)) for row in rows ]
+
+
+    def set_status(self, chunk_ids, status):
+        """
+            Changes the status of a list of chunks
+            Arguments:
+                chunk_ids: list of ids of the chunks
+                status: new status
+        """
+        with self.transaction_():
+            self.connection.executemany('UPDATE chunks SET status = ? WHERE id = ?', [ (status, chunk_id) for chunk_id in chunk_ids ])
+
+
+    def count_by_status(self):
+        """
+            Returns a dictionary with the number of chunks with each status
+        """
+        rows = self.connection.execute('SELECT status, COUNT(*) FROM chunks GROUP BY status').fetchall()
+        return dict(rows)
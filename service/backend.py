@@ -37,7 +37,11 @@ class ThreadedServer(object):
             Method that runs indefinitely waiting for connections
         """
         self.sock.listen(5)
-        backend_instance = face_retrieval.FaceRetrieval()
+        # accept connections right away, so that selfTest can report the progress of the initialization
+        backend_instance = face_retrieval.FaceRetrieval(staged_start=True)
+        initialization_thread = threading.Thread(target=backend_instance.initialize)
+        initialization_thread.daemon = True
+        initialization_thread.start()
         while True:
             try:
                 client, address = self.sock.accept()
@@ -46,8 +50,9 @@ class ThreadedServer(object):
                 listening_thread.start()
             except KeyboardInterrupt as e:
                 print ('KeyboardInterrupt detected. Terminating Server !')
-                backend_instance.worker_pool.terminate()
-                backend_instance.worker_pool.join()
+                if backend_instance.worker_pool:
+                    backend_instance.worker_pool.terminate()
+                    backend_instance.worker_pool.join()
                 break
 
 
@@ -0,0 +1,122 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import os
+import multiprocessing
+import numpy
+import torch
+
+import settings
+
+
+def get_available_cores():
+    """
+        Returns the CPU cores the current process is allowed to run on
+        Returns:
+            A sorted list of core numbers
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+# cores the process was allowed to run on when it started, before applying any plan
+INITIAL_CORES = get_available_cores()
+
+
+def parse_core_list(core_list):
+    """
+        Parses a list of cores in the format used by taskset, e.g. '0-3,6'
+        Arguments:
+            core_list: string with comma-separated core numbers or ranges of core numbers
+        Returns:
+            A sorted list of core numbers
+    """
+    cores = set()
+    for item in core_list.split(','):
+        item = item.strip()
+        if len(item) == 0:
+            continue
+        if '-' in item:
+            first, last = item.split('-')
+            cores.update(range(int(first), int(last) + 1))
+        else:
+            cores.add(int(item))
+    return sorted(cores)
+
+
+def plan_cpu_usage(num_workers, reserved_cores=settings.CPU_RESERVED_CORES, available_cores=None):
+    """
+        Splits the available cores between a main process and a number of worker processes, so that
+        the threads of the different processes do not compete for the same cores. The main process
+        gets the first reserved_cores cores and the workers share the rest, each one getting a
+        separate set of cores if there are enough of them.
+        Arguments:
+            num_workers: number of worker processes
+            reserved_cores: number of cores reserved for the main process. If zero, the main process
+                            can run on any core. At least one core is always left for the workers.
+            available_cores: list of cores to be split. If None, all the cores available to the
+                             current process are used.
+        Returns:
+            A dictionary with the fields 'main', with the list of cores of the main process, and
+            'workers', with a list of lists of cores, one per worker
+    """
+    if available_cores == None:
+        available_cores = get_available_cores()
+    if num_workers == 0:
+        return {'main': list(available_cores), 'workers': []}
+
+    reserved_cores = min(max(reserved_cores, 0), len(available_cores) - 1)
+    if reserved_cores > 0:
+        main_cores = list(available_cores[:reserved_cores])
+    else:
+        main_cores = list(available_cores)
+    worker_cores = list(available_cores[reserved_cores:])
+
+    if len(worker_cores) >= num_workers:
+        workers = [ [ int(core) for core in cores ] for cores in numpy.array_split(worker_cores, num_workers) ]
+    else:
+        # not enough cores for all the workers, so some workers have to share a core
+        workers = [ [ worker_cores[idx % len(worker_cores)] ] for idx in range(num_workers) ]
+
+    return {'main': main_cores, 'workers': workers}
+
+
+def apply_cpu_plan(cores, pin=settings.CPU_AFFINITY_ENABLED, all_threads=False):
+    """
+        Makes the current process use the specified cores. The number of threads used by PyTorch
+        is set to the number of cores and, if requested, the process is pinned to the cores.
+        Arguments:
+            cores: list of cores for the current process
+            pin: boolean indicating whether to restrict the current process to the cores. It is
+                 ignored on systems where the affinity of a process cannot be set.
+            all_threads: boolean indicating whether to pin all the threads already running in the
+                         process. Otherwise, only the calling thread is pinned, and the threads and
+                         processes it starts afterwards.
+    """
+    if pin and hasattr(os, 'sched_setaffinity'):
+        thread_ids = [ 0 ]
+        if all_threads and os.path.isdir('/proc/self/task'):
+            thread_ids = [ int(thread_id) for thread_id in os.listdir('/proc/self/task') ]
+        for thread_id in thread_ids:
+            try:
+                os.sched_setaffinity(thread_id, cores)
+            except OSError as e:
+                # the thread might have finished in the meantime
+                if thread_id == 0:
+                    print ('Could not set the CPU affinity of process %d. Reason: %s' % (os.getpid(), str(e)))
+    torch.set_num_threads(max(1, len(cores)))
+    print ('Process %d using %d threads on cores %s' % (os.getpid(), max(1, len(cores)), str(cores)))
+
+
+def reset_cpu_affinity():
+    """
+        Lets the current process run on all the cores the parent process had when it started. Used as
+        initializer of the processes started by a process pinned to a few cores, which would otherwise
+        inherit its cores.
+    """
+    if settings.CPU_AFFINITY_ENABLED and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, INITIAL_CORES)
+        except OSError as e:
+            print ('Could not set the CPU affinity of process %d. Reason: %s' % (os.getpid(), str(e)))
@@ -3,6 +3,9 @@ __copyright__   = 'August 2018'
 
 import settings
 import kdutils
+import segmentutils
+import face_database
+import numpy
 import os
 import pickle # used for saving the lists and dictionaries
 import dill   # used for saving the kd-trees
@@ -128,3 +131,153 @@ def remove_features_from_database():
     except Exception as e:
         print ('Failed building new database. Reason: ' + str(e))
         pass
+
+
+def compact_database(force=False):
+    """
+        Faces deleted while the service is running are only marked as deleted in the tombstones
+        file of the database. Use this method to produce new database files (and kd-tree files,
+        if KDTREES_RANKING_ENABLED is True) without the deleted faces, once the ratio of deleted
+        faces is at least TOMBSTONES_COMPACTION_RATIO.
+
+        The new files are created next to the original ones, with the suffix '_compacted'. Once
+        you have generated them, change the DATASET_FEATS_FILE and KDTREES_FILE variables in the
+        settings to point to the new main files, and restart the service or use 'reloadDatabase'.
+
+        Arguments:
+            force: boolean indicating whether to compact the database regardless of the ratio of deleted faces
+    """
+    try:
+        tombstones = face_database.load_tombstones(settings.DATASET_FEATS_FILE)
+        num_deleted = numpy.count_nonzero(tombstones)
+        if num_deleted == 0:
+            print ('There are no deleted faces in %s. Nothing to be done' % settings.DATASET_FEATS_FILE)
+            return
+        print ('Found %d deleted faces in %s' % (num_deleted, settings.DATASET_FEATS_FILE))
+        # the tombstones cover all the rows of the database at the time of the last deletion
+        ratio = num_deleted/float(len(tombstones))
+        print ('Ratio of deleted faces: %f' % ratio)
+        if ratio < settings.TOMBSTONES_COMPACTION_RATIO and not force:
+            print ('The ratio of deleted faces is below TOMBSTONES_COMPACTION_RATIO. Nothing to be done')
+            return
+
+        # find out the sub-databases, in the order in which they are loaded
+        with open(settings.DATASET_FEATS_FILE, 'rb') as fin:
+            database_content = pickle.load(fin)
+        if isinstance(database_content, dict):
+            sub_databases = [ settings.DATASET_FEATS_FILE ]
+            # release memory, the content will be loaded again below
+            database_content = None
+        elif isinstance(database_content, list):
+            sub_databases = [ segmentutils.get_entry_path(settings.DATASET_FEATS_FILE, entry) for entry in database_content ]
+        else:
+            raise Exception('File %s contains corrupted information.' % settings.DATASET_FEATS_FILE)
+
+        # rewrite the sub-databases without the deleted rows
+        offset = 0
+        manifest_num_rows = []
+        feats_size = None
+        feats_dtype = None
+        for sub_database in sub_databases:
+            print ('Loading sub-database ' + sub_database)
+            with open(sub_database, 'rb') as fin_chunk:
+                database_chunk_content = pickle.load(fin_chunk)
+            num_rows = len(database_chunk_content['paths'])
+            keep = ~face_database.is_deleted(tombstones, numpy.arange(offset, offset + num_rows))
+            kept_rows = numpy.flatnonzero(keep)
+            offset = offset + num_rows
+            new_database = {'paths': [], 'rois': []}
+            new_database['paths'].extend([ database_chunk_content['paths'][idx] for idx in kept_rows ])
+            new_database['rois'].extend([ database_chunk_content['rois'][idx] for idx in kept_rows ])
+            if 'feats' in database_chunk_content:
+                new_database['feats'] = numpy.array(database_chunk_content['feats'])[keep]
+                if feats_size == None and len(new_database['feats']) > 0:
+                    feats_size = new_database['feats'].shape[-1]
+                    feats_dtype = new_database['feats'].dtype.name
+            manifest_num_rows.append(len(new_database['paths']))
+            NEW_SUB_DATASET_FILE = sub_database.replace('.pkl', '_compacted.pkl')
+            print ('Generating new sub-database %s with %d of %d faces' % (NEW_SUB_DATASET_FILE, len(new_database['paths']), num_rows))
+            with open(NEW_SUB_DATASET_FILE, 'wb') as fout:
+                pickle.dump(new_database, fout, pickle.HIGHEST_PROTOCOL)
+
+        NEW_DATASET_FILE = settings.DATASET_FEATS_FILE.replace('.pkl', '_compacted.pkl')
+        if isinstance(database_content, list):
+            print ('Generating new database ' + NEW_DATASET_FILE)
+            new_entries = [ entry.replace('.pkl', '_compacted.pkl') for entry in database_content ]
+            with open(NEW_DATASET_FILE, 'wb') as fout:
+                pickle.dump(new_entries, fout, pickle.HIGHEST_PROTOCOL)
+            segmentutils.save_manifest(NEW_DATASET_FILE, new_entries, manifest_num_rows, feats_size, feats_dtype)
+
+        # rebuild the kd-trees without the deleted rows
+        if settings.KDTREES_RANKING_ENABLED and os.path.exists(settings.KDTREES_FILE):
+            worker_pool = multiprocessing.Pool(processes=settings.NUMBER_OF_HELPER_WORKERS)
+            with open(settings.KDTREES_FILE, 'rb') as fin:
+                kdtrees_content = dill.load(fin)
+            if len(kdtrees_content) > 0 and isinstance(kdtrees_content[0], str):
+                kdtree_files = [ segmentutils.get_entry_path(settings.KDTREES_FILE, entry) for entry in kdtrees_content ]
+                new_kdtrees_content = [ entry.replace('.pkl', '_compacted.pkl') for entry in kdtrees_content ]
+                del kdtrees_content
+            else:
+                kdtree_files = [ settings.KDTREES_FILE ]
+                new_kdtrees_content = None
+            offset = 0
+            for kdtree_file in kdtree_files:
+                print ('Loading kd-tree file ' + kdtree_file)
+                with open(kdtree_file, 'rb') as fin:
+                    kdtrees = dill.load(fin)
+                feats = numpy.concatenate([ kdtree.data for kdtree in kdtrees ])
+                del kdtrees
+                keep = ~face_database.is_deleted(tombstones, numpy.arange(offset, offset + len(feats)))
+                offset = offset + len(feats)
+                kdutils.build_kdtrees(feats[keep], settings.KDTREES_DATASET_SPLIT_SIZE,
+                                      worker_pool, kdtree_file.replace('.pkl', '_compacted.pkl'))
+            if new_kdtrees_content != None:
+                NEW_KDTREES_FILE = settings.KDTREES_FILE.replace('.pkl', '_compacted.pkl')
+                print ('Saving kd-tree list ' + str(new_kdtrees_content))
+                with open(NEW_KDTREES_FILE, 'wb') as fout:
+                    dill.dump(new_kdtrees_content, fout)
+
+    except Exception as e:
+        print ('Failed compacting database. Reason: ' + str(e))
+        pass
+
+
+def build_database_manifest():
+    """
+        A list-based database is loaded faster when it has a manifest, i.e. a file listing the number
+        of faces in each sub-database. The manifest allows the service to allocate the memory for all
+        the features before loading the sub-databases, which are then loaded in parallel by
+        DATABASE_LOADING_WORKERS processes writing directly into that memory.
+
+        Use this method to generate the manifest of the list-based database in DATASET_FEATS_FILE.
+        The manifest is saved next to the database file, with the suffix '_manifest'. Segments added
+        later with 'ingest' are recorded in the manifest automatically.
+    """
+    try:
+        if segmentutils.peek_database_type(settings.DATASET_FEATS_FILE) != list:
+            print ('%s is not a list-based database. Nothing to be done' % settings.DATASET_FEATS_FILE)
+            return
+        with open(settings.DATASET_FEATS_FILE, 'rb') as fin:
+            database_content = pickle.load(fin)
+        num_rows = []
+        feats_size = None
+        feats_dtype = None
+        for entry in database_content:
+            sub_database = segmentutils.get_entry_path(settings.DATASET_FEATS_FILE, entry)
+            print ('Loading sub-database ' + sub_database)
+            with open(sub_database, 'rb') as fin_chunk:
+                database_chunk_content = pickle.load(fin_chunk)
+            num_rows.append(len(database_chunk_content['paths']))
+            if 'feats' in database_chunk_content and len(database_chunk_content['feats']) > 0:
+                feats = numpy.asarray(database_chunk_content['feats'])
+                if feats_size == None:
+                    feats_size = feats.shape[-1]
+                    feats_dtype = feats.dtype.name
+                elif feats.shape[-1] != feats_size:
+                    raise Exception('The features in %s do not have the same size as in the other sub-databases.' % sub_database)
+            del database_chunk_content
+        print ('Saving manifest for %d faces in %d sub-databases' % (sum(num_rows), len(num_rows)))
+        segmentutils.save_manifest(settings.DATASET_FEATS_FILE, database_content, num_rows, feats_size, feats_dtype)
+    except Exception as e:
+        print ('Failed building database manifest. Reason: ' + str(e))
+        pass
@@ -0,0 +1,1185 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import os
+import pickle
+import dill
+import threading
+import multiprocessing
+import tempfile
+import shutil
+import time
+import numpy
+from scipy.spatial import distance as df
+from scipy.spatial import cKDTree
+
+import settings
+import cpuutils
+import filterutils
+import segmentutils
+
+if settings.KDTREES_RANKING_ENABLED:
+    import kdutils
+
+def get_tombstones_file(feats_file):
+    """
+        Returns the path to the file storing the tombstones of a database
+        Arguments:
+            feats_file: Full path to the database file
+        Returns:
+            The full path to the tombstones file
+    """
+    return feats_file.replace('.pkl', '_tombstones.pkl')
+
+
+def load_tombstones(feats_file):
+    """
+        Loads the tombstones of a database, i.e. the rows that have been deleted from it
+        Arguments:
+            feats_file: Full path to the database file
+        Returns:
+            A boolean array with one element per row, set to True for deleted rows.
+            The array can be shorter than the database, in which case the rows beyond
+            the end of the array are not deleted.
+    """
+    tombstones_file = get_tombstones_file(feats_file)
+    if not os.path.exists(tombstones_file):
+        return numpy.zeros(0, dtype=bool)
+    with open(tombstones_file, 'rb') as fin:
+        tombstones_content = pickle.load(fin)
+    return numpy.unpackbits(tombstones_content['bitmap'])[:tombstones_content['num_rows']].astype(bool)
+
+
+def save_tombstones(feats_file, tombstones):
+    """
+        Saves the tombstones of a database in a compact bitmap
+        Arguments:
+            feats_file: Full path to the database file
+            tombstones: boolean array with one element per row, set to True for deleted rows
+    """
+    tombstones_content = {'num_rows': len(tombstones), 'bitmap': numpy.packbits(tombstones)}
+    segmentutils.save_atomically(tombstones_content, get_tombstones_file(feats_file))
+
+
+def is_deleted(tombstones, rows):
+    """
+        Checks which rows are deleted
+        Arguments:
+            tombstones: boolean array with one element per row, set to True for deleted rows
+            rows: array of row ids
+        Returns:
+            A boolean array with the same length as rows, set to True for deleted rows
+    """
+    deleted = numpy.zeros(len(rows), dtype=bool)
+    in_range = rows < len(tombstones)
+    deleted[in_range] = tombstones[rows[in_range]]
+    return deleted
+
+
+def load_sub_database(job):
+    """
+        Loads one sub-database of a list-based database. Used by the processes loading
+        the sub-databases in parallel.
+        Arguments:
+            job: tuple (sub_database, load_feats, shared_feats), where sub_database is the full path
+                 to the sub-database file, load_feats indicates whether the features should be loaded, and
+                 shared_feats is None or a tuple (filename, dtype, shape, start, num_rows) describing
+                 the preallocated matrix where the features should be written, starting at row 'start'
+        Returns:
+            A dictionary with the 'paths' and 'rois' of the sub-database. The 'feats' are also included,
+            unless they were written to the preallocated matrix or not loaded at all.
+    """
+    sub_database, load_feats, shared_feats = job
+    with open(sub_database, 'rb') as fin_chunk:
+        database_chunk_content = pickle.load(fin_chunk)
+    result = {'paths': database_chunk_content['paths'], 'rois': database_chunk_content['rois'], 'feats': None}
+    if load_feats:
+        if 'feats' not in database_chunk_content.keys():
+            raise Exception('The features cannot be found. Please check your settings.')
+        feats = numpy.asarray(database_chunk_content['feats'])
+        if shared_feats != None:
+            filename, dtype, shape, start, num_rows = shared_feats
+            if len(feats) != num_rows or len(result['paths']) != num_rows:
+                raise Exception('The manifest does not match the content of %s. Please rebuild it.' % sub_database)
+            if num_rows > 0:
+                matrix = numpy.memmap(filename, dtype=dtype, mode='r+', shape=shape)
+                matrix[start:start + num_rows] = feats
+                matrix.flush()
+                del matrix
+        else:
+            result['feats'] = feats
+    return result
+
+
+def get_files_signature(feats_file, kdtrees_file):
+    """
+        Returns a value that changes whenever the database file or the kd-trees file are modified
+        Arguments:
+            feats_file: Full path to the database file
+            kdtrees_file: Full path to the kd-trees file
+        Returns:
+            A tuple with the modification times of the files, or None for files that do not exist
+    """
+    signature = []
+    for filename in [ feats_file, kdtrees_file ]:
+        if filename and os.path.exists(filename):
+            signature.append(os.path.getmtime(filename))
+        else:
+            signature.append(None)
+    return tuple(signature)
+
+
+def estimate_files_memory_usage(feats_file, kdtrees_file):
+    """
+        Estimates the number of bytes that a database would use in memory, without loading it.
+        The estimation is based on the size of the files of the database.
+        Arguments:
+            feats_file: Full path to the database file
+            kdtrees_file: Full path to the kd-trees file. Only used if KDTREES_RANKING_ENABLED is True.
+        Returns:
+            The estimated number of bytes
+    """
+    total_size = os.path.getsize(feats_file)
+    list_based = segmentutils.peek_database_type(feats_file) == list
+    if list_based:
+        total_size = total_size + get_entries_size(feats_file, pickle)
+    if settings.KDTREES_RANKING_ENABLED and os.path.exists(kdtrees_file):
+        total_size = total_size + os.path.getsize(kdtrees_file)
+        # the kd-trees file of a dictionary-based database contains the kd-trees themselves,
+        # so only list-based databases have a list of kd-trees files
+        if list_based:
+            total_size = total_size + get_entries_size(kdtrees_file, dill)
+    return total_size
+
+
+def get_entries_size(database_file, loader):
+    """
+        Adds up the size of the sub-files listed in a list-based database file or kd-trees file
+        Arguments:
+            database_file: Full path to the main database file or kd-trees file
+            loader: module used to load the file. Either pickle or dill.
+        Returns:
+            The number of bytes of the sub-files
+    """
+    with open(database_file, 'rb') as fin:
+        entries = loader.load(fin)
+    total_size = 0
+    for entry in entries:
+        # anything else than a file name is not a list of entries
+        if not isinstance(entry, str):
+            return 0
+        total_size = total_size + os.path.getsize(segmentutils.get_entry_path(database_file, entry))
+    return total_size
+
+
+# Rough number of bytes used by the path and the roi of each face in memory.
+# Only used to estimate the memory used by a database.
+ESTIMATED_METADATA_BYTES_PER_FACE = 300
+
+
+class FaceDatabase(object):
+    """
+        Class holding the features and the metadata of one dataset, and implementing
+        the search over them.
+    """
+
+    def __init__(self, name, feats_file, kdtrees_file):
+        """
+            Initializes the database. The actual data is not loaded until load() is called.
+            Arguments:
+                name: short string with the name of the dataset
+                feats_file: Full path to the database file
+                kdtrees_file: Full path to the file with the kd-trees of the database. Only used
+                              if KDTREES_RANKING_ENABLED is True.
+        """
+        self.name = name
+        self.feats_file = feats_file
+        self.kdtrees_file = kdtrees_file
+        self.database = {'paths': [], 'rois': [], 'feats': []}
+        self.kdtrees = []
+        self.sub_databases = []
+        self.filter_index = None
+        self.files_signature = None
+        # faces added while the database is in use are kept in small 'delta' segments
+        # until they are merged into the main database
+        self.delta_segments = []
+        # merged delta segments that were not saved to the database file. A copy of their
+        # data is kept, so that they can be moved to a new version of the database.
+        self.unsaved_segments = []
+        # number of rows of the main database that are stored in the database file
+        self.file_rows = 0
+        # rows deleted from the database
+        self.tombstones = numpy.zeros(0, dtype=bool)
+        # set when the database is replaced by a new version, which takes its unsaved faces
+        self.retired = False
+        self.lock = threading.Lock()
+        self.merge_lock = threading.Lock()
+        self.tombstones_lock = threading.Lock()
+
+
+    def load(self):
+        """
+            Loads into memory the database of features, which should have been computed beforehand.
+        """
+        self.files_signature = get_files_signature(self.feats_file, self.kdtrees_file)
+        if settings.KDTREES_RANKING_ENABLED:
+            print ('Ranking with kdtrees is enabled')
+            if os.path.exists(self.kdtrees_file):
+                print ('Found precomputed kdtrees...')
+                self.kdtrees = kdutils.load_kdtrees(self.kdtrees_file, settings.DATABASE_LOADING_WORKERS, settings.DATABASE_LOADING_TIMEOUT,
+                                                    cpuutils.reset_cpu_affinity)
+            else:
+                print ('DID NOT find precomputed kdtrees. The dataset features will not be accessible via kd-trees.')
+
+        print ('Loading dataset %s ...' % self.name)
+        t = time.time()
+        load_feats = len(self.kdtrees)==0
+        # acquire dataset information the old-fashion way
+        with open(self.feats_file, 'rb') as fin:
+            database_content = pickle.load(fin)
+        if isinstance(database_content, dict):
+            if load_feats:
+                if 'feats' in database_content.keys():
+                    self.database['feats'] = numpy.asarray(database_content['feats'])
+                else:
+                    raise Exception('The features cannot be found. Please check your settings.')
+            self.database['paths'].extend(database_content['paths'])
+            self.database['rois'].extend(database_content['rois'])
+            self.sub_databases.append((os.path.basename(self.feats_file), 0, len(self.database['paths'])))
+        elif isinstance(database_content, list):
+            self.load_sub_databases_(database_content, load_feats)
+        else:
+            raise Exception('Cannot load dataset %s. File %s contains corrupted information.' % (self.name, self.feats_file))
+        del database_content
+        if not load_feats:
+            self.database['feats'] = numpy.zeros((0, settings.FEATURES_VECTOR_SIZE), dtype=numpy.float32)
+
+        print ('Loaded database for %d tracks in t=%f' % (len(self.database['paths']), time.time() - t))
+
+        # ignore the tombstones of rows that were not saved to the database file
+        self.file_rows = len(self.database['paths'])
+        self.tombstones = load_tombstones(self.feats_file)[:self.file_rows]
+        if numpy.any(self.tombstones):
+            print ('Found %d deleted tracks' % numpy.count_nonzero(self.tombstones))
+
+        # precompute the metadata needed to filter the searches
+        self.filter_index = filterutils.RowFilterIndex(self.database['paths'], self.sub_databases)
+
+
+    def load_sub_databases_(self, entries, load_feats):
+        """
+            Loads the sub-databases of a list-based database in parallel, using DATABASE_LOADING_WORKERS
+            processes. If the manifest of the database is available, the features of all sub-databases
+            are written by the workers directly into a single preallocated matrix. Otherwise, the
+            features are sent back by the workers and concatenated at the end.
+            Arguments:
+                entries: list of entries of the main database file
+                load_feats: boolean indicating whether the features should be loaded
+        """
+        if len(entries) == 0:
+            return
+
+        manifest = None
+        shared_feats_file = None
+        if load_feats:
+            manifest = segmentutils.load_manifest(self.feats_file, entries)
+            if manifest != None and manifest['feats_size'] == None:
+                manifest = None
+            if manifest == None:
+                print ('No valid manifest found for %s. Run databaseutils.build_database_manifest() to speed up loading.' % self.feats_file)
+            else:
+                num_rows = sum(manifest['num_rows'])
+                feats_shape = (num_rows, manifest['feats_size'])
+                feats_dtype = numpy.dtype(manifest['feats_dtype'])
+                feats_bytes = num_rows*feats_shape[1]*feats_dtype.itemsize
+                tmp_dir = settings.DATABASE_LOADING_TMP_DIR
+                if tmp_dir and shutil.disk_usage(tmp_dir).free < feats_bytes:
+                    # e.g. the small /dev/shm of a container, where writing the features would crash the loading processes
+                    print ('Not enough free space in %s for the features of dataset %s, using the system temporary directory' % (tmp_dir, self.name))
+                    tmp_dir = None
+                file_handle, shared_feats_file = tempfile.mkstemp(suffix='.feats', dir=tmp_dir)
+                os.close(file_handle)
+                print ('Allocating %d bytes for the features of dataset %s' % (feats_bytes, self.name))
+                if num_rows > 0:
+                    # create the file with the size of the whole matrix, so the workers can write to it
+                    numpy.memmap(shared_feats_file, dtype=feats_dtype, mode='w+', shape=feats_shape).flush()
+
+        jobs = []
+        row_offset = 0
+        for idx, entry in enumerate(entries):
+            shared_feats = None
+            if shared_feats_file:
+                shared_feats = (shared_feats_file, manifest['feats_dtype'], feats_shape, row_offset, manifest['num_rows'][idx])
+                row_offset = row_offset + manifest['num_rows'][idx]
+            jobs.append((segmentutils.get_entry_path(self.feats_file, entry), load_feats, shared_feats))
+
+        feats_parts = []
+        try:
+            # the loading processes use all the cores, even if the main process is pinned to a few of them
+            worker_pool = multiprocessing.Pool(processes=max(1, min(settings.DATABASE_LOADING_WORKERS, len(entries))),
+                                               initializer=cpuutils.reset_cpu_affinity)
+            try:
+                # the results are taken in the order of the entries, so the rows are numbered as in a
+                # sequential load. A loading process that dies (e.g. killed for lack of memory) never
+                # returns its result, so do not wait forever for it.
+                pending_results = [ worker_pool.apply_async(load_sub_database, (job,)) for job in jobs ]
+                for idx, pending_result in enumerate(pending_results):
+                    try:
+                        database_chunk_content = pending_result.get(settings.DATABASE_LOADING_TIMEOUT)
+                    except multiprocessing.TimeoutError:
+                        raise Exception('Timeout while loading sub-dataset %s. The loading process might have died.' % entries[idx])
+                    sub_database_start = len(self.database['paths'])
+                    self.database['paths'].extend(database_chunk_content['paths'])
+                    self.database['rois'].extend(database_chunk_content['rois'])
+                    self.sub_databases.append((entries[idx], sub_database_start, len(self.database['paths'])))
+                    if database_chunk_content['feats'] is not None:
+                        feats_parts.append(database_chunk_content['feats'])
+                    print ('Loaded sub-dataset %s (%d/%d)' % (entries[idx], idx + 1, len(entries)))
+                worker_pool.close()
+            finally:
+                # stop any process still loading after an error
+                worker_pool.terminate()
+                worker_pool.join()
+
+            if shared_feats_file:
+                if feats_shape[0] > 0:
+                    self.database['feats'] = numpy.memmap(shared_feats_file, dtype=feats_dtype, mode='r', shape=feats_shape)
+                else:
+                    self.database['feats'] = numpy.zeros(feats_shape, dtype=feats_dtype)
+            elif load_feats:
+                self.database['feats'] = numpy.concatenate(feats_parts)
+        finally:
+            if shared_feats_file:
+                try:
+                    # the mapping of the features remains valid after removing the file
+                    os.remove(shared_feats_file)
+                except OSError:
+                    # some systems do not allow to remove a file in use
+                    pass
+
+
+    def size(self):
+        """
+            Returns the number of faces in the database, including the ones in delta segments
+        """
+        with self.lock:
+            return len(self.database['paths']) + sum([ len(segment['paths']) for segment in self.delta_segments ])
+
+
+    def has_pending_changes(self):
+        """
+            Returns True if there are faces in delta segments that have not been merged into the main database yet
+        """
+        with self.lock:
+            return len(self.delta_segments) > 0
+
+
+    def has_unsaved_changes(self):
+        """
+            Returns True if there are faces that are not saved to the database file, either in
+            delta segments or merged into the main database without saving them
+        """
+        with self.lock:
+            return len(self.delta_segments) > 0 or len(self.unsaved_segments) > 0
+
+
+    def estimate_memory_usage(self):
+        """
+            Estimates the number of bytes used by the database in memory
+            Returns:
+                The estimated number of bytes
+        """
+        num_faces = self.size()
+        # the kd-trees keep a copy of the features plus the tree structure
+        num_feats = len(self.database['feats']) + 2*sum([ kdtree.n for kdtree in self.kdtrees ])
+        num_feats = num_feats + sum([ len(segment['feats']) for segment in self.delta_segments ])
+        feats_item_size = numpy.dtype(numpy.float32).itemsize
+        if len(self.database['feats']) > 0:
+            feats_item_size = numpy.asarray(self.database['feats'][0]).itemsize
+        return num_faces*ESTIMATED_METADATA_BYTES_PER_FACE + num_feats*settings.FEATURES_VECTOR_SIZE*feats_item_size
+
+
+    def get_row_source_(self, idx):
+        """
+            Finds where the data of a row of the database is stored
+            Arguments:
+                idx: row of the database
+            Returns:
+                A tuple with the dictionary holding the 'paths' and 'rois' of the row
+                and the position of the row within the dictionary
+        """
+        with self.lock:
+            main_size = len(self.database['paths'])
+            if idx < main_size:
+                return self.database, idx
+            for segment in self.delta_segments:
+                if idx < segment['start'] + len(segment['paths']):
+                    return segment, idx - segment['start']
+        raise IndexError('Row %d is not in dataset %s' % (idx, self.name))
+
+
+    def get_path(self, idx):
+        """
+            Returns the path of the image corresponding to a row of the database
+            Arguments:
+                idx: row of the database
+            Returns:
+                The path as a string
+        """
+        source, source_idx = self.get_row_source_(idx)
+        path = source['paths'][source_idx]
+        # check underlying type of results and
+        # remove one dimension if necessary
+        # for compatibility with json.dumps
+        if isinstance(path, numpy.ndarray):
+            path = path[0]
+        return path
+
+
+    def get_roi(self, idx):
+        """
+            Returns the bounding-box of the face corresponding to a row of the database
+            Arguments:
+                idx: row of the database
+            Returns:
+                The bounding-box in the form [x1,y1,x2,y2]
+        """
+        source, source_idx = self.get_row_source_(idx)
+        return source['rois'][source_idx]
+
+
+    def search(self, features, filter_params=None, max_distance=-1, max_results=settings.MAX_RESULTS_RETURN):
+        """
+            Finds the faces in the database that are closest to the query features.
+            The faces in delta segments are included in the search, while deleted faces are excluded.
+            Arguments:
+                features: 1xN array with the query features
+                filter_params: dictionary restricting the search to a part of the database. See
+                               filterutils.RowFilterIndex.resolve() for the supported fields.
+                max_distance: if greater than zero, only the faces within this distance of the query are returned
+                max_results: maximum number of faces to be returned, or -1 for no limit
+            Returns:
+                A tuple with the array of database indexes of the faces found and the array of
+                their distances to the query, both sorted by increasing distance
+        """
+        # take a consistent snapshot of the data, in case delta segments are merged during the search
+        with self.lock:
+            kdtrees = list(self.kdtrees)
+            main_feats = self.database['feats']
+            main_size = len(self.database['paths'])
+            filter_index = self.filter_index
+            delta_segments = list(self.delta_segments)
+            tombstones = self.tombstones
+
+        # resolve the filter, if any, to the ranges of rows to be scored
+        ranges = None
+        if filter_params:
+            ranges = filter_index.resolve(filter_params)
+            if ranges != None:
+                print ('Searching %d filtered rows' % filterutils.count_rows(ranges))
+
+        if settings.KDTREES_RANKING_ENABLED and len(kdtrees) > 0:
+            found_indexes, found_distances = self.search_kdtrees_(kdtrees, tombstones, features, ranges, max_distance, max_results)
+        else:
+            found_indexes, found_distances = self.search_exact_(main_feats, main_size, tombstones, features, ranges, max_distance, max_results)
+        found_indexes = [ found_indexes ]
+        found_distances = [ found_distances ]
+
+        for segment in delta_segments:
+            segment_ranges = [ (0, len(segment['paths'])) ]
+            if filter_params:
+                segment_ranges = segment['filter_index'].resolve(filter_params)
+                segment_ranges = [ (start - segment['start'], end - segment['start']) for start, end in segment_ranges ]
+            segment_indexes, segment_distances = self.search_block_(segment['feats'], segment_ranges, segment['start'],
+                                                                    tombstones, features, max_distance, max_results)
+            found_indexes.extend(segment_indexes)
+            found_distances.extend(segment_distances)
+
+        return self.sort_search_results_(found_indexes, found_distances, max_results)
+
+
+    def add_delta_segment(self, paths, rois, feats):
+        """
+            Adds new faces to the database. The faces are stored in a delta segment and can
+            be searched right away. Use merge_delta_segments() to move them to the main database.
+            Arguments:
+                paths: list with the path of the image of each new face
+                rois: list with the bounding-box of each new face
+                feats: matrix with the features of each new face
+            Returns:
+                The row id of the first new face, or None if the database has been replaced by a new
+                version. In that case, the faces must be added to the new version.
+        """
+        feats = numpy.reshape(numpy.asarray(feats, dtype=numpy.float32), (len(paths), settings.FEATURES_VECTOR_SIZE))
+        with self.lock:
+            if self.retired:
+                return None
+            start = len(self.database['paths']) + sum([ len(segment['paths']) for segment in self.delta_segments ])
+            segment = {'paths': list(paths), 'rois': list(rois), 'feats': feats, 'start': start}
+            segment['filter_index'] = filterutils.RowFilterIndex(segment['paths'], [], start)
+            self.delta_segments.append(segment)
+        print ('Added %d faces to dataset %s' % (len(paths), self.name))
+        return start
+
+
+    def find_rows(self, paths=[], path_prefixes=[]):
+        """
+            Finds the rows of the database corresponding to the specified image paths
+            Arguments:
+                paths: list of image paths, as stored in the database
+                path_prefixes: list of path prefixes. All rows with a path starting with
+                               one of the prefixes are returned.
+            Returns:
+                An array of row ids
+        """
+        with self.lock:
+            filter_indexes = [ self.filter_index ] + [ segment['filter_index'] for segment in self.delta_segments ]
+        ranges = []
+        for filter_index in filter_indexes:
+            for path in paths:
+                ranges.extend(filter_index.path_ranges(path))
+            for path_prefix in path_prefixes:
+                ranges.extend(filter_index.prefix_ranges(path_prefix))
+        rows = [ numpy.arange(start, end) for start, end in filterutils.union_ranges(ranges) ]
+        if len(rows) == 0:
+            return numpy.array([], dtype=int)
+        return numpy.concatenate(rows)
+
+
+    def delete_rows(self, rows):
+        """
+            Deletes rows from the database by marking them in the tombstones bitmap, which
+            is saved right away. The rows are not removed from memory or from the database
+            file, but they will never be returned by a search again. See compact_database()
+            in databaseutils.py to physically remove them.
+            Arguments:
+                rows: list of row ids
+            Returns:
+                The number of rows that were not deleted before
+        """
+        num_deleted = self.mark_deleted_(rows)
+        # write the file without blocking the searches
+        self.save_tombstones_()
+        print ('Deleted %d tracks from dataset %s' % (num_deleted, self.name))
+        return num_deleted
+
+
+    def mark_deleted_(self, rows):
+        """
+            Marks rows as deleted in the tombstones bitmap in memory, without saving it
+            Arguments:
+                rows: list of row ids
+            Returns:
+                The number of rows that were not deleted before
+        """
+        # repeated rows must be counted only once
+        rows = numpy.unique(numpy.asarray(rows, dtype=int))
+        num_rows = self.size()
+        rows = rows[(rows >= 0) & (rows < num_rows)]
+        with self.lock:
+            # copy the bitmap, so that searches in progress are not affected
+            tombstones = numpy.zeros(num_rows, dtype=bool)
+            tombstones[:len(self.tombstones)] = self.tombstones
+            num_deleted = numpy.count_nonzero(~tombstones[rows])
+            tombstones[rows] = True
+            self.tombstones = tombstones
+        return num_deleted
+
+
+    def save_tombstones_(self):
+        """
+            Saves the tombstones of the rows stored in the database file. The tombstones of the faces
+            not saved to the file stay in memory, since their row ids may change if the database is
+            reloaded. The rows deleted by other processes since the database was loaded are kept.
+        """
+        with self.tombstones_lock:
+            with self.lock:
+                file_rows = self.file_rows
+                tombstones = self.tombstones[:file_rows]
+            file_tombstones = numpy.zeros(file_rows, dtype=bool)
+            previous_tombstones = load_tombstones(self.feats_file)[:file_rows]
+            file_tombstones[:len(previous_tombstones)] = previous_tombstones
+            file_tombstones[:len(tombstones)] |= tombstones
+            save_tombstones(self.feats_file, file_tombstones)
+
+
+    def reload_tombstones(self):
+        """
+            Loads again the tombstones from the tombstones file, to pick up any rows
+            deleted by another instance of the database. The tombstones of the faces
+            not saved to the database file are kept.
+        """
+        with self.lock:
+            file_rows = self.file_rows
+        file_tombstones = load_tombstones(self.feats_file)[:file_rows]
+        with self.lock:
+            tombstones = self.tombstones.copy()
+            tombstones[:len(file_tombstones)] |= file_tombstones
+            self.tombstones = tombstones
+
+
+    def files_changed(self):
+        """
+            Returns True if the database file or the kd-trees file have been modified since they were loaded
+        """
+        return self.files_signature != get_files_signature(self.feats_file, self.kdtrees_file)
+
+
+    def take_unsaved_segments(self):
+        """
+            Removes from the database the faces that are not saved to the database file, i.e. the
+            delta segments and the merged segments that were not saved, and returns them. The
+            database is retired, so no more faces can be added to it. Must be called with the
+            merge_lock held, so that a merge does not move the segments at the same time.
+            Returns:
+                The list of segments. Each segment is a dictionary with at least the fields 'paths',
+                'rois', 'feats' and 'tombstones', with the deleted faces of the segment.
+        """
+        with self.lock:
+            self.retired = True
+            segments = self.unsaved_segments + self.delta_segments
+            self.unsaved_segments = []
+            self.delta_segments = []
+            for segment in segments:
+                segment_tombstones = numpy.zeros(len(segment['paths']), dtype=bool)
+                stored_tombstones = self.tombstones[segment['start']:segment['start'] + len(segment['paths'])]
+                segment_tombstones[:len(stored_tombstones)] = stored_tombstones
+                segment['tombstones'] = segment_tombstones
+        return segments
+
+
+    def merge_delta_segments(self, persist=True):
+        """
+            Merges all the delta segments into the main database, building a new kd-tree for
+            them if the database uses kd-trees. Searches can continue while the merge is in progress.
+            Arguments:
+                persist: boolean indicating whether to save the merged faces as a new segment
+                         of the database file, so that they are loaded again on restart
+        """
+        with self.merge_lock:
+            with self.lock:
+                segments = list(self.delta_segments)
+                main_paths = self.database['paths']
+            if len(segments) == 0:
+                return
+
+            merged = {'paths': [], 'rois': [], 'feats': None}
+            for segment in segments:
+                merged['paths'].extend(segment['paths'])
+                merged['rois'].extend(segment['rois'])
+            merged['feats'] = numpy.concatenate([ segment['feats'] for segment in segments ])
+            start = segments[0]['start']
+            end = start + len(merged['paths'])
+            print ('Merging %d faces into dataset %s' % (len(merged['paths']), self.name))
+
+            use_kdtrees = settings.KDTREES_RANKING_ENABLED and len(self.kdtrees) > 0
+            new_kdtrees = []
+            if use_kdtrees:
+                new_kdtrees = [ cKDTree(merged['feats']) ]
+
+            segment_name = 'delta_%d' % start
+            if persist and (self.file_rows != start or self.files_changed()):
+                # the rows would not be saved in the same position as in memory, so keep them
+                # unsaved until the database is reloaded
+                print ('The files of dataset %s changed, or some faces are not saved to them. Not saving the merged faces.' % self.name)
+                persist = False
+            if persist:
+                try:
+                    kdtrees_file = None
+                    if use_kdtrees:
+                        kdtrees_file = self.kdtrees_file
+                    segment_name = segmentutils.append_segment(self.feats_file, merged, kdtrees_file, new_kdtrees)
+                    # the files have changed, but they are still in sync with the memory
+                    self.files_signature = get_files_signature(self.feats_file, self.kdtrees_file)
+                except Exception as e:
+                    # keep the delta segments and try again the next time
+                    print ('Failed saving merged faces of dataset %s. Reason: %s' % (self.name, str(e)))
+                    return
+
+            # prepare the new filter index before touching the main database
+            sub_databases = self.sub_databases + [ (segment_name, start, end) ]
+            filter_index = filterutils.RowFilterIndex(main_paths + merged['paths'], sub_databases)
+
+            with self.lock:
+                self.database['paths'].extend(merged['paths'])
+                self.database['rois'].extend(merged['rois'])
+                if use_kdtrees:
+                    self.kdtrees = self.kdtrees + new_kdtrees
+                else:
+                    self.database['feats'] = numpy.concatenate((self.database['feats'], merged['feats']))
+                self.sub_databases = sub_databases
+                self.filter_index = filter_index
+                self.delta_segments = self.delta_segments[len(segments):]
+                if persist:
+                    self.file_rows = end
+                else:
+                    merged['start'] = start
+                    self.unsaved_segments.append(merged)
+
+            if persist and numpy.any(self.tombstones[start:end]):
+                # the deleted faces are now stored in the database file
+                self.save_tombstones_()
+            print ('Done merging faces into dataset %s' % self.name)
+
+
+    def search_block_(self, feats, ranges, offset, tombstones, features, max_distance, max_results):
+        """
+            Computes the distances between the query features and the specified rows of a feature matrix.
+            The rows are scored in blocks of RANGE_SEARCH_BLOCK_SIZE, keeping only the best candidates.
+            Short ranges are scored together, see filterutils.row_blocks().
+            Parameters:
+                feats: matrix of features
+                ranges: list of [start, end) ranges of rows of feats to be scored
+                offset: value to be added to the row numbers to convert them to database indexes
+                tombstones: boolean array with one element per database row, set to True for deleted rows
+                features: 1xN array with the query features
+                max_distance: if greater than zero, only the rows within this distance of the query are returned
+                max_results: maximum number of rows to be returned, or -1 for no limit
+            Returns:
+                A tuple with the list of arrays of database indexes found and the list of
+                arrays with their distances to the query
+        """
+        found_indexes = []
+        found_distances = []
+        num_found = 0
+        for block in filterutils.row_blocks(ranges, settings.RANGE_SEARCH_BLOCK_SIZE):
+            if isinstance(block, tuple):
+                block_rows = numpy.arange(block[0], block[1])
+                block_feats = feats[block[0]:block[1]]
+            else:
+                # rows gathered from many short ranges
+                block_rows = block
+                block_feats = feats[block]
+            dst = df.cdist(block_feats, features)[:, 0]
+            if max_distance > 0:
+                hits = numpy.flatnonzero(dst <= max_distance)
+            else:
+                hits = numpy.arange(len(dst))
+            hits = hits[~is_deleted(tombstones, block_rows[hits] + offset)]
+            if len(hits) > 0:
+                found_distances.append(dst[hits])
+                found_indexes.append(block_rows[hits] + offset)
+                num_found = num_found + len(hits)
+                # if there is a cap on the number of results, do not keep more candidates than needed
+                if max_results > 0 and num_found > 2*max_results:
+                    found_indexes, found_distances = self.sort_search_results_(found_indexes, found_distances, max_results)
+                    found_indexes = [ found_indexes ]
+                    found_distances = [ found_distances ]
+                    num_found = len(found_indexes[0])
+
+        return found_indexes, found_distances
+
+
+    def search_kdtrees_(self, kdtrees, tombstones, features, ranges, max_distance, max_results):
+        """
+            Finds the faces in the kd-trees that are closest to the query features
+            Parameters:
+                kdtrees: list of kd-trees of the main database
+                tombstones: boolean array with one element per database row, set to True for deleted rows
+                features: 1xN array with the query features
+                ranges: list of [start, end) ranges of database rows to be searched, or None to search all rows
+                max_distance: if greater than zero, only the faces within this distance of the query are returned
+                max_results: maximum number of faces to be returned, or -1 for no limit
+            Returns:
+                A tuple with the array of database indexes of the faces found and the array of
+                their distances to the query, both sorted by increasing distance
+        """
+        found_indexes = []
+        found_distances = []
+        accum_len = 0
+        if max_distance <= 0:
+            if max_results <= 0:
+                raise Exception('A search without max_distance needs a positive max_results')
+            # split number of results among kdtrees to create smaller sublists of results ...
+            max_results_num_splitted = (max_results*1.0)/len(kdtrees)
+            # ... but always get one more element to avoid rounding errors when converting
+            # to int, and this does not harm the sorting process.
+            max_results_num_splitted = int(max_results_num_splitted + 1)
+        else:
+            # the kd-trees only return neighbours strictly closer than the bound, while the exact
+            # search includes the faces at max_distance, so move the bound up to the next float
+            distance_upper_bound = numpy.nextafter(max_distance, numpy.inf)
+        for kdtree in kdtrees:
+            tree_ranges = [ (0, kdtree.n) ]
+            if ranges != None:
+                tree_ranges = filterutils.intersect_ranges(ranges, [ (accum_len, accum_len + kdtree.n) ])
+                tree_ranges = [ (start - accum_len, end - accum_len) for start, end in tree_ranges ]
+            if len(tree_ranges) == 0:
+                # none of the rows in this kd-tree passes the filter
+                pass
+            elif filterutils.count_rows(tree_ranges) < kdtree.n:
+                # some rows are filtered out, so score the remaining ones directly
+                block_indexes, block_distances = self.search_block_(kdtree.data, tree_ranges, accum_len,
+                                                                    tombstones, features, max_distance, max_results)
+                found_indexes.extend(block_indexes)
+                found_distances.extend(block_distances)
+            elif max_distance <= 0 or max_results > 0:
+                # ask for enough extra neighbours to make up for the deleted ones
+                num_deleted = numpy.count_nonzero(tombstones[accum_len:accum_len + kdtree.n])
+                if max_distance <= 0:
+                    dd, ii = kdtree.query(features, k=min(max_results_num_splitted + num_deleted, kdtree.n))
+                else:
+                    # let the kd-tree prune the search with the distance threshold. Missing
+                    # neighbours are reported with an infinite distance.
+                    dd, ii = kdtree.query(features, k=min(max_results + num_deleted, kdtree.n), distance_upper_bound=distance_upper_bound)
+                dd = numpy.reshape(dd, -1)
+                ii = numpy.reshape(ii, -1) + accum_len
+                valid = numpy.isfinite(dd)
+                valid[valid] = ~is_deleted(tombstones, ii[valid])
+                found_distances.append(dd[valid])
+                found_indexes.append(ii[valid])
+            else:
+                ii = numpy.array(kdtree.query_ball_point(features[0], max_distance), dtype=int)
+                if len(ii) > 0:
+                    ii = ii[~is_deleted(tombstones, ii + accum_len)]
+                    found_distances.append(numpy.linalg.norm(kdtree.data[ii] - features[0], axis=1))
+                    found_indexes.append(ii + accum_len)
+            accum_len = accum_len + kdtree.n
+
+        return self.sort_search_results_(found_indexes, found_distances, max_results)
+
+
+    def search_exact_(self, feats, num_rows, tombstones, features, ranges, max_distance, max_results):
+        """
+            Finds the faces in the main database that are closest to the query features
+            Parameters:
+                feats: features of the main database
+                num_rows: number of rows in the main database
+                tombstones: boolean array with one element per database row, set to True for deleted rows
+                features: 1xN array with the query features
+                ranges: list of [start, end) ranges of database rows to be searched, or None to search all rows
+                max_distance: if greater than zero, only the faces within this distance of the query are returned
+                max_results: maximum number of faces to be returned, or -1 for no limit
+            Returns:
+                A tuple with the array of database indexes of the faces found and the array of
+                their distances to the query, both sorted by increasing distance
+        """
+        if ranges == None:
+            ranges = [ (0, num_rows) ]
+        found_indexes, found_distances = self.search_block_(feats, ranges, 0,
+                                                            tombstones, features, max_distance, max_results)
+        return self.sort_search_results_(found_indexes, found_distances, max_results)
+
+
+    def sort_search_results_(self, found_indexes, found_distances, max_results):
+        """
+            Merges partial search results and sorts them by increasing distance
+            Parameters:
+                found_indexes: list of arrays of database indexes
+                found_distances: list of arrays with the distances corresponding to found_indexes
+                max_results: maximum number of results to keep, or -1 for no limit
+            Returns:
+                A tuple with the array of sorted indexes and the array of sorted distances
+        """
+        if len(found_indexes) == 0:
+            return numpy.array([], dtype=int), numpy.array([])
+        indexes = numpy.concatenate(found_indexes)
+        distances = numpy.concatenate(found_distances)
+        if max_results > 0 and len(distances) > max_results:
+            # only sort the best ones
+            best = numpy.argpartition(distances, max_results-1)[:max_results]
+            indexes = indexes[best]
+            distances = distances[best]
+        order = numpy.argsort(distances, kind='mergesort')
+        return indexes[order], distances[order]
+
+
+class FaceDatabaseRegistry(object):
+    """
+        Class keeping track of the datasets served by the engine.
+        Datasets are loaded on first use. When the estimated memory used by all the loaded
+        datasets exceeds DATASETS_MEMORY_BUDGET, the least recently used datasets that are
+        not being searched, and that do not have faces not saved to their files, are evicted from
+        memory. They will be loaded again on their next use.
+    """
+
+    def __init__(self, datasets=settings.DATASETS, memory_budget=settings.DATASETS_MEMORY_BUDGET):
+        """
+            Initializes the registry
+            Arguments:
+                datasets: dictionary with the configuration of each named dataset. See DATASETS in the settings.
+                memory_budget: Maximum number of bytes to be used by the loaded datasets, or a value <= 0 for no limit.
+        """
+        self.configurations = dict()
+        for name in datasets:
+            self.configurations[name] = datasets[name]
+        self.memory_budget = memory_budget
+        self.loaded = dict()
+        self.last_used = dict()
+        self.users = dict()
+        self.lock = threading.Lock()
+        self.loading_locks = dict()
+        self.reloading = set()
+
+
+    def resolve_name(self, name):
+        """
+            Maps a dataset name to one of the configured datasets
+            Arguments:
+                name: name of the dataset specified by a client
+            Returns:
+                The same name if it corresponds to a configured dataset. Otherwise, the
+                name of the default dataset, i.e. the one in DATASET_FEATS_FILE.
+        """
+        if name in self.configurations:
+            return name
+        return settings.DEFAULT_DATASET_NAME
+
+
+    def is_known(self, name):
+        """
+            Returns True if the name corresponds to one of the configured datasets or to the default
+            dataset. Requests that modify a dataset must not fall back to the default dataset.
+            Arguments:
+                name: name of the dataset specified by a client
+        """
+        return name in self.configurations or name == settings.DEFAULT_DATASET_NAME
+
+
+    def is_allowed_file(self, name, filename):
+        """
+            Checks whether a dataset can be switched to a new database file or kd-trees file. The files
+            must be in the same directory as the current files of the dataset, or in one of the
+            RELOAD_ALLOWED_DIRS, since loading a file runs the code pickled in it.
+            Arguments:
+                name: name of a configured dataset, or DEFAULT_DATASET_NAME
+                filename: Full path to the new file
+            Returns:
+                True if the file can be loaded
+        """
+        allowed_dirs = [ os.path.dirname(current_file) for current_file in self.get_configuration(name) if current_file ]
+        allowed_dirs = allowed_dirs + settings.RELOAD_ALLOWED_DIRS
+        file_dir = os.path.dirname(os.path.realpath(filename))
+        return filename.endswith('.pkl') and any([ file_dir == os.path.realpath(allowed_dir) for allowed_dir in allowed_dirs ])
+
+
+    def get_configuration(self, name):
+        """
+            Returns the paths to the database file and kd-trees file of a dataset
+            Arguments:
+                name: name of a configured dataset, or DEFAULT_DATASET_NAME
+            Returns:
+                A tuple with the database file and the kd-trees file
+        """
+        if name in self.configurations:
+            configuration = self.configurations[name]
+            feats_file = configuration['feats_file']
+            if name == settings.DEFAULT_DATASET_NAME and 'kdtrees_file' not in configuration:
+                return feats_file, settings.KDTREES_FILE
+            kdtrees_file = configuration.get('kdtrees_file', feats_file.replace('.pkl', '_kdtrees.pkl'))
+            return feats_file, kdtrees_file
+        return settings.DATASET_FEATS_FILE, settings.KDTREES_FILE
+
+
+    def acquire(self, name):
+        """
+            Returns the database of a dataset, loading it if necessary. The database is
+            protected from eviction until release() is called.
+            Arguments:
+                name: name of the dataset
+            Returns:
+                The FaceDatabase instance of the dataset
+        """
+        name = self.resolve_name(name)
+        with self.lock:
+            database = self.acquire_loaded_(name)
+            if database != None:
+                return database
+            if name not in self.loading_locks:
+                self.loading_locks[name] = threading.Lock()
+            loading_lock = self.loading_locks[name]
+
+        # only one thread loads each dataset, the rest wait for it
+        with loading_lock:
+            with self.lock:
+                database = self.acquire_loaded_(name)
+                if database != None:
+                    return database
+
+            feats_file, kdtrees_file = self.get_configuration(name)
+            database = FaceDatabase(name, feats_file, kdtrees_file)
+            database.load()
+
+            with self.lock:
+                self.loaded[name] = database
+                self.users[name] = 1
+                self.last_used[name] = time.time()
+                self.evict_()
+
+        return database
+
+
+    def acquire_loaded_(self, name):
+        """
+            Returns the database of a dataset if it is already loaded, protecting it from eviction.
+            Must be called with the lock acquired.
+            Arguments:
+                name: name of a configured dataset, or DEFAULT_DATASET_NAME
+            Returns:
+                The FaceDatabase instance of the dataset, or None if it is not loaded
+        """
+        database = self.loaded.get(name, None)
+        if database != None:
+            self.users[name] = self.users[name] + 1
+            self.last_used[name] = time.time()
+        return database
+
+
+    def reload(self, name, feats_file=None, kdtrees_file=None):
+        """
+            Loads a new version of the database of a dataset while the current version keeps
+            serving requests, then swaps them. Searches in progress finish with the version they
+            started with, and the old version is released from memory when they are done.
+            Faces added with 'ingest' and not yet saved to the database files are kept.
+            Arguments:
+                name: name of the dataset
+                feats_file: Full path to the new database file. Default: the current database file of the dataset
+                kdtrees_file: Full path to the new kd-trees file. Default: the current kd-trees file of the dataset
+            Returns:
+                True if the new version was loaded, False otherwise
+        """
+        name = self.resolve_name(name)
+        with self.lock:
+            if name in self.reloading:
+                print ('Dataset %s is already being reloaded' % name)
+                return False
+            self.reloading.add(name)
+
+        try:
+            current_feats_file, current_kdtrees_file = self.get_configuration(name)
+            if not feats_file:
+                feats_file = current_feats_file
+            if not kdtrees_file:
+                kdtrees_file = current_kdtrees_file
+
+            # make sure both versions fit in memory at the same time
+            new_memory_usage = estimate_files_memory_usage(feats_file, kdtrees_file)
+            with self.lock:
+                if not self.fits_memory_budget_(new_memory_usage, settings.RELOAD_MEMORY_BUDGET, name):
+                    print ('Not enough memory to reload dataset %s. Needed %d bytes' % (name, new_memory_usage))
+                    return False
+
+            old_database = self.loaded.get(name, None)
+            if old_database != None and old_database.has_pending_changes() and feats_file == old_database.feats_file:
+                # save the faces added to the current version, so they are also loaded in the new version
+                old_database.merge_delta_segments(settings.INGEST_PERSIST_MERGED_SEGMENTS)
+
+            print ('Loading new version of dataset %s from %s' % (name, feats_file))
+            database = FaceDatabase(name, feats_file, kdtrees_file)
+            database.load()
+
+            # a merge of the old version must not move its segments while they are taken, so hold
+            # its merge lock. The old version can change while waiting for the lock, e.g. if the
+            # dataset is evicted and loaded again, so check it again once the lock is held.
+            while True:
+                with self.lock:
+                    old_database = self.loaded.get(name, None)
+                old_merge_lock = old_database.merge_lock if old_database != None else threading.Lock()
+                with old_merge_lock:
+                    with self.lock:
+                        if old_database != self.loaded.get(name, None):
+                            continue
+                        if old_database != None:
+                            # keep any deletions, and the faces not saved to the database file. Their row ids
+                            # change if the database file has grown, so their deletions are moved with them.
+                            if feats_file == old_database.feats_file:
+                                database.reload_tombstones()
+                            deleted_rows = []
+                            for segment in old_database.take_unsaved_segments():
+                                start = database.add_delta_segment(segment['paths'], segment['rois'], segment['feats'])
+                                if start != segment['start']:
+                                    print ('Faces %d to %d of dataset %s are now faces %d to %d' % (segment['start'], segment['start'] + len(segment['paths']) - 1,
+                                                                                                  name, start, start + len(segment['paths']) - 1))
+                                deleted_rows.append(numpy.flatnonzero(segment['tombstones']) + start)
+                            if len(deleted_rows) > 0:
+                                # these rows are not in the database file, so there is nothing to save
+                                database.mark_deleted_(numpy.concatenate(deleted_rows))
+                        self.configurations[name] = {'feats_file': feats_file, 'kdtrees_file': kdtrees_file}
+                        self.loaded[name] = database
+                        self.users[name] = 0
+                        self.last_used[name] = time.time()
+                        self.evict_()
+                        break
+
+            print ('Dataset %s successfully reloaded' % name)
+            return True
+
+        finally:
+            with self.lock:
+                self.reloading.discard(name)
+
+
+    def fits_memory_budget_(self, extra_memory_usage, memory_budget, keep_name=None):
+        """
+            Checks whether the loaded datasets plus some extra memory fit in a memory budget.
+            If needed, evicts the least recently used datasets that are not in use.
+            Must be called with the lock acquired.
+            Arguments:
+                extra_memory_usage: number of bytes to be added to the memory used by the loaded datasets
+                memory_budget: Maximum number of bytes, or a value <= 0 for no limit.
+                keep_name: name of a dataset that must not be evicted, e.g. the one being reloaded
+            Returns:
+                True if the extra memory fits in the budget
+        """
+        if memory_budget <= 0:
+            return True
+        return self.evict_(memory_budget - extra_memory_usage, keep_name)
+
+
+    def loaded_databases(self):
+        """
+            Returns the list of FaceDatabase instances currently loaded in memory
+        """
+        with self.lock:
+            return list(self.loaded.values())
+
+
+    def release(self, database):
+        """
+            Indicates that a database obtained with acquire() is not being used anymore
+            Arguments:
+                database: FaceDatabase instance returned by acquire()
+        """
+        with self.lock:
+            if self.loaded.get(database.name, None) is database:
+                self.users[database.name] = self.users[database.name] - 1
+                self.last_used[database.name] = time.time()
+
+
+    def evict_(self, memory_budget=None, keep_name=None):
+        """
+            Evicts the least recently used datasets until the memory used by the loaded
+            datasets fits in the budget. Datasets being used, or with faces not saved to their files,
+            and the default dataset are never evicted.
+            Must be called with the lock acquired.
+            Arguments:
+                memory_budget: Maximum number of bytes to be used by the loaded datasets.
+                               Default: the memory budget of the registry.
+                keep_name: name of a dataset that must not be evicted
+            Returns:
+                True if the loaded datasets fit in the budget
+        """
+        if memory_budget == None:
+            memory_budget = self.memory_budget
+            if memory_budget <= 0:
+                return True
+        memory_usage = dict()
+        for name in self.loaded:
+            memory_usage[name] = self.loaded[name].estimate_memory_usage()
+        total_memory_usage = sum(memory_usage.values())
+        for name in sorted(self.loaded.keys(), key=lambda name: self.last_used[name]):
+            if total_memory_usage <= memory_budget:
+                break
+            if name == settings.DEFAULT_DATASET_NAME or name == keep_name:
+                # the default dataset serves the requests to unknown datasets, so it stays loaded
+                continue
+            if self.users[name] == 0 and not self.loaded[name].has_unsaved_changes():
+                print ('Evicting dataset %s from memory' % name)
+                total_memory_usage = total_memory_usage - memory_usage[name]
+                del self.loaded[name]
+                del self.users[name]
+                del self.last_used[name]
+        if total_memory_usage > memory_budget:
+            print ('WARNING: The loaded datasets exceed the memory budget, but all of them are in use')
+            return False
+        return True
@@ -6,6 +6,7 @@ import settings
 import torch
 import torch.backends.cudnn as cudnn
 import numpy
+import modelutils
 # add RetinaFace to python path
 sys.path.append(os.path.join(settings.DEPENDENCIES_PATH, 'Pytorch_Retinaface'))
 from layers.functions.prior_box import PriorBox
@@ -30,6 +31,8 @@ class FaceDetectorRetinaFace(object):
                        face_rect_expand_factor=FACE_RECT_EXPAND_FACTOR,
                        trained_model=settings.FACE_DETECTION_MODEL,
                        network=settings.FACE_DETECTION_NETWORK,
+                       inference_backend=settings.INFERENCE_BACKEND,
+                       inference_precision=settings.INFERENCE_PRECISION,
                        ):
         """
             Initializes the RetinaFace in PyTorch
@@ -38,23 +41,36 @@ class FaceDetectorRetinaFace(object):
                 face_rect_expand_factor: Expansion factor for the detection face rectangle
                 trained_model: Path to a pretrained model file with weights
                 network: Name of the network used for the detection. The options are 'mobile0.25' or 'resnet50'.
+                inference_backend: 'eager' to use the original PyTorch model, or 'torchscript' or 'onnx'
+                                   to use the model exported from it with modelutils.py
+                inference_precision: 'float32', 'bfloat16' or 'int8'. With 'bfloat16', the network is evaluated
+                                     with automatic mixed precision. With 'int8', the model quantized with
+                                     modelutils.py is used.
         """
         torch.set_grad_enabled(False)
         cudnn.benchmark = True
         self.is_cuda_enable = enable_cuda
         self.face_rect_expand_factor = face_rect_expand_factor
         self.trained_model = trained_model
+        self.network_name = network
+        self.inference_backend = inference_backend
+        self.inference_precision = inference_precision
         self.cfg = None
         if network == 'mobile0.25':
             self.cfg = cfg_mnet
         elif network == 'resnet50':
             self.cfg = cfg_re50
         assert self.cfg != None, "Network name can only be 'resnet50' or 'mobile0.25' !"
-        self.net = RetinaFace(cfg=self.cfg, phase = 'test')
-        self.net = self.load_model(self.net, self.trained_model, not self.is_cuda_enable)
-        self.net.eval()
         self.device = torch.device('cpu' if not self.is_cuda_enable else 'cuda')
-        self.net = self.net.to(self.device)
+        if self.inference_precision == 'int8':
+            self.net = modelutils.load_quantized_model(modelutils.get_detection_model_name(network), self.device)
+        elif self.inference_backend != 'eager':
+            self.net = modelutils.load_exported_model(modelutils.get_detection_model_name(network), self.inference_backend, self.device)
+        else:
+            self.net = RetinaFace(cfg=self.cfg, phase = 'test')
+            self.net = self.load_model(self.net, self.trained_model, not self.is_cuda_enable)
+            self.net.eval()
+            self.net = self.net.to(self.device)
 
 
     def check_keys(self, model, pretrained_state_dict):
@@ -111,6 +127,91 @@ class FaceDetectorRetinaFace(object):
         return model
 
 
+    def prepare_input_(self, img):
+        """
+            Converts an image to the input expected by the network
+            Arguments:
+                img: input image
+            Returns:
+                A tensor with the image, ready to be input to the network
+        """
+        img = numpy.float32(img)
+        img -= (104, 117, 123)
+        img = img.transpose(2, 0, 1)
+        img = torch.from_numpy(img).unsqueeze(0)
+        return img.to(self.device)
+
+
+    def expand_detection_(self, det, im_width, im_height):
+        """
+            Expands the bounding-box of a detection by the face_rect_expand_factor specified when the object
+            was instantiated, keeping it within the image
+            Arguments:
+                det: array in the form [x1,y1,x2,y2,score]
+                im_width: width of the image
+                im_height: height of the image
+            Returns:
+                An array in the form [x1,y1,x2,y2,score], with integer coordinates
+        """
+        bounding_box = numpy.zeros(5, dtype=numpy.float32)
+        # extend detection
+        extend_factor = self.face_rect_expand_factor
+        width = round(det[2]-det[0]+1)
+        height = round(det[3]-det[1]+1)
+        length = (width + height)/2.0
+        centrepoint = [round(det[0]) + width/2.0, round(det[1]) + height/2.0]
+        bounding_box[0] = centrepoint[0] - round((1+extend_factor)*length/2.0)
+        bounding_box[1] = centrepoint[1] - round((1+extend_factor)*length/2.0)
+        bounding_box[2] = centrepoint[0] + round((1+extend_factor)*length/2.0)
+        bounding_box[3] = centrepoint[1] + round((1+extend_factor)*length/2.0)
+        # prevent going off image
+        bounding_box[0] = int(max(bounding_box[0], 0))
+        bounding_box[1] = int(max(bounding_box[1], 0))
+        bounding_box[2] = int(min(bounding_box[2], im_width))
+        bounding_box[3] = int(min(bounding_box[3], im_height))
+        bounding_box[4] = det[4]
+        return bounding_box
+
+
+    def select_detections_(self, boxes, scores, im_width, im_height, return_best):
+        """
+            Selects the detections of an image from the output of the network
+            Arguments:
+                boxes: array with one bounding-box per prior, in image coordinates
+                scores: array with the face score of each prior
+                im_width: width of the image
+                im_height: height of the image
+                return_best: boolean indicating whether to return just to best detection or the complete list of detections
+            Returns:
+                A list of detections as described in detect_faces(), or None if there are no detections
+        """
+        # ignore low scores
+        inds = numpy.where(scores > CONF_THRESH)[0]
+        boxes = boxes[inds]
+        scores = scores[inds]
+
+        # keep top-K before NMS
+        # order = scores.argsort()[::-1][:args.top_k]
+        order = scores.argsort()[::-1]
+        boxes = boxes[order]
+        scores = scores[order]
+
+        # do NMS
+        dets = numpy.hstack((boxes, scores[:, numpy.newaxis])).astype(numpy.float32, copy=False)
+        keep = py_cpu_nms(dets, NMS_THRESH)
+
+        # keep top-K faster NMS
+        detections = dets[keep, :]
+
+        if len(detections) > 0:
+            if return_best:
+                # detections is ordered by confidence so the first one is the best
+                return [ self.expand_detection_(numpy.squeeze(detections[0, 0:5]), im_width, im_height) ]
+            else:
+                return [ self.expand_detection_(numpy.squeeze(detections[j, 0:5]), im_width, im_height) for j in range(len(detections)) ]
+        return None
+
+
     def detect_faces(self, img, return_best=False):
         """
             Computes a list of faces detected in the input image in the form of a list of bounding-boxes, one per each detected face.
@@ -123,97 +224,122 @@ class FaceDetectorRetinaFace(object):
                 the coordinates of the bottom-right corner of the box. The score is a floating-point number.
                 When return_best is True, the returned list will contain only one bounding-box
         """
-        if numpy.all(img != None):
-            try:
-                im_height, im_width, _ = img.shape
-                scale = torch.Tensor([img.shape[1], img.shape[0], img.shape[1], img.shape[0]])
-                img = numpy.float32(img)
-                img -= (104, 117, 123)
-                img = img.transpose(2, 0, 1)
-                img = torch.from_numpy(img).unsqueeze(0)
-                img = img.to(self.device)
-                scale = scale.to(self.device)
-
-                # note below that the landmarks (3rd returned value) are ignored
-                loc, conf, _ = self.net(img)
-
-                priorbox = PriorBox(self.cfg, image_size=(im_height, im_width))
-                priors = priorbox.forward()
-                priors = priors.to(self.device)
-                prior_data = priors.data
-                boxes = decode(loc.data.squeeze(0), prior_data, self.cfg['variance'])
-                boxes = boxes * scale
-                boxes = boxes.cpu().numpy()
-                scores = conf.squeeze(0).data.cpu().numpy()[:, 1]
-
-                # ignore low scores
-                inds = numpy.where(scores > CONF_THRESH)[0]
-                boxes = boxes[inds]
-                scores = scores[inds]
-
-                # keep top-K before NMS
-                # order = scores.argsort()[::-1][:args.top_k]
-                order = scores.argsort()[::-1]
-                boxes = boxes[order]
-                scores = scores[order]
-
-                # do NMS
-                dets = numpy.hstack((boxes, scores[:, numpy.newaxis])).astype(numpy.float32, copy=False)
-                keep = py_cpu_nms(dets, NMS_THRESH)
-
-                # keep top-K faster NMS
-                detections = dets[keep, :]
-
-                if len(detections) > 0:
-                    if return_best:
-                        # detections is ordered by confidence so the first one is the best
-                        det = numpy.squeeze(detections[0, 0:5])
-                        bounding_box = numpy.zeros(5, dtype=numpy.float32)
-                        # extend detection
-                        extend_factor = self.face_rect_expand_factor
-                        width = round(det[2]-det[0]+1)
-                        height = round(det[3]-det[1]+1)
-                        length = (width + height)/2.0
-                        centrepoint = [round(det[0]) + width/2.0, round(det[1]) + height/2.0]
-                        bounding_box[0] = centrepoint[0] - round((1+extend_factor)*length/2.0)
-                        bounding_box[1] = centrepoint[1] - round((1+extend_factor)*length/2.0)
-                        bounding_box[2] = centrepoint[0] + round((1+extend_factor)*length/2.0)
-                        bounding_box[3] = centrepoint[1] + round((1+extend_factor)*length/2.0)
-                        # prevent going off image
-                        bounding_box[0] = int(max(bounding_box[0], 0))
-                        bounding_box[1] = int(max(bounding_box[1], 0))
-                        bounding_box[2] = int(min(bounding_box[2], img.shape[3]))
-                        bounding_box[3] = int(min(bounding_box[3], img.shape[2]))
-                        bounding_box[4] = det[4]
-                        return [bounding_box]
-                    else:
-                        det_list = []
-                        for j in range(len(detections)):
-                            det = numpy.squeeze(detections[j, 0:5])
-                            bounding_box = numpy.zeros(5, dtype=numpy.float32)
-                            # extend detection
-                            extend_factor = self.face_rect_expand_factor
-                            width = round(det[2]-det[0]+1)
-                            height = round(det[3]-det[1]+1)
-                            length = (width + height)/2.0
-                            centrepoint = [round(det[0]) + width/2.0, round(det[1]) + height/2.0]
-                            bounding_box[0] = centrepoint[0] - round((1+extend_factor)*length/2.0)
-                            bounding_box[1] = centrepoint[1] - round((1+extend_factor)*length/2.0)
-                            bounding_box[2] = centrepoint[0] + round((1+extend_factor)*length/2.0)
-                            bounding_box[3] = centrepoint[1] + round((1+extend_factor)*length/2.0)
-                            # prevent going off image
-                            bounding_box[0] = int(max(bounding_box[0], 0))
-                            bounding_box[1] = int(max(bounding_box[1], 0))
-                            bounding_box[2] = int(min(bounding_box[2], img.shape[3]))
-                            bounding_box[3] = int(min(bounding_box[3], img.shape[2]))
-                            bounding_box[4] = det[4]
-                            det_list.append(bounding_box)
-                        return det_list
-                else:
-                    return None
+        try:
+            return self.detect_faces_batch([img], return_best)[0]
+        except Exception as e:
+            print ('Exception in FaceDetectorRetinaFace: ' + str(e))
+            pass
 
+        return None
+
+
+    def detect_faces_batch(self, images, return_best=False):
+        """
+            Detects the faces in several images, evaluating the network once per group of images of similar
+            size. Images of different sizes are padded at the bottom and right with the mean color, i.e. with
+            zeros after subtracting the mean, up to the size of the largest image of their group. A group is
+            closed when the padded area would exceed FACE_DETECTION_BATCH_MAX_PADDING times the area of its
+            images. If the evaluation of a group fails, its images are evaluated one by one.
+            Arguments:
+                images: list of images to be input to the RetinaFace model
+                return_best: boolean indicating whether to return just to best detection or the complete list of detections
+            Returns:
+                A list with the result of detect_faces() for each image, in the same order as the images.
+                The result is None for the images whose detection failed.
+        """
+        results = [ None ] * len(images)
+        valid_indexes = [ idx for idx in range(len(images)) if numpy.all(images[idx] != None) ]
+        # group the images by size, starting with the largest ones
+        valid_indexes.sort(key=lambda idx: images[idx].shape[0] * images[idx].shape[1], reverse=True)
+        groups = []
+        for idx in valid_indexes:
+            im_height, im_width, _ = images[idx].shape
+            if len(groups) > 0:
+                group = groups[-1]
+                batch_height = max(group['height'], im_height)
+                batch_width = max(group['width'], im_width)
+                images_area = group['area'] + im_height * im_width
+                if batch_height * batch_width * (len(group['indexes']) + 1) <= settings.FACE_DETECTION_BATCH_MAX_PADDING * images_area:
+                    group['indexes'].append(idx)
+                    group['height'] = batch_height
+                    group['width'] = batch_width
+                    group['area'] = images_area
+                    continue
+            groups.append({ 'indexes': [idx], 'height': im_height, 'width': im_width, 'area': im_height * im_width })
+
+        for group in groups:
+            try:
+                group_results = self.detect_faces_padded_([ images[idx] for idx in group['indexes'] ], return_best)
             except Exception as e:
                 print ('Exception in FaceDetectorRetinaFace: ' + str(e))
-                pass
+                if len(group['indexes']) == 1:
+                    continue
+                print ('Detecting the faces of the %d images of the batch one by one' % len(group['indexes']))
+                group_results = []
+                for idx in group['indexes']:
+                    try:
+                        group_results.extend(self.detect_faces_padded_([ images[idx] ], return_best))
+                    except Exception as e:
+                        # an image that cannot be processed is reported as an image without faces
+                        print ('Exception in FaceDetectorRetinaFace: ' + str(e))
+                        group_results.append(None)
+            for idx, detections in zip(group['indexes'], group_results):
+                results[idx] = detections
 
-        return None
+        return results
+
+
+    def detect_faces_padded_(self, images, return_best):
+        """
+            Detects the faces in several images with a single evaluation of the network, padding them up
+            to the size of the largest image
+            Arguments:
+                images: list of images to be input to the RetinaFace model. None of them can be None.
+                return_best: boolean indicating whether to return just to best detection or the complete list of detections
+            Returns:
+                A list with the result of detect_faces() for each image, in the same order as the images
+        """
+        results = []
+        batch_height = max([ image.shape[0] for image in images ])
+        batch_width = max([ image.shape[1] for image in images ])
+        batch = torch.zeros((len(images), 3, batch_height, batch_width), device=self.device)
+        for batch_idx, image in enumerate(images):
+            im_height, im_width, _ = image.shape
+            batch[batch_idx, :, :im_height, :im_width] = self.prepare_input_(image)[0]
+        scale = torch.Tensor([batch_width, batch_height, batch_width, batch_height])
+        scale = scale.to(self.device)
+
+        # note below that the landmarks (3rd returned value) are ignored
+        with modelutils.inference_context(self.inference_precision, self.device):
+            loc, conf, _ = self.net(batch)
+        loc = loc.float()
+        conf = conf.float()
+
+        priorbox = PriorBox(self.cfg, image_size=(batch_height, batch_width))
+        priors = priorbox.forward()
+        priors = priors.to(self.device)
+        prior_data = priors.data
+        for batch_idx, image in enumerate(images):
+            boxes = decode(loc.data[batch_idx], prior_data, self.cfg['variance'])
+            boxes = boxes * scale
+            boxes = boxes.cpu().numpy()
+            scores = conf.data[batch_idx].cpu().numpy()[:, 1]
+            im_height, im_width, _ = image.shape
+            results.append(self.select_detections_(boxes, scores, im_width, im_height, return_best))
+
+        return results
+
+
+    def warm_up(self, image_sizes=settings.WARMUP_IMAGE_SIZES, num_passes=settings.WARMUP_NUM_PASSES):
+        """
+            Runs a few forward passes of the network at each of the specified input sizes, so that
+            the lazy initialization done by the framework (including the selection of the fastest
+            algorithms when cudnn.benchmark is enabled) does not slow down the first real requests
+            Arguments:
+                image_sizes: list of (height, width) tuples with the sizes of the input images
+                num_passes: number of forward passes to run for each size
+        """
+        for height, width in image_sizes:
+            image = numpy.random.randint(0, 256, size=(height, width, 3), dtype=numpy.uint8)
+            for idx in range(num_passes):
+                self.detect_faces(image)
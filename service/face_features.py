@@ -9,7 +9,9 @@ import skimage.transform
 import settings
 import torch
 import torch.backends.cudnn as cudnn
+import torch.multiprocessing # registers the pickling of shared tensors used when passing the network to other processes
 import PIL.Image
+import modelutils
 
 cudnn.benchmark = True
 torch.set_grad_enabled(False)
@@ -19,6 +21,62 @@ sys.path.append(os.path.dirname(settings.FEATURES_MODEL_DEF))
 # then import the model
 import senet50_256 as model
 
+# size of the images input to the network. The crops of the faces are resized to it.
+NETWORK_INPUT_SIZE = 244
+
+def load_network(model_weights=settings.FEATURES_MODEL_WEIGHTS, enable_cuda=settings.CUDA_ENABLED,
+                 inference_backend=settings.INFERENCE_BACKEND, inference_precision=settings.INFERENCE_PRECISION):
+    """
+        Loads the face-feature extraction CNN model
+        Arguments:
+            model_weights: Full path to the file containing the weights of the model
+            enable_cuda: boolean indicating whether the model must be loaded on the GPU
+            inference_backend: 'eager' to load the original PyTorch model, or 'torchscript' or 'onnx'
+                               to load the model exported from it with modelutils.py
+            inference_precision: 'float32', 'bfloat16' or 'int8'. With 'int8', the model quantized with
+                                 modelutils.py is loaded regardless of the inference_backend.
+        Returns:
+            The model, ready for evaluation
+    """
+    device = torch.device('cpu' if not enable_cuda else 'cuda')
+    if inference_precision == 'int8':
+        return modelutils.load_quantized_model(modelutils.get_features_model_name(model_weights), device)
+    if inference_backend != 'eager':
+        return modelutils.load_exported_model(modelutils.get_features_model_name(model_weights), inference_backend, device)
+    network = model.Senet50_256()
+    if not enable_cuda:
+        pretrained_dict = torch.load(model_weights, map_location=lambda storage, loc: storage)
+    else:
+        pretrained_dict = torch.load(model_weights, map_location=lambda storage, loc: storage.cuda(device))
+    network.load_state_dict(pretrained_dict)
+    network.eval()
+    return network.to(device)
+
+
+def load_shared_network(model_weights=settings.FEATURES_MODEL_WEIGHTS, enable_cuda=settings.CUDA_ENABLED,
+                        inference_backend=settings.INFERENCE_BACKEND, inference_precision=settings.INFERENCE_PRECISION):
+    """
+        Loads the face-feature extraction CNN model with its weights in shared memory, so that it
+        can be passed to other processes (e.g. via the initializer of a pool of processes) and
+        used by all of them without each one holding its own copy of the weights.
+        Arguments:
+            model_weights: Full path to the file containing the weights of the model
+            enable_cuda: boolean indicating whether the model must be loaded on the GPU
+            inference_backend: 'eager', 'torchscript' or 'onnx'. See load_network().
+            inference_precision: 'float32', 'bfloat16' or 'int8'. See load_network().
+        Returns:
+            The model, or None when CUDA is enabled, since the GPU memory cannot be shared with
+            processes created by forking, or when an exported or quantized model is used, since those
+            cannot be passed to other processes. In that case, each process must load its own model.
+    """
+    if enable_cuda or modelutils.is_exported_model(inference_backend, inference_precision):
+        return None
+    network = load_network(model_weights, enable_cuda, inference_backend, inference_precision)
+    # the weights are read-only from now on, so they can be safely shared
+    network.share_memory()
+    return network
+
+
 class FaceFeatureExtractor(object):
     """ Class to support the face-feature extraction """
 
@@ -26,7 +84,10 @@ class FaceFeatureExtractor(object):
                        model_def=settings.FEATURES_MODEL_DEF,
                        feature_layer=settings.FEATURES_MODEL_LAYER,
                        feature_vector_size=settings.FEATURES_VECTOR_SIZE,
-                       enable_cuda=settings.CUDA_ENABLED):
+                       enable_cuda=settings.CUDA_ENABLED,
+                       network=None,
+                       inference_backend=settings.INFERENCE_BACKEND,
+                       inference_precision=settings.INFERENCE_PRECISION):
         """
             Initializes the face-feature extraction CNN model
             Arguments:
@@ -35,6 +96,13 @@ class FaceFeatureExtractor(object):
                 feature_layer: name of the layer from where to extract the features
                 feature_vector_size: the length of the feature vector output by the CNN
                 enable_cuda: boolean indicating whether CUDA must be used for the extraction of the features
+                network: an already loaded model, e.g. one returned by load_shared_network(). If None,
+                         the model is loaded from model_weights.
+                inference_backend: 'eager' to use the original PyTorch model, or 'torchscript' or 'onnx'
+                                   to use the model exported from it with modelutils.py
+                inference_precision: 'float32', 'bfloat16' or 'int8'. With 'bfloat16', the CNN is evaluated
+                                     with automatic mixed precision. With 'int8', the model quantized with
+                                     modelutils.py is used.
         """
         self.is_cuda_enable = enable_cuda
         self.model_weights = model_weights
@@ -42,17 +110,47 @@ class FaceFeatureExtractor(object):
         self.feature_layer = feature_layer
         self.feature_vector_size = feature_vector_size
         self.net_lock = multiprocessing.Lock()
+        self.inference_backend = inference_backend
+        self.inference_precision = inference_precision
 
-        # Load model here
-        self.network = model.Senet50_256()
+        # Load model here, unless it was already loaded
         self.device = torch.device('cpu' if not self.is_cuda_enable else 'cuda')
-        if not self.is_cuda_enable:
-            pretrained_dict = torch.load(self.model_weights, map_location=lambda storage, loc: storage)
+        if network is not None:
+            self.network = network
+        else:
+            self.network = load_network(self.model_weights, self.is_cuda_enable, self.inference_backend, self.inference_precision)
+        # the exported models do not keep the metadata of the original model, so it is saved separately
+        if not modelutils.is_exported_model(self.inference_backend, self.inference_precision):
+            self.mean = self.network.meta['mean']
         else:
-            pretrained_dict = torch.load(self.model_weights, map_location=lambda storage, loc: storage.cuda(self.device))
-        self.network.load_state_dict(pretrained_dict)
-        self.network.eval()
-        self.network = self.network.to(self.device)
+            self.mean = numpy.array(modelutils.load_exported_meta(modelutils.get_features_model_name(self.model_weights))['mean'])
+
+
+    def prepare_input_(self, image):
+        """
+            Converts an image to the input expected by the CNN
+            Arguments:
+                image: input image
+            Returns:
+                A tensor with the image, ready to be input to the CNN
+        """
+        # the input to the network is NETWORK_INPUT_SIZE, so we need to resize the image.
+        # Unfortunately, the resizing has to be done with Pillow to follow
+        # a similar procedure to
+        # https://github.com/ox-vgg/vgg_face2/blob/master/standard_evaluation/pytorch_feature_extractor.py
+        # or the results are not the same because the resizing results with
+        # skimage are different
+
+        pil_img = PIL.Image.fromarray(image)
+        pil_img = pil_img.resize(size=(NETWORK_INPUT_SIZE, NETWORK_INPUT_SIZE), resample=PIL.Image.BILINEAR)
+
+        # now we can convert back to numpy to continue
+        img_prepared = numpy.array(pil_img)
+        img_prepared = img_prepared - self.mean
+        im_array = numpy.array([img_prepared])
+        img_torch = torch.Tensor(im_array.transpose(0, 3, 1, 2))
+        img_torch = img_torch.to(self.device)
+        return img_torch
 
 
     def feature_compute(self, image):
@@ -66,46 +164,74 @@ class FaceFeatureExtractor(object):
                 A 1D normalized vector with the length specified when the object was instantiated
                 Returns None in case of error
         """
-        if numpy.all(image != None):
+        return self.feature_compute_batch([image])[0]
 
-            try:
 
-                # the input to the network is 224x224, so we need to resize the image.
-                # Unfortunately, the resizing has to be done with Pillow to follow
-                # a similar procedure to
-                # https://github.com/ox-vgg/vgg_face2/blob/master/standard_evaluation/pytorch_feature_extractor.py
-                # or the results are not the same because the resizing results with
-                # skimage are different
+    def feature_compute_batch(self, images):
+        """
+            Computes the vectors of face-features of several images with a single evaluation of the CNN.
+            If the evaluation fails, the images are evaluated one by one.
+            Arguments:
+                images: list of input images
+            Returns:
+                A list with the result of feature_compute() for each image, in the same order as the images
+        """
+        results = [ None ] * len(images)
+        valid_indexes = [ idx for idx in range(len(images)) if numpy.all(images[idx] != None) ]
+        if len(valid_indexes) > 0:
+
+            try:
 
-                pil_img = PIL.Image.fromarray(image)
-                pil_img = pil_img.resize(size=(244, 244), resample=PIL.Image.BILINEAR)
+                feats = self.compute_stacked_([ images[idx] for idx in valid_indexes ])
+                for batch_idx, idx in enumerate(valid_indexes):
+                    results[idx] = feats[batch_idx]
 
-                # now we can convert back to numpy to continue
-                img_prepared = numpy.array(pil_img)
-                img_prepared = img_prepared - self.network.meta['mean']
-                im_array = numpy.array([img_prepared])
-                img_torch = torch.Tensor(im_array.transpose(0, 3, 1, 2))
-                img_torch = img_torch.to(self.device)
+            except Exception as e:
+                print ('Exception in FaceFeatureExtractor: ' + str(e))
+                if len(valid_indexes) > 1:
+                    # do not lose the features of the whole batch because of one of the images
+                    for idx in valid_indexes:
+                        try:
+                            results[idx] = self.compute_stacked_([ images[idx] ])[0]
+                        except Exception as e:
+                            print ('Exception in FaceFeatureExtractor: ' + str(e))
+                            pass
 
-                # lock acquire
-                self.net_lock.acquire()
+        return results
 
-                # evaluate input
-                feat = self.network(img_torch)[1].detach().cpu().numpy()[: , :, 0, 0]
 
-                # make sure the output is a simple 1D vector
-                feat = numpy.reshape(feat, self.feature_vector_size)
+    def compute_stacked_(self, images):
+        """
+            Computes the vectors of face-features of several images with a single evaluation of the CNN
+            Arguments:
+                images: list of input images. None of them can be None.
+            Returns:
+                A 2D array with the normalized vector of each image in its rows
+        """
+        img_torch = torch.cat([ self.prepare_input_(image) for image in images ])
 
-                # lock release
-                self.net_lock.release()
+        # evaluate input
+        with self.net_lock:
+            with modelutils.inference_context(self.inference_precision, self.device):
+                feats = self.network(img_torch)[1]
+        feats = feats.detach().float().cpu().numpy()[: , :, 0, 0]
 
-                # normalize
-                feat = feat / numpy.sqrt(numpy.sum(feat ** 2, -1, keepdims=True))
+        # make sure the output is a list of simple 1D vectors
+        feats = numpy.reshape(feats, (len(images), self.feature_vector_size))
 
-                return feat
+        # normalize
+        feats = feats / numpy.sqrt(numpy.sum(feats ** 2, -1, keepdims=True))
+        return feats
 
-            except Exception as e:
-                print ('Exception in FaceFeatureExtractor: ' + str(e))
-                pass
 
-        return None
+    def warm_up(self, num_passes=settings.WARMUP_NUM_PASSES):
+        """
+            Runs a few forward passes of the CNN, so that the lazy initialization done
+            by the framework does not slow down the first real request
+            Arguments:
+                num_passes: number of forward passes to run
+        """
+        # use the size of the input of the network, as in prepare_input_()
+        image = numpy.random.randint(0, 256, size=(NETWORK_INPUT_SIZE, NETWORK_INPUT_SIZE, 3), dtype=numpy.uint8)
+        for idx in range(num_passes):
+            self.feature_compute(image)
@@ -4,22 +4,64 @@ __copyright__   = 'April 2018'
 import os
 import fileinput
 import multiprocessing
+import threading
 import numpy
 import simplejson as json
 import time
-from scipy.spatial import distance as df
-import pickle
 import traceback
+import queue
 
 import imutils
 import settings
+import cpuutils
+import face_database
 # import face detector
 import face_detection_retinaface
 # import face feature extractor
 import face_features
 
-if settings.KDTREES_RANKING_ENABLED:
-    import kdutils
+# possible values of the status reported by selfTest()
+STATUS_LOADING = 'loading'
+STATUS_WARMING = 'warming'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+# requests that can be served before the engine is ready
+PRE_READY_FUNCTIONS = ['selfTest', 'testFunc']
+
+# feature extractor of each helper worker, created once when the worker starts
+worker_feature_extractor = None
+
+def init_helper_worker(ready_counter, shared_network, worker_cores_queue, all_worker_cores):
+    """
+        Initializes a process of the pool of helper workers. Makes the process use the cores assigned
+        to it, creates the feature extractor of the process and runs a few forward passes with it,
+        so that requests do not have to wait for it.
+        Arguments:
+            ready_counter: shared counter incremented once the worker is initialized
+            shared_network: feature extraction model with its weights in shared memory, or None
+                            if the worker must load its own model
+            worker_cores_queue: queue with the list of cores of each worker
+            all_worker_cores: list of the cores of all workers, used when the queue is empty
+    """
+    global worker_feature_extractor
+    try:
+        # wait a bit, the items put in the queue by the parent process might not have arrived yet
+        cores = worker_cores_queue.get(True, 5)
+    except queue.Empty:
+        # this worker replaces one that has finished, whose cores are unknown
+        cores = all_worker_cores
+    cpuutils.apply_cpu_plan(cores)
+    try:
+        worker_feature_extractor = face_features.FaceFeatureExtractor(network=shared_network)
+        worker_feature_extractor.warm_up()
+    except Exception as e:
+        # group_feature_extractor() will try again to create the feature extractor
+        print ('Exception in init_helper_worker: ' + str(e))
+        worker_feature_extractor = None
+    with ready_counter.get_lock():
+        ready_counter.value = ready_counter.value + 1
+
 
 def group_feature_extractor(image_list):
     """
@@ -31,11 +73,14 @@ def group_feature_extractor(image_list):
                         file to be processed and "roi" the coordinates of the bounding-box of a face detected on
                         the image.
     """
+    global worker_feature_extractor
     list_of_feats = []
     if len(image_list) > 0:
         try:
-            # init feature extractor
-            feature_extractor = face_features.FaceFeatureExtractor()
+            # init feature extractor, unless the worker already has one
+            if worker_feature_extractor == None:
+                worker_feature_extractor = face_features.FaceFeatureExtractor()
+            feature_extractor = worker_feature_extractor
             for image in image_list:
                 # read image
                 theim = imutils.acquire_image(image["path"])
@@ -61,66 +106,135 @@ class FaceRetrieval(object):
         Class implementing the face-search engine.
     """
 
-    def __init__(self):
+    def __init__(self, staged_start=False):
         """
             Initializes the engine.
-            Loads into memory the database of features, which should have been computed beforehand.
-            Instantiates the face detector, the thread pool and other useful members.
+            Unless staged_start is True, it also calls initialize() to load the rest of the engine.
+            Arguments:
+                staged_start: boolean indicating whether initialize() will be called later by the
+                              caller, e.g. from another thread, instead of from here
         """
         self.query_id = 0
         self.query_id_lock = multiprocessing.Lock()
-        self.worker_pool = multiprocessing.Pool(processes=settings.NUMBER_OF_HELPER_WORKERS)
-        self.database = {'paths': [], 'rois': [], 'feats': []}
-        self.kdtrees = []
+        self.status = STATUS_LOADING
+        self.workers_ready = multiprocessing.Value('i', 0)
+        self.worker_pool = None
         self.query_data = dict()
-        self.face_detector = face_detection_retinaface.FaceDetectorRetinaFace()
+        self.face_detector = None
+        self.databases = face_database.FaceDatabaseRegistry()
+        if not staged_start:
+            self.initialize()
 
-        if settings.KDTREES_RANKING_ENABLED:
-            print ('Ranking with kdtrees is enabled')
-            if os.path.exists(settings.KDTREES_FILE):
-                print ('Found precomputed kdtrees...')
-                self.kdtrees = kdutils.load_kdtrees(settings.KDTREES_FILE)
-            else:
-                print ('DID NOT find precomputed kdtrees. The dataset features will not be accessible via kd-trees.')
-
-        print ('Loading dataset...')
-        # acquire dataset information the old-fashion way
-        with open(settings.DATASET_FEATS_FILE, 'rb') as fin:
-            database_content = pickle.load(fin)
-            if isinstance(database_content, dict):
-                if len(self.kdtrees)==0:
-                    if 'feats' in database_content.keys():
-                        self.database['feats'].extend(database_content['feats'])
-                    else:
-                        raise Exception('The features cannot be found. Please check your settings.')
-                self.database['paths'].extend(database_content['paths'])
-                self.database['rois'].extend(database_content['rois'])
-            elif isinstance(database_content, list):
-                for entry in database_content:
-                    print ('Loading sub-dataset ' +  entry )
-                    if os.path.sep not in entry:
-                        # in this case, assume it is in the same directory as the DATASET_FEATS_FILE
-                        sub_database = os.path.join(os.path.dirname(settings.DATASET_FEATS_FILE), entry)
-                    else:
-                        sub_database = entry
-                    with open(sub_database, 'rb') as fin_chunk:
-                        database_chunk_content = pickle.load(fin_chunk)
-                    if len(self.kdtrees)==0:
-                        if 'feats' in database_chunk_content.keys():
-                             self.database['feats'].extend(database_chunk_content['feats'])
-                        else:
-                            raise Exception('The features cannot be found. Please check your settings.')
-                    self.database['paths'].extend(database_chunk_content['paths'])
-                    self.database['rois'].extend(database_chunk_content['rois'])
-            else:
-                raise Exception('Cannot initialize FaceRetrieval. File %s contains corrupted information.' % settings.DATASET_FEATS_FILE)
 
-        print ('Loaded database for %d tracks' % len(self.database['paths']))
+    def initialize(self):
+        """
+            Loads into memory the database of features of the default dataset, which should have been computed beforehand.
+            The rest of the datasets are loaded on demand.
+            Instantiates the face detector and the pool of helper workers, warms up the networks, starts the
+            background threads and waits for the helper workers to be ready. The status reported by selfTest() goes from 'loading'
+            to 'warming' and then to 'ready', or to 'failed' if something goes wrong.
+        """
+        try:
+            # load the weights of the feature extractor only once, in shared memory, and let all the
+            # helper workers use them. Loading the weights is quick, so do it before anything else to
+            # let the workers warm up while the rest is loaded.
+            shared_network = face_features.load_shared_network()
+            # give each helper worker its own cores, to prevent their threads from competing for the
+            # same cores, and keep some cores for the ranking and the socket server
+            cpu_plan = cpuutils.plan_cpu_usage(settings.NUMBER_OF_HELPER_WORKERS)
+            worker_cores_queue = multiprocessing.Queue()
+            for cores in cpu_plan['workers']:
+                worker_cores_queue.put(cores)
+            all_worker_cores = sorted(set([ core for cores in cpu_plan['workers'] for core in cores ]))
+            self.worker_pool = multiprocessing.Pool(processes=settings.NUMBER_OF_HELPER_WORKERS, initializer=init_helper_worker,
+                                                    initargs=(self.workers_ready, shared_network, worker_cores_queue, all_worker_cores))
+
+            self.face_detector = face_detection_retinaface.FaceDetectorRetinaFace()
+
+            # load the default dataset right away, so that problems with it are found at start-up
+            self.databases.release(self.databases.acquire(settings.DEFAULT_DATASET_NAME))
+
+            # now that the processes loading the dataset are done, keep the main process on its cores.
+            # This method runs in its own thread, so pin all the threads of the process, including the
+            # one that starts the threads serving the requests.
+            cpuutils.apply_cpu_plan(cpu_plan['main'], all_threads=True)
+
+            # start the background merging of ingested faces into the main databases
+            self.merge_thread = threading.Thread(target=self.merge_worker_)
+            self.merge_thread.daemon = True
+            self.merge_thread.start()
+
+            # start watching the database files for changes, if enabled
+            if settings.DATABASE_WATCH_INTERVAL > 0:
+                self.watch_thread = threading.Thread(target=self.watch_worker_)
+                self.watch_thread.daemon = True
+                self.watch_thread.start()
+
+            self.status = STATUS_WARMING
+            print ('Warming up the face detector')
+            t = time.time()
+            self.face_detector.warm_up()
+            print ('Done warming up the face detector in t=%f' % (time.time() - t))
+
+            # the helper workers warm up their feature extractor when they start. A worker that dies
+            # while starting is replaced, but it might keep dying, so do not wait forever.
+            deadline = time.time() + settings.HELPER_WORKERS_READY_TIMEOUT
+            while self.workers_ready.value < settings.NUMBER_OF_HELPER_WORKERS:
+                if time.time() > deadline:
+                    raise Exception('Only %d of %d helper workers were ready after %d seconds' %
+                                    (self.workers_ready.value, settings.NUMBER_OF_HELPER_WORKERS, settings.HELPER_WORKERS_READY_TIMEOUT))
+                time.sleep(0.1)
+            print ('All helper workers are ready')
+
+            self.status = STATUS_READY
+            print ('FaceRetrieval successfully initialized')
+        except Exception as e:
+            self.status = STATUS_FAILED
+            print ('Exception while initializing FaceRetrieval: ' + str(e))
+            print (traceback.format_exc())
 
-        # do one load of this to get things into the cache
-        feature_extractor = face_features.FaceFeatureExtractor()
 
-        print ('FaceRetrieval successfully initialized')
+    def merge_worker_(self):
+        """
+            Body of the thread that periodically merges the faces added with ingest()
+            into the main database of each loaded dataset
+        """
+        while True:
+            time.sleep(settings.INGEST_MERGE_INTERVAL)
+            for database in self.databases.loaded_databases():
+                if database.has_pending_changes():
+                    try:
+                        database.merge_delta_segments(settings.INGEST_PERSIST_MERGED_SEGMENTS)
+                    except Exception as e:
+                        print ('Exception while merging dataset %s: %s' % (database.name, str(e)))
+                        print (traceback.format_exc())
+
+
+    def watch_worker_(self):
+        """
+            Body of the thread that periodically checks whether the files of the loaded
+            datasets have been modified, and reloads them if so. A dataset is only reloaded
+            once its files have not changed for a whole DATABASE_WATCH_INTERVAL, to avoid
+            loading files that are still being written.
+        """
+        pending_signatures = dict()
+        while True:
+            time.sleep(settings.DATABASE_WATCH_INTERVAL)
+            for database in self.databases.loaded_databases():
+                if not database.files_changed():
+                    pending_signatures.pop(database.name, None)
+                    continue
+                signature = face_database.get_files_signature(database.feats_file, database.kdtrees_file)
+                if pending_signatures.get(database.name, None) == signature:
+                    print ('Detected new version of dataset ' + database.name)
+                    del pending_signatures[database.name]
+                    try:
+                        self.databases.reload(database.name)
+                    except Exception as e:
+                        print ('Exception while reloading dataset %s: %s' % (database.name, str(e)))
+                        print (traceback.format_exc())
+                else:
+                    pending_signatures[database.name] = signature
 
 
     def prepare_success_json_str_(self, success):
@@ -138,14 +252,16 @@ class FaceRetrieval(object):
 
     def selfTest(self, req_params):
         """
-            Simple test function that will return the same JSON object as in the parameter
+            Simple test function that reports whether the server is running
             Parameters:
                 req_params: JSON object
             Returns:
-                JSON formatted string
+                JSON formatted string with the fields 'success' and 'status'. The 'status'
+                is one of 'loading', 'warming', 'ready' or 'failed'. Requests other than
+                selfTest are only served when the status is 'ready'.
         """
-        print ('Server is running')
-        return self.prepare_success_json_str_(True)
+        print ('Server is running. Status: ' + self.status)
+        return json.dumps({'success': True, 'status': self.status})
 
 
     def getQueryId(self, req_params):
@@ -631,6 +747,14 @@ class FaceRetrieval(object):
             Parameters:
                 req_params: JSON object with at least the field:
                             - query_id: the id of the query
+                            Other fields include:
+                            - max_distance: if specified and greater than zero, only the faces within this
+                                            distance of the query are returned (range search).
+                                            Default: RANGE_SEARCH_MAX_DISTANCE
+                            - max_results: maximum number of results to be returned. Default: MAX_RESULTS_RETURN,
+                                           or no limit in the case of a range search
+                            - filter: dictionary restricting the search to a part of the database. See
+                                      filterutils.RowFilterIndex.resolve() for the supported fields.
             Returns:
                 JSON formatted string with 'success' field set to 'False'
                 in case of any problems. The 'success' field set to 'True'
@@ -641,57 +765,58 @@ class FaceRetrieval(object):
         else:
             return self.prepare_success_json_str_(False)
 
-        query_id = str(query_id)
-        print ('Ranking Data')
+        max_distance = settings.RANGE_SEARCH_MAX_DISTANCE
+        if 'max_distance' in req_params:
+            max_distance = float(req_params['max_distance'])
 
-        if settings.KDTREES_RANKING_ENABLED:
-            bests = []
-            accum_len = 0
-            # split number of results among kdtrees to create smaller sublists of results ...
-            max_results_num_splitted = (settings.MAX_RESULTS_RETURN*1.0)/len(self.kdtrees)
-            # ... but always get one more element to avoid rounding errors when converting
-            # to int, and this does not harm the sorting process.
-            max_results_num_splitted = int(max_results_num_splitted + 1)
-            for idx in range(len(self.kdtrees)):
-                dd, ii = self.kdtrees[idx].query(self.query_data[query_id]["features"], k=max_results_num_splitted)
-                for idx2 in range(max_results_num_splitted):
-                    bests.append( ( dd[0][idx2], ii[0][idx2] + accum_len ) )
-                accum_len = accum_len + self.kdtrees[idx].n
-            bests_sorted = numpy.array(bests, dtype=[('dist', float), ('idx', int)])
-            bests_sorted.sort(order='dist')
-            ranking_indexes = [ item[1] for item in bests_sorted[0:settings.MAX_RESULTS_RETURN] ]
-            dst = [ item[0] for item in bests_sorted[0:settings.MAX_RESULTS_RETURN] ]
+        if 'max_results' in req_params:
+            max_results = int(req_params['max_results'])
+        elif max_distance > 0:
+            max_results = -1
         else:
-            dst = df.cdist(self.database['feats'], self.query_data[query_id]["features"])
-            ranking_indexes = numpy.argsort(dst, axis=None)
-            ranking_indexes = ranking_indexes[0:settings.MAX_RESULTS_RETURN]
-
-        print ('Done computing distances')
-
-        ranking_list = []
-        for i in range(len(ranking_indexes)):
-            idx = ranking_indexes[i]
-            ranking_dict = {}
-            ranking_dict['path'] = self.database['paths'][idx]
-            det = self.database['rois'][idx]
-            roi_str = '%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f' % (
-                    # x1  , y1   ,  x2  ,  y1   ,x2    ,y2    ,x1    ,y2    ,x1    ,y1
-                    det[0], det[1], det[2], det[1], det[2], det[3], det[0], det[3], det[0], det[1])
-            ranking_dict['roi'] = roi_str
-            if settings.KDTREES_RANKING_ENABLED:
-                ranking_dict['score'] = dst[i]
+            max_results = settings.MAX_RESULTS_RETURN
+        if max_results <= 0:
+            if max_distance > 0:
+                # no limit on the number of results of a range search
+                max_results = -1
             else:
-                ranking_dict['score'] = dst[idx][0]
-            # change the score of all "bad" results according to the MAX_RESULTS_SCORE settings,
-            # but only if it is enable (i.e. MAX_RESULTS_SCORE > 0 )
-            if settings.MAX_RESULTS_SCORE > 0 and ranking_dict['score'] > settings.MAX_RESULTS_SCORE:
-                ranking_dict['score'] = -1
-            # check underlying type of results and
-            # remove one dimension if necessary
-            # for compatibility with json.dumps
-            if isinstance(ranking_dict['path'], numpy.ndarray):
-                ranking_dict['path'] = ranking_dict['path'][0]
-            ranking_list.append(ranking_dict)
+                print ('Invalid max_results %d without max_distance, using %d' % (max_results, settings.MAX_RESULTS_RETURN))
+                max_results = settings.MAX_RESULTS_RETURN
+
+        query_id = str(query_id)
+        print ('Ranking Data')
+
+        if max_distance > 0:
+            print ('Range search within distance %f' % max_distance)
+
+        filter_params = None
+        if 'filter' in req_params:
+            filter_params = req_params['filter']
+
+        database = self.databases.acquire(self.query_data[query_id]["dataset"])
+        try:
+            ranking_indexes, dst = database.search(self.query_data[query_id]["features"], filter_params, max_distance, max_results)
+
+            print ('Done computing distances')
+
+            ranking_list = []
+            for i in range(len(ranking_indexes)):
+                idx = ranking_indexes[i]
+                ranking_dict = {}
+                ranking_dict['path'] = database.get_path(idx)
+                det = database.get_roi(idx)
+                roi_str = '%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f_%0.2f' % (
+                        # x1  , y1   ,  x2  ,  y1   ,x2    ,y2    ,x1    ,y2    ,x1    ,y1
+                        det[0], det[1], det[2], det[1], det[2], det[3], det[0], det[3], det[0], det[1])
+                ranking_dict['roi'] = roi_str
+                ranking_dict['score'] = float(dst[i])
+                # change the score of all "bad" results according to the MAX_RESULTS_SCORE settings,
+                # but only if it is enable (i.e. MAX_RESULTS_SCORE > 0 )
+                if settings.MAX_RESULTS_SCORE > 0 and ranking_dict['score'] > settings.MAX_RESULTS_SCORE:
+                    ranking_dict['score'] = -1
+                ranking_list.append(ranking_dict)
+        finally:
+            self.databases.release(database)
 
         self.query_data[query_id]["rankings"] = ranking_list
 
@@ -734,6 +859,212 @@ class FaceRetrieval(object):
             return self.prepare_success_json_str_(False)
 
 
+    def ingest(self, req_params):
+        """
+            Adds new images to a dataset, using the models already loaded by the engine.
+            The faces found in the images can be searched as soon as this method returns.
+            They are merged into the main database in the background every INGEST_MERGE_INTERVAL seconds.
+            Parameters:
+                req_params: JSON object with at least the field:
+                            - impaths: list of full paths to the images to be added
+                            Other fields include:
+                            - dataset: name of the dataset to add the images to. Default: DEFAULT_DATASET_NAME
+                            - base_path: base path of the images in the dataset. If specified, the paths
+                                         stored in the database will be relative to it.
+            Returns:
+                JSON formatted string with 'success' field set to 'False'
+                in case of any problems. Otherwise, the JSON will contain the 'success'
+                field set to 'True', the number of faces added ('num_faces') and the
+                row id of the first of them ('first_id').
+        """
+        if 'impaths' in req_params:
+            impaths = req_params['impaths']
+        else:
+            return self.prepare_success_json_str_(False)
+
+        dataset = settings.DEFAULT_DATASET_NAME
+        if 'dataset' in req_params:
+            dataset = req_params['dataset']
+        if not self.databases.is_known(dataset):
+            # do not modify the default dataset by mistake
+            print ('Unknown dataset %s' % dataset)
+            return self.prepare_success_json_str_(False)
+
+        base_path = None
+        if 'base_path' in req_params:
+            base_path = req_params['base_path']
+
+        t = time.time()
+
+        # run face detector over all images
+        faces = []
+        for impath in impaths:
+            theim = imutils.acquire_image(impath)
+            detections = self.face_detector.detect_faces(theim)
+            if numpy.all(detections != None):
+                for det in detections:
+                    # The coordinates should be already integers, but some basic
+                    # conversion is need for compatibility with all face detectors.
+                    # Plus we have to get rid of the detection score det[4]
+                    det = [int(det[0]), int(det[1]), int(det[2]), int(det[3])]
+                    faces.append({'path': impath, 'roi': det})
+        print ('Found %d faces in %d images' % (len(faces), len(impaths)))
+
+        if len(faces) == 0:
+            return json.dumps({'success': True, 'num_faces': 0, 'first_id': -1})
+
+        try:
+            # distribute faces among helper workers
+            num_faces_per_worker = (len(faces) + settings.NUMBER_OF_HELPER_WORKERS - 1) // settings.NUMBER_OF_HELPER_WORKERS
+            faces_groups = [ faces[idx:idx+num_faces_per_worker] for idx in range(0, len(faces), num_faces_per_worker) ]
+            results = self.worker_pool.map_async(group_feature_extractor, faces_groups).get(settings.FEATURES_EXTRACTION_TIMEOUT*num_faces_per_worker)
+        except Exception as e:
+            print ('Exception while computing features: ' +  str(e))
+            print (traceback.format_exc())
+            return self.prepare_success_json_str_(False)
+
+        feats = []
+        for idx in range(len(faces_groups)):
+            if len(results[idx]) != len(faces_groups[idx]):
+                print ('Failed computing the features of some faces. Aborting ingestion.')
+                return self.prepare_success_json_str_(False)
+            feats.extend(results[idx])
+
+        paths = []
+        for face in faces:
+            if base_path:
+                paths.append(os.path.relpath(face['path'], base_path))
+            else:
+                paths.append(face['path'])
+        rois = [ face['roi'] for face in faces ]
+
+        first_id = None
+        while first_id is None:
+            # if the dataset is reloaded in the meantime, add the faces to its new version
+            database = self.databases.acquire(dataset)
+            try:
+                first_id = database.add_delta_segment(paths, rois, numpy.concatenate(feats))
+            finally:
+                self.databases.release(database)
+
+        print ('Done ingesting images ' + str(time.time() - t))
+        return json.dumps({'success': True, 'num_faces': len(faces), 'first_id': first_id})
+
+
+    def deleteFaces(self, req_params):
+        """
+            Deletes faces from a dataset. The deletion is effective immediately for all
+            subsequent searches. Deleted faces are only removed from the database files
+            after running compact_database() in databaseutils.py.
+            Parameters:
+                req_params: JSON object with at least one of the fields:
+                            - paths: list of image paths, as stored in the database. All faces in these images are deleted.
+                            - path_prefix: a path prefix or list of path prefixes. All faces in images
+                                           with a path starting with one of the prefixes are deleted.
+                            - ids: list of row ids of the faces to be deleted, as returned by 'ingest'
+                                   or used in the 'id_ranges' search filter.
+                            Other fields include:
+                            - dataset: name of the dataset. Default: DEFAULT_DATASET_NAME
+            Returns:
+                JSON formatted string with 'success' field set to 'False'
+                in case of any problems. Otherwise, the JSON will contain the 'success'
+                field set to 'True' and the number of faces deleted ('num_faces').
+        """
+        paths = []
+        if 'paths' in req_params:
+            paths = req_params['paths']
+
+        path_prefixes = []
+        if 'path_prefix' in req_params:
+            path_prefixes = req_params['path_prefix']
+            if not isinstance(path_prefixes, list):
+                path_prefixes = [ path_prefixes ]
+            if '' in path_prefixes:
+                print ('Refusing to delete faces with an empty path prefix')
+                return self.prepare_success_json_str_(False)
+
+        ids = []
+        if 'ids' in req_params:
+            ids = req_params['ids']
+
+        if len(paths) == 0 and len(path_prefixes) == 0 and len(ids) == 0:
+            return self.prepare_success_json_str_(False)
+
+        dataset = settings.DEFAULT_DATASET_NAME
+        if 'dataset' in req_params:
+            dataset = req_params['dataset']
+        if not self.databases.is_known(dataset):
+            # do not modify the default dataset by mistake
+            print ('Unknown dataset %s' % dataset)
+            return self.prepare_success_json_str_(False)
+
+        database = self.databases.acquire(dataset)
+        try:
+            rows = numpy.concatenate((database.find_rows(paths, path_prefixes), numpy.array(ids, dtype=int)))
+            num_deleted = database.delete_rows(rows)
+        except Exception as e:
+            print ('Exception while deleting faces: ' + str(e))
+            return self.prepare_success_json_str_(False)
+        finally:
+            self.databases.release(database)
+
+        return json.dumps({'success': True, 'num_faces': num_deleted})
+
+
+    def reloadDatabase(self, req_params):
+        """
+            Loads a new version of the database of a dataset in the background, while the current
+            version keeps serving requests. Once loaded, the new version replaces the current one.
+            Parameters:
+                req_params: JSON object with the optional fields:
+                            - dataset: name of the dataset. Default: DEFAULT_DATASET_NAME
+                            - feats_file: Full path to the new database file. Default: the current database file
+                            - kdtrees_file: Full path to the new kd-trees file. Default: the current kd-trees file
+                            - wait: boolean indicating whether to wait until the new version is loaded. Default: False
+            Returns:
+                JSON formatted string with 'success' field set to 'False'
+                in case of any problems. The 'success' field set to 'True'
+                otherwise. If 'wait' is False, 'success' only indicates that the
+                reload has started.
+        """
+        dataset = settings.DEFAULT_DATASET_NAME
+        if 'dataset' in req_params:
+            dataset = req_params['dataset']
+        if not self.databases.is_known(dataset):
+            # do not modify the default dataset by mistake
+            print ('Unknown dataset %s' % dataset)
+            return self.prepare_success_json_str_(False)
+
+        feats_file = None
+        if 'feats_file' in req_params:
+            feats_file = req_params['feats_file']
+            if not self.databases.is_allowed_file(dataset, feats_file):
+                print ('Refusing to load database file %s' % feats_file)
+                return self.prepare_success_json_str_(False)
+            if not os.path.exists(feats_file):
+                print ('Database file %s not found' % feats_file)
+                return self.prepare_success_json_str_(False)
+
+        kdtrees_file = None
+        if 'kdtrees_file' in req_params:
+            kdtrees_file = req_params['kdtrees_file']
+            if not self.databases.is_allowed_file(dataset, kdtrees_file):
+                print ('Refusing to load kd-trees file %s' % kdtrees_file)
+                return self.prepare_success_json_str_(False)
+
+        if 'wait' in req_params and req_params['wait']:
+            try:
+                return self.prepare_success_json_str_(self.databases.reload(dataset, feats_file, kdtrees_file))
+            except Exception as e:
+                print ('Exception while reloading dataset %s: %s' % (dataset, str(e)))
+                return self.prepare_success_json_str_(False)
+
+        reload_thread = threading.Thread(target=self.databases.reload, args=(dataset, feats_file, kdtrees_file))
+        reload_thread.daemon = True
+        reload_thread.start()
+        return self.prepare_success_json_str_(True)
+
+
     def testFunc(self, req_params):
         """
             Simple test function that will return the same JSON object as in the parameter
@@ -762,6 +1093,9 @@ class FaceRetrieval(object):
             req_params = json.loads(request)
             req_params['pid'] = pid
             if 'func' in req_params:
+                if self.status != STATUS_READY and req_params['func'] not in PRE_READY_FUNCTIONS:
+                    print ('Refusing request %s. Status: %s' % (req_params['func'], self.status))
+                    return json.dumps({'success': False, 'status': self.status})
                 method = getattr(self, req_params['func'])
                 if method:
                     rval = method(req_params)
@@ -0,0 +1,231 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import bisect
+import numpy
+
+# All the filters are resolved to lists of row ranges. Each range is a pair [start, end), so
+# the rows start, start+1, ..., end-1 are included in the range. The lists are always sorted
+# and the ranges in them never overlap.
+
+
+def ranges_from_rows(rows):
+    """
+        Converts a list of row indexes into a list of row ranges
+        Arguments:
+            rows: list or array of row indexes, in any order
+        Returns:
+            A sorted list of non-overlapping [start, end) row ranges covering the input rows
+    """
+    rows = numpy.unique(numpy.asarray(rows, dtype=numpy.int64))
+    if len(rows) == 0:
+        return []
+    # a new range begins wherever there is a gap between consecutive rows
+    breaks = numpy.flatnonzero(numpy.diff(rows) > 1)
+    starts = numpy.concatenate(([rows[0]], rows[breaks + 1]))
+    ends = numpy.concatenate((rows[breaks] + 1, [rows[-1] + 1]))
+    return [ (int(start), int(end)) for start, end in zip(starts, ends) ]
+
+
+def union_ranges(ranges):
+    """
+        Merges a list of row ranges into a list of non-overlapping row ranges
+        Arguments:
+            ranges: list of [start, end) row ranges, in any order and possibly overlapping
+        Returns:
+            A sorted list of non-overlapping [start, end) row ranges
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if end <= start:
+            continue
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def intersect_ranges(ranges_a, ranges_b):
+    """
+        Computes the intersection of two lists of row ranges
+        Arguments:
+            ranges_a: sorted list of non-overlapping [start, end) row ranges
+            ranges_b: sorted list of non-overlapping [start, end) row ranges
+        Returns:
+            A sorted list of non-overlapping [start, end) row ranges
+    """
+    result = []
+    idx_a = 0
+    idx_b = 0
+    while idx_a < len(ranges_a) and idx_b < len(ranges_b):
+        start = max(ranges_a[idx_a][0], ranges_b[idx_b][0])
+        end = min(ranges_a[idx_a][1], ranges_b[idx_b][1])
+        if start < end:
+            result.append((start, end))
+        if ranges_a[idx_a][1] < ranges_b[idx_b][1]:
+            idx_a = idx_a + 1
+        else:
+            idx_b = idx_b + 1
+    return result
+
+
+def count_rows(ranges):
+    """
+        Counts the number of rows in a list of non-overlapping row ranges
+        Arguments:
+            ranges: list of non-overlapping [start, end) row ranges
+        Returns:
+            The number of rows covered by the ranges
+    """
+    return sum([ end - start for start, end in ranges ])
+
+
+def row_blocks(ranges, block_size):
+    """
+        Splits a list of row ranges in blocks to be processed at once. Ranges with at least block_size
+        rows are split in [start, end) blocks, which can be sliced from a matrix without copying it. The
+        rest of the ranges, e.g. the many short ranges of interleaved paths, are grouped together in
+        arrays of row indexes, so that they are not processed one at a time.
+        Arguments:
+            ranges: list of non-overlapping [start, end) row ranges
+            block_size: maximum number of rows per block
+        Returns:
+            A generator of blocks. Each block is either a tuple (start, end) or an array of row indexes.
+    """
+    short_ranges = []
+    for start, end in ranges:
+        if end - start >= block_size:
+            for block_start in range(start, end, block_size):
+                yield (block_start, min(block_start + block_size, end))
+        elif end > start:
+            short_ranges.append((start, end))
+    if len(short_ranges) > 0:
+        starts = numpy.array([ start for start, end in short_ranges ], dtype=numpy.int64)
+        lengths = numpy.array([ end - start for start, end in short_ranges ], dtype=numpy.int64)
+        # the row indexes of all the ranges, without a loop over the ranges
+        range_offsets = numpy.cumsum(lengths) - lengths
+        rows = numpy.arange(lengths.sum(), dtype=numpy.int64) + numpy.repeat(starts - range_offsets, lengths)
+        for block_start in range(0, len(rows), block_size):
+            yield rows[block_start:block_start + block_size]
+
+
+class RowFilterIndex(object):
+    """
+        Class holding the metadata needed to evaluate search filters over the rows of a database.
+        It is built when the database is loaded, so that filters can be resolved to row ranges
+        without going through all the paths of the database on every search.
+    """
+
+    def __init__(self, paths, sub_databases, first_row=0):
+        """
+            Builds the index
+            Arguments:
+                paths: list with the path of the image corresponding to each row of the database
+                sub_databases: list of tuples (name, start, end), one per sub-database, indicating
+                               the [start, end) range of rows loaded from the sub-database
+                first_row: row id of the first element in paths. Use it to index a part of a
+                           database that does not start at row 0.
+        """
+        self.first_row = first_row
+        self.num_rows = len(paths)
+        self.sub_databases = {}
+        for name, start, end in sub_databases:
+            if name not in self.sub_databases:
+                self.sub_databases[name] = []
+            self.sub_databases[name].append((start, end))
+        # keep the rows sorted by path, so that all the rows sharing a path prefix can be found
+        # with a binary search
+        normalized_paths = [ self.normalize_path_(path) for path in paths ]
+        self.sorted_rows = numpy.argsort(numpy.array(normalized_paths, dtype=object), kind='mergesort')
+        self.sorted_paths = [ normalized_paths[row] for row in self.sorted_rows ]
+
+
+    def normalize_path_(self, path):
+        """
+            Returns the path as a plain string. Some databases store each path in a one-element array.
+            Arguments:
+                path: path stored in the database
+            Returns:
+                The path as a string
+        """
+        if isinstance(path, numpy.ndarray):
+            path = path[0]
+        return str(path)
+
+
+    def path_ranges(self, path):
+        """
+            Finds the rows with exactly the specified path
+            Arguments:
+                path: image path, as stored in the database
+            Returns:
+                A sorted list of non-overlapping [start, end) row ranges
+        """
+        lower = bisect.bisect_left(self.sorted_paths, path)
+        upper = bisect.bisect_right(self.sorted_paths, path, lower)
+        return ranges_from_rows(self.sorted_rows[lower:upper] + self.first_row)
+
+
+    def prefix_ranges(self, prefix):
+        """
+            Finds the rows with a path starting with the specified prefix
+            Arguments:
+                prefix: path prefix
+            Returns:
+                A sorted list of non-overlapping [start, end) row ranges
+        """
+        if len(prefix) == 0:
+            return [ (self.first_row, self.first_row + self.num_rows) ]
+        lower = bisect.bisect_left(self.sorted_paths, prefix)
+        upper_key = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        upper = bisect.bisect_left(self.sorted_paths, upper_key, lower)
+        return ranges_from_rows(self.sorted_rows[lower:upper] + self.first_row)
+
+
+    def resolve(self, filter_params):
+        """
+            Converts the filter specified in a request into a list of row ranges.
+            Arguments:
+                filter_params: dictionary with any of the following fields. Each field can
+                               contain a single value or a list of values. Values in the same
+                               field are OR-ed, while different fields are AND-ed.
+                               - path_prefix: prefix of the path of the images to be included
+                               - sub_database: name of a sub-database, as listed in the main database file
+                               - id_ranges: [start, end) range of row ids to be included
+            Returns:
+                A sorted list of non-overlapping [start, end) row ranges, or None if the
+                filter does not exclude any row
+        """
+        if not filter_params:
+            return None
+
+        result = [ (self.first_row, self.first_row + self.num_rows) ]
+
+        if 'path_prefix' in filter_params:
+            prefixes = filter_params['path_prefix']
+            if not isinstance(prefixes, list):
+                prefixes = [ prefixes ]
+            ranges = []
+            for prefix in prefixes:
+                ranges.extend(self.prefix_ranges(prefix))
+            result = intersect_ranges(result, union_ranges(ranges))
+
+        if 'sub_database' in filter_params:
+            names = filter_params['sub_database']
+            if not isinstance(names, list):
+                names = [ names ]
+            ranges = []
+            for name in names:
+                if name in self.sub_databases:
+                    ranges.extend(self.sub_databases[name])
+            result = intersect_ranges(result, union_ranges(ranges))
+
+        if 'id_ranges' in filter_params:
+            id_ranges = filter_params['id_ranges']
+            if len(id_ranges) == 2 and not isinstance(id_ranges[0], list):
+                id_ranges = [ id_ranges ]
+            ranges = [ (int(start), int(end)) for start, end in id_ranges ]
+            result = intersect_ranges(result, union_ranges(ranges))
+
+        return result
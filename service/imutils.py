@@ -1,9 +1,11 @@
 __author__      = 'Ernesto Coto'
 __copyright__   = 'April 2018'
 
+import numpy
 import skimage
 from skimage import io
 from skimage import color
+import PIL.Image
 
 def acquire_image(img_path):
     """
@@ -34,6 +36,60 @@ def acquire_image(img_path):
     return None
 
 
+def acquire_image_reduced(img_path, scale):
+    """
+        Utility function to read an image at a reduced size and convert it to RGB. JPEG images are
+        decoded directly at the reduced size, which is much faster than decoding them completely.
+        Arguments:
+           img_path: Full path to the image file to be read
+           scale: factor applied to the size of the image, e.g. 0.25. The size of the returned image
+                  is only approximately reduced by this factor.
+        Returns:
+           A tuple with an MxNx3 array with the contents of the reduced image in RGB format, and the
+           size (width, height) of the original image. Returns (None, None) in case of errors
+    """
+    try:
+        img = PIL.Image.open(img_path)
+        original_size = img.size
+        reduced_size = (max(1, int(img.size[0] * scale)), max(1, int(img.size[1] * scale)))
+        # let the JPEG decoder skip the detail not needed, then finish the resize
+        img.draft('RGB', reduced_size)
+        img = img.convert('RGB')
+        if img.size != reduced_size:
+            img = img.resize(reduced_size, PIL.Image.BILINEAR)
+        return numpy.asarray(img), original_size
+    except Exception as e:
+        print (e)
+        pass
+
+    return None, None
+
+
+def image_hash(img_path):
+    """
+        Utility function to compute the perceptual hash (dHash) of an image, which is the same for
+        resized and re-encoded copies of the image. JPEG images are decoded directly at a reduced
+        size, which is much faster than decoding them completely.
+        Arguments:
+           img_path: Full path to the image file to be read
+        Returns:
+           The 64-bit hash as a non-negative integer. Returns None in case of errors
+    """
+    try:
+        img = PIL.Image.open(img_path)
+        # let the JPEG decoder skip the detail not needed, then reduce the image to 9x8 pixels
+        img.draft('L', (64, 64))
+        pixels = numpy.asarray(img.convert('L').resize((9, 8), PIL.Image.BILINEAR), dtype=numpy.int16)
+        # one bit per pair of horizontally adjacent pixels, set if the intensity increases
+        bits = numpy.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel())
+        return int.from_bytes(bits.tobytes(), 'big')
+    except Exception as e:
+        print (e)
+        pass
+
+    return None
+
+
 def save_image(img, img_path):
     """
         Utility function to save an image to a local path.
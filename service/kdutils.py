@@ -5,6 +5,7 @@ from scipy.spatial import cKDTree
 import dill # used for saving the kd-trees
 import time
 import os
+import multiprocessing
 
 
 def build_kdtrees(feats, split_size, thead_pool, filename):
@@ -25,7 +26,7 @@ def build_kdtrees(feats, split_size, thead_pool, filename):
         num_feats = len(feats)
         splitted_feats = []
         if num_feats > split_size:
-            NUM_DATASET_SPLITS = num_feats/split_size
+            NUM_DATASET_SPLITS = num_feats//split_size
             for idx in range(NUM_DATASET_SPLITS):
                 if idx < NUM_DATASET_SPLITS-1:
                     splitted_feats.append(feats[idx*split_size:(idx+1)*split_size])
@@ -45,12 +46,30 @@ def build_kdtrees(feats, split_size, thead_pool, filename):
         pass
 
 
-def load_kdtrees(filename):
+def load_kdtrees_file(filename):
+    """
+        Load the list of kd-trees stored in a single kd-trees file.
+        Parameters:
+            filename: Full path and name to the file storing the kd-trees
+        Returns:
+            A list of kd-tree objects
+    """
+    with open(filename, 'rb') as fin:
+        return dill.load(fin)
+
+
+def load_kdtrees(filename, num_workers=1, timeout=None, worker_initializer=None):
     """
         Load a list of kd-trees from the specified file.
         Parameters:
             filename: Full path and name to the resulting file storing
                       the kd-trees
+            num_workers: Number of processes used to load the sub-kdtree
+                         files, when the file contains a list of them
+            timeout: Number of seconds to wait for a process to load a sub-kdtree
+                     file, or None to wait forever
+            worker_initializer: function run by each of the processes loading
+                                the sub-kdtree files when it starts, or None
         Returns:
             A list of kd-tree objects
     """
@@ -62,15 +81,35 @@ def load_kdtrees(filename):
                 kdtrees_file_content = dill.load(fin)
                 if len(kdtrees_file_content)>0:
                     if isinstance(kdtrees_file_content[0], str):
+                        sub_kdtrees = []
                         for entry in kdtrees_file_content:
                             if os.path.sep not in entry:
                                 # in this case, assume it is in the same directory as the file specified in the parameter
-                                sub_kdtree = os.path.join(os.path.dirname(filename), entry)
+                                sub_kdtrees.append(os.path.join(os.path.dirname(filename), entry))
                             else:
-                                sub_kdtree = entry
-                            print ('Loading sub-kdtree file ' + sub_kdtree)
-                            with open(sub_kdtree, 'rb') as fin_sub_kdtree:
-                                kdtrees.extend( dill.load(fin_sub_kdtree) )
+                                sub_kdtrees.append(entry)
+                        num_workers = min(num_workers, len(sub_kdtrees))
+                        if num_workers > 1:
+                            worker_pool = multiprocessing.Pool(processes=num_workers, initializer=worker_initializer)
+                            try:
+                                # the results are taken in the order of the files, so the kd-trees are in the same
+                                # order as the rows. Do not wait forever for a loading process that died.
+                                pending_results = [ worker_pool.apply_async(load_kdtrees_file, (sub_kdtree,)) for sub_kdtree in sub_kdtrees ]
+                                for idx, pending_result in enumerate(pending_results):
+                                    try:
+                                        sub_kdtree_content = pending_result.get(timeout)
+                                    except multiprocessing.TimeoutError:
+                                        raise Exception('Timeout while loading %s. The loading process might have died.' % sub_kdtrees[idx])
+                                    kdtrees.extend(sub_kdtree_content)
+                                    print ('Loaded sub-kdtree file %d/%d' % (idx + 1, len(sub_kdtrees)))
+                                worker_pool.close()
+                            finally:
+                                worker_pool.terminate()
+                                worker_pool.join()
+                        else:
+                            for sub_kdtree in sub_kdtrees:
+                                print ('Loading sub-kdtree file ' + sub_kdtree)
+                                kdtrees.extend( load_kdtrees_file(sub_kdtree) )
                     else:
                         kdtrees.extend( kdtrees_file_content )
                 else:
@@ -0,0 +1,529 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import os
+import copy
+import argparse
+import contextlib
+import simplejson as json
+import numpy
+import torch
+from scipy.spatial import distance as df
+
+import settings
+
+# thresholds used by check_parity()
+PARITY_MAX_BOX_DIFFERENCE = 2.0 # pixels
+PARITY_MAX_SCORE_DIFFERENCE = 0.01
+PARITY_MIN_FEATURES_COSINE = 0.999
+
+# settings used by quantize_models()
+QUANTIZATION_ENGINE = 'fbgemm'
+QUANTIZATION_MAX_CALIBRATION_FACES = 500
+
+# size of the example inputs used when exporting the models, as (height, width)
+FEATURES_EXPORT_INPUT_SIZE = (244, 244)
+DETECTION_EXPORT_INPUT_SIZE = (480, 640)
+
+
+def get_features_model_name(model_weights=settings.FEATURES_MODEL_WEIGHTS):
+    """
+        Returns the name under which the face-feature extraction model is exported
+        Arguments:
+            model_weights: Full path to the file containing the weights of the model
+        Returns:
+            The name of the exported model
+    """
+    return os.path.splitext(os.path.basename(model_weights))[0]
+
+
+def get_detection_model_name(network=settings.FACE_DETECTION_NETWORK):
+    """
+        Returns the name under which the face detection model is exported
+        Arguments:
+            network: Name of the network used for the detection. The options are 'mobile0.25' or 'resnet50'.
+        Returns:
+            The name of the exported model
+    """
+    return 'retinaface_' + network
+
+
+def get_exported_model_file(name, inference_backend, models_dir=settings.EXPORTED_MODELS_DIR):
+    """
+        Returns the path to the file of an exported model
+        Arguments:
+            name: name of the exported model
+            inference_backend: 'torchscript' or 'onnx'
+            models_dir: directory of the exported models
+        Returns:
+            The full path to the file
+    """
+    if inference_backend == 'torchscript':
+        return os.path.join(models_dir, name + '.torchscript.pt')
+    elif inference_backend == 'onnx':
+        return os.path.join(models_dir, name + '.onnx')
+    raise Exception('Unknown inference backend ' + str(inference_backend))
+
+
+def get_quantized_model_file(name, models_dir=settings.EXPORTED_MODELS_DIR):
+    """
+        Returns the path to the file of a model quantized to int8
+        Arguments:
+            name: name of the exported model
+            models_dir: directory of the exported models
+        Returns:
+            The full path to the file
+    """
+    return os.path.join(models_dir, name + '.int8.torchscript.pt')
+
+
+def is_exported_model(inference_backend, inference_precision):
+    """
+        Finds out whether a combination of inference backend and precision uses an exported model
+        Arguments:
+            inference_backend: 'eager', 'torchscript' or 'onnx'
+            inference_precision: 'float32', 'bfloat16' or 'int8'
+        Returns:
+            True if an exported model is used, False if the original PyTorch model is used
+    """
+    return inference_backend != 'eager' or inference_precision == 'int8'
+
+
+def inference_context(inference_precision, device):
+    """
+        Returns the context in which a model should be evaluated to run at the specified precision.
+        Only 'bfloat16' needs a special context, and it has no effect on ONNX models.
+        Arguments:
+            inference_precision: 'float32', 'bfloat16' or 'int8'
+            device: torch device where the model is evaluated
+        Returns:
+            A context manager
+    """
+    if inference_precision == 'bfloat16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def get_exported_meta_file(name, models_dir=settings.EXPORTED_MODELS_DIR):
+    """
+        Returns the path to the file with the metadata of an exported model
+        Arguments:
+            name: name of the exported model
+            models_dir: directory of the exported models
+        Returns:
+            The full path to the file
+    """
+    return os.path.join(models_dir, name + '.meta.json')
+
+
+def load_exported_meta(name, models_dir=settings.EXPORTED_MODELS_DIR):
+    """
+        Loads the metadata saved when exporting a model, e.g. the mean subtracted from the input images
+        Arguments:
+            name: name of the exported model
+            models_dir: directory of the exported models
+        Returns:
+            A dictionary with the metadata
+    """
+    with open(get_exported_meta_file(name, models_dir), 'r') as fin:
+        return json.load(fin)
+
+
+class OnnxModule(object):
+    """
+        Class wrapping an ONNX model, so that it can be called like a PyTorch module
+    """
+
+    def __init__(self, model_file, device):
+        """
+            Initializes the ONNX runtime session
+            Arguments:
+                model_file: Full path to the ONNX file
+                device: torch device where the outputs of the model should be placed
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception('The onnxruntime package is needed to use the ONNX inference backend')
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda':
+            providers = ['CUDAExecutionProvider'] + providers
+        self.device = device
+        self.session = onnxruntime.InferenceSession(model_file, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+
+    def __call__(self, tensor):
+        """
+            Evaluates the model
+            Arguments:
+                tensor: input tensor
+            Returns:
+                A tuple with the outputs of the model, as tensors
+        """
+        outputs = self.session.run(None, {self.input_name: tensor.detach().cpu().numpy()})
+        return tuple([ torch.from_numpy(output).to(self.device) for output in outputs ])
+
+
+def load_exported_model(name, inference_backend, device, models_dir=settings.EXPORTED_MODELS_DIR):
+    """
+        Loads an exported model
+        Arguments:
+            name: name of the exported model
+            inference_backend: 'torchscript' or 'onnx'
+            device: torch device where the model should be evaluated
+            models_dir: directory of the exported models
+        Returns:
+            An object that can be called like the original PyTorch module
+    """
+    model_file = get_exported_model_file(name, inference_backend, models_dir)
+    if not os.path.exists(model_file):
+        raise Exception('Cannot find %s. Please export the models with modelutils.py first.' % model_file)
+    print ('Loading exported model from ' + model_file)
+    if inference_backend == 'torchscript':
+        network = torch.jit.load(model_file, map_location=device)
+        network.eval()
+        return network
+    return OnnxModule(model_file, device)
+
+
+def load_quantized_model(name, device, models_dir=settings.EXPORTED_MODELS_DIR):
+    """
+        Loads a model quantized to int8
+        Arguments:
+            name: name of the exported model
+            device: torch device where the model should be evaluated. Only the CPU is supported.
+            models_dir: directory of the exported models
+        Returns:
+            The quantized TorchScript model
+    """
+    if device.type != 'cpu':
+        raise Exception('The int8 models can only be evaluated on the CPU')
+    model_file = get_quantized_model_file(name, models_dir)
+    if not os.path.exists(model_file):
+        raise Exception('Cannot find %s. Please quantize the models with modelutils.py first.' % model_file)
+    print ('Loading quantized model from ' + model_file)
+    network = torch.jit.load(model_file, map_location=device)
+    network.eval()
+    return network
+
+
+def save_exported_meta_(feature_extractor, models_dir):
+    """
+        Saves the metadata of the face-feature extraction model needed to use its exported versions
+        Arguments:
+            feature_extractor: FaceFeatureExtractor using the original model
+            models_dir: directory of the exported models
+    """
+    name = get_features_model_name(feature_extractor.model_weights)
+    meta = {'mean': numpy.asarray(feature_extractor.mean).tolist()}
+    with open(get_exported_meta_file(name, models_dir), 'w') as fout:
+        json.dump(meta, fout)
+
+
+def export_network_(network, example_input, name, models_dir, export_onnx, dynamic_axes):
+    """
+        Exports a PyTorch module to a frozen TorchScript file and, optionally, to an ONNX file
+        Arguments:
+            network: PyTorch module, in evaluation mode
+            example_input: example input tensor used to trace the module
+            name: name of the exported model
+            models_dir: directory of the exported models
+            export_onnx: boolean indicating whether to export the ONNX file as well
+            dynamic_axes: function that receives the names of the outputs of the ONNX model and returns
+                          the dictionary with the dynamic axes of its input and outputs
+    """
+    with torch.no_grad():
+        traced_network = torch.jit.freeze(torch.jit.trace(network, example_input))
+    torchscript_file = get_exported_model_file(name, 'torchscript', models_dir)
+    torch.jit.save(traced_network, torchscript_file)
+    print ('Saved ' + torchscript_file)
+
+    if export_onnx:
+        onnx_file = get_exported_model_file(name, 'onnx', models_dir)
+        num_outputs = len(network(example_input))
+        output_names = [ 'output%d' % idx for idx in range(num_outputs) ]
+        torch.onnx.export(network, example_input, onnx_file, input_names=['input'], output_names=output_names,
+                          dynamic_axes=dynamic_axes(output_names), opset_version=11)
+        print ('Saved ' + onnx_file)
+
+
+def export_models(models_dir=settings.EXPORTED_MODELS_DIR, export_onnx=False):
+    """
+        Exports the face-feature extraction and face detection models specified in the settings,
+        so that they can be used with INFERENCE_BACKEND set to 'torchscript' or 'onnx'.
+        The models are always exported from the CPU.
+        Arguments:
+            models_dir: directory where the exported models are saved
+            export_onnx: boolean indicating whether to export ONNX files besides the TorchScript files
+    """
+    import face_features
+    import face_detection_retinaface
+
+    if not os.path.exists(models_dir):
+        os.makedirs(models_dir)
+
+    print ('Exporting face-feature extraction model')
+    feature_extractor = face_features.FaceFeatureExtractor(enable_cuda=False, inference_backend='eager', inference_precision='float32')
+    name = get_features_model_name(feature_extractor.model_weights)
+    example_input = torch.zeros(1, 3, FEATURES_EXPORT_INPUT_SIZE[0], FEATURES_EXPORT_INPUT_SIZE[1])
+    export_network_(feature_extractor.network, example_input, name, models_dir, export_onnx,
+                    lambda output_names: dict([ (output_name, {0: 'batch'}) for output_name in ['input'] + output_names ]))
+    save_exported_meta_(feature_extractor, models_dir)
+
+    print ('Exporting face detection model')
+    face_detector = face_detection_retinaface.FaceDetectorRetinaFace(enable_cuda=False, inference_backend='eager', inference_precision='float32')
+    name = get_detection_model_name(face_detector.network_name)
+    example_input = torch.zeros(1, 3, DETECTION_EXPORT_INPUT_SIZE[0], DETECTION_EXPORT_INPUT_SIZE[1])
+    dynamic_axes = lambda output_names: dict([('input', {0: 'batch', 2: 'height', 3: 'width'})] +
+                                             [ (output_name, {0: 'batch', 1: 'priors'}) for output_name in output_names ])
+    export_network_(face_detector.net, example_input, name, models_dir, export_onnx, dynamic_axes)
+
+
+def check_parity(image_files, inference_backend):
+    """
+        Compares the detections and features computed with an exported model against those
+        computed with the original PyTorch model, on a set of images. Use it after exporting
+        the models to make sure the exported models can be used instead of the original ones.
+        Arguments:
+            image_files: list of full paths to the images to be used in the comparison
+            inference_backend: 'torchscript' or 'onnx'
+        Returns:
+            True if the results of both models are within the PARITY_* thresholds, False otherwise
+    """
+    import face_features
+    import face_detection_retinaface
+    import imutils
+
+    eager_detector = face_detection_retinaface.FaceDetectorRetinaFace(inference_backend='eager', inference_precision='float32')
+    exported_detector = face_detection_retinaface.FaceDetectorRetinaFace(inference_backend=inference_backend, inference_precision='float32')
+    eager_extractor = face_features.FaceFeatureExtractor(inference_backend='eager', inference_precision='float32')
+    exported_extractor = face_features.FaceFeatureExtractor(inference_backend=inference_backend, inference_precision='float32')
+
+    num_faces = 0
+    num_mismatched_images = 0
+    max_box_difference = 0.0
+    max_score_difference = 0.0
+    min_cosine = 1.0
+    for image_file in image_files:
+        image = imutils.acquire_image(image_file)
+        if numpy.all(image == None):
+            print ('Skipping unreadable image ' + image_file)
+            continue
+        eager_detections = eager_detector.detect_faces(image) or []
+        exported_detections = exported_detector.detect_faces(image) or []
+        if len(eager_detections) != len(exported_detections):
+            print ('%s: %d faces detected with the original model, %d with the exported model' %
+                   (image_file, len(eager_detections), len(exported_detections)))
+            num_mismatched_images = num_mismatched_images + 1
+            continue
+        for eager_det, exported_det in zip(eager_detections, exported_detections):
+            max_box_difference = max(max_box_difference, float(numpy.max(numpy.abs(eager_det[0:4] - exported_det[0:4]))))
+            max_score_difference = max(max_score_difference, float(abs(eager_det[4] - exported_det[4])))
+            det = [int(eager_det[0]), int(eager_det[1]), int(eager_det[2]), int(eager_det[3])]
+            crop_img = image[det[1]:det[3], det[0]:det[2], :]
+            eager_feat = eager_extractor.feature_compute(crop_img)
+            exported_feat = exported_extractor.feature_compute(crop_img)
+            # the features are normalized, so the dot product is the cosine similarity
+            min_cosine = min(min_cosine, float(numpy.dot(eager_feat, exported_feat)))
+            num_faces = num_faces + 1
+
+    print ('Compared %d faces in %d images' % (num_faces, len(image_files)))
+    print ('Images with a different number of detections: %d' % num_mismatched_images)
+    print ('Maximum difference in the bounding-boxes: %f pixels' % max_box_difference)
+    print ('Maximum difference in the detection scores: %f' % max_score_difference)
+    print ('Minimum cosine similarity between features: %f' % min_cosine)
+    passed = (num_mismatched_images == 0 and max_box_difference <= PARITY_MAX_BOX_DIFFERENCE and
+              max_score_difference <= PARITY_MAX_SCORE_DIFFERENCE and min_cosine >= PARITY_MIN_FEATURES_COSINE)
+    print ('Parity check ' + ('PASSED' if passed else 'FAILED'))
+    return passed
+
+
+def quantize_network_(network, calibration_inputs, example_input, mode):
+    """
+        Quantizes a PyTorch module to int8
+        Arguments:
+            network: PyTorch module, in evaluation mode
+            calibration_inputs: list of input tensors used to calibrate the quantization of the activations
+            example_input: example input tensor
+            mode: 'static' to quantize the weights and the activations, or 'dynamic' to quantize only the
+                  weights of the linear layers, in which case the calibration_inputs are not used
+        Returns:
+            The quantized module
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    if mode == 'dynamic':
+        return quantize_dynamic(copy.deepcopy(network), {torch.nn.Linear}, dtype=torch.qint8)
+    prepared_network = prepare_fx(copy.deepcopy(network), get_default_qconfig_mapping(QUANTIZATION_ENGINE), example_inputs=(example_input,))
+    with torch.no_grad():
+        for calibration_input in calibration_inputs:
+            prepared_network(calibration_input)
+    return convert_fx(prepared_network)
+
+
+def quantize_models(calibration_images, models_dir=settings.EXPORTED_MODELS_DIR, mode='static'):
+    """
+        Quantizes the face-feature extraction and face detection models specified in the settings to
+        int8, so that they can be used with INFERENCE_PRECISION set to 'int8'. The models are calibrated
+        with a set of sample images, which should be representative of the dataset, and the faces
+        detected on them. Use evaluate_precision() afterwards to check the accuracy of the quantized models.
+        Arguments:
+            calibration_images: list of full paths to the images used for the calibration
+            models_dir: directory where the quantized models are saved
+            mode: 'static' or 'dynamic'. See quantize_network_().
+    """
+    import face_features
+    import face_detection_retinaface
+    import imutils
+
+    if not os.path.exists(models_dir):
+        os.makedirs(models_dir)
+    torch.backends.quantized.engine = QUANTIZATION_ENGINE
+
+    feature_extractor = face_features.FaceFeatureExtractor(enable_cuda=False, inference_backend='eager', inference_precision='float32')
+    face_detector = face_detection_retinaface.FaceDetectorRetinaFace(enable_cuda=False, inference_backend='eager', inference_precision='float32')
+
+    # the detector is calibrated with the images, and the feature extractor with the faces found on them
+    detector_inputs = []
+    extractor_inputs = []
+    for image_file in calibration_images:
+        image = imutils.acquire_image(image_file)
+        if numpy.all(image == None):
+            print ('Skipping unreadable image ' + image_file)
+            continue
+        detector_inputs.append(face_detector.prepare_input_(image))
+        for det in face_detector.detect_faces(image) or []:
+            if len(extractor_inputs) < QUANTIZATION_MAX_CALIBRATION_FACES:
+                det = [int(det[0]), int(det[1]), int(det[2]), int(det[3])]
+                extractor_inputs.append(feature_extractor.prepare_input_(image[det[1]:det[3], det[0]:det[2], :]))
+    print ('Calibrating with %d images and %d faces' % (len(detector_inputs), len(extractor_inputs)))
+    if mode == 'static' and len(extractor_inputs) == 0:
+        raise Exception('No faces were found in the calibration images')
+
+    networks = [
+        (feature_extractor.network, extractor_inputs, get_features_model_name(feature_extractor.model_weights),
+         torch.zeros(1, 3, FEATURES_EXPORT_INPUT_SIZE[0], FEATURES_EXPORT_INPUT_SIZE[1])),
+        (face_detector.net, detector_inputs, get_detection_model_name(face_detector.network_name),
+         torch.zeros(1, 3, DETECTION_EXPORT_INPUT_SIZE[0], DETECTION_EXPORT_INPUT_SIZE[1]))
+    ]
+    for network, calibration_inputs, name, example_input in networks:
+        print ('Quantizing model ' + name)
+        quantized_network = quantize_network_(network, calibration_inputs, example_input, mode)
+        with torch.no_grad():
+            traced_network = torch.jit.freeze(torch.jit.trace(quantized_network, example_input))
+        quantized_file = get_quantized_model_file(name, models_dir)
+        torch.jit.save(traced_network, quantized_file)
+        print ('Saved ' + quantized_file)
+    save_exported_meta_(feature_extractor, models_dir)
+
+
+def evaluate_precision(image_files, inference_precision, top_k=10):
+    """
+        Measures the accuracy lost when running the models at a reduced precision. The faces detected
+        on a set of images with the float32 models are used to compare the features computed at both
+        precisions. Reports the drift of the features, i.e. 1 - their cosine similarity, and the overlap
+        of the top_k results of ranking every face against the rest with the features of each precision.
+        Arguments:
+            image_files: list of full paths to the images to be used in the evaluation
+            inference_precision: 'bfloat16' or 'int8'
+            top_k: number of results compared when ranking
+        Returns:
+            A dictionary with the measurements
+    """
+    import face_features
+    import face_detection_retinaface
+    import imutils
+
+    reference_detector = face_detection_retinaface.FaceDetectorRetinaFace(inference_backend='eager', inference_precision='float32')
+    reduced_detector = face_detection_retinaface.FaceDetectorRetinaFace(inference_precision=inference_precision)
+    reference_extractor = face_features.FaceFeatureExtractor(inference_backend='eager', inference_precision='float32')
+    reduced_extractor = face_features.FaceFeatureExtractor(inference_precision=inference_precision)
+
+    num_mismatched_images = 0
+    max_box_difference = 0.0
+    reference_feats = []
+    reduced_feats = []
+    for image_file in image_files:
+        image = imutils.acquire_image(image_file)
+        if numpy.all(image == None):
+            print ('Skipping unreadable image ' + image_file)
+            continue
+        reference_detections = reference_detector.detect_faces(image) or []
+        reduced_detections = reduced_detector.detect_faces(image) or []
+        if len(reference_detections) != len(reduced_detections):
+            num_mismatched_images = num_mismatched_images + 1
+        else:
+            for reference_det, reduced_det in zip(reference_detections, reduced_detections):
+                max_box_difference = max(max_box_difference, float(numpy.max(numpy.abs(reference_det[0:4] - reduced_det[0:4]))))
+        for det in reference_detections:
+            det = [int(det[0]), int(det[1]), int(det[2]), int(det[3])]
+            crop_img = image[det[1]:det[3], det[0]:det[2], :]
+            reference_feat = reference_extractor.feature_compute(crop_img)
+            reduced_feat = reduced_extractor.feature_compute(crop_img)
+            if numpy.all(reference_feat != None) and numpy.all(reduced_feat != None):
+                reference_feats.append(reference_feat)
+                reduced_feats.append(reduced_feat)
+
+    results = {'num_faces': len(reference_feats), 'num_mismatched_images': num_mismatched_images,
+               'max_box_difference': max_box_difference}
+    print ('Compared %d faces in %d images' % (len(reference_feats), len(image_files)))
+    print ('Images with a different number of detections: %d' % num_mismatched_images)
+    print ('Maximum difference in the bounding-boxes: %f pixels' % max_box_difference)
+    if len(reference_feats) == 0:
+        return results
+
+    reference_feats = numpy.array(reference_feats)
+    reduced_feats = numpy.array(reduced_feats)
+    # the features are normalized, so the dot product is the cosine similarity
+    drift = 1.0 - numpy.sum(reference_feats*reduced_feats, axis=1)
+    results['mean_cosine_drift'] = float(numpy.mean(drift))
+    results['max_cosine_drift'] = float(numpy.max(drift))
+    print ('Cosine drift of the features: mean %f, max %f' % (results['mean_cosine_drift'], results['max_cosine_drift']))
+
+    if len(reference_feats) > 1:
+        k = min(top_k, len(reference_feats) - 1)
+        rankings = []
+        for feats in [reference_feats, reduced_feats]:
+            dst = df.cdist(feats, feats)
+            # do not count each face as a result of itself
+            numpy.fill_diagonal(dst, numpy.inf)
+            rankings.append(numpy.argsort(dst, axis=1, kind='mergesort')[:, :k])
+        overlap = [ len(set(reference_ranking) & set(reduced_ranking))/float(k)
+                    for reference_ranking, reduced_ranking in zip(rankings[0], rankings[1]) ]
+        results['mean_ranking_overlap'] = float(numpy.mean(overlap))
+        results['min_ranking_overlap'] = float(numpy.min(overlap))
+        print ('Overlap of the top %d results: mean %f, min %f' % (k, results['mean_ranking_overlap'], results['min_ranking_overlap']))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export of the face detection and face-feature extraction models')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help='Export the models specified in the settings')
+    export_parser.add_argument('-o', dest='models_dir', default=settings.EXPORTED_MODELS_DIR, help='Output directory (default: EXPORTED_MODELS_DIR in the settings)')
+    export_parser.add_argument('--onnx', dest='export_onnx', action='store_true', default=False, help='Export ONNX files as well')
+    parity_parser = subparsers.add_parser('parity', help='Compare the exported models against the original ones')
+    parity_parser.add_argument('images', metavar='images', type=str, nargs='+', help='Paths to the images used in the comparison')
+    parity_parser.add_argument('-b', dest='inference_backend', default='torchscript', choices=['torchscript', 'onnx'], help='Exported models to be compared (default: torchscript)')
+    quantize_parser = subparsers.add_parser('quantize', help='Quantize the models specified in the settings to int8')
+    quantize_parser.add_argument('images', metavar='images', type=str, nargs='+', help='Paths to the images used for the calibration')
+    quantize_parser.add_argument('-o', dest='models_dir', default=settings.EXPORTED_MODELS_DIR, help='Output directory (default: EXPORTED_MODELS_DIR in the settings)')
+    quantize_parser.add_argument('-m', dest='mode', default='static', choices=['static', 'dynamic'], help='Quantization mode (default: static)')
+    evaluate_parser = subparsers.add_parser('evaluate', help='Compare the models at a reduced precision against the float32 models')
+    evaluate_parser.add_argument('images', metavar='images', type=str, nargs='+', help='Paths to the images used in the evaluation')
+    evaluate_parser.add_argument('-p', dest='inference_precision', default='int8', choices=['bfloat16', 'int8'], help='Precision to be evaluated (default: int8)')
+    evaluate_parser.add_argument('-k', dest='top_k', type=int, default=10, help='Number of ranking results compared (default: 10)')
+    args = parser.parse_args()
+    if args.command == 'export':
+        export_models(args.models_dir, args.export_onnx)
+    elif args.command == 'parity':
+        if not check_parity(args.images, args.inference_backend):
+            exit(1)
+    elif args.command == 'quantize':
+        quantize_models(args.images, args.models_dir, args.mode)
+    elif args.command == 'evaluate':
+        evaluate_precision(args.images, args.inference_precision, args.top_k)
+    else:
+        parser.print_help()
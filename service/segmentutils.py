@@ -0,0 +1,505 @@
+__author__      = 'Ernesto Coto'
+__copyright__   = 'October 2026'
+
+import os
+import contextlib
+import hashlib
+import pickle # used for saving the lists and dictionaries
+import pickletools
+import dill   # used for saving the kd-trees
+import numpy
+
+import settings
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+def get_entry_path(database_file, entry):
+    """
+        Returns the full path to an entry of a list-based database file
+        Arguments:
+            database_file: Full path to the main database (or kd-trees) file
+            entry: one of the entries of the list contained in the database file
+        Returns:
+            The full path to the file of the entry
+    """
+    if os.path.sep not in entry:
+        # in this case, assume it is in the same directory as the main database file
+        return os.path.join(os.path.dirname(database_file), entry)
+    return entry
+
+
+def peek_database_type(database_file):
+    """
+        Finds out whether a database file contains a dictionary or a list without loading it,
+        by looking at the first opcodes of the pickled data.
+        Arguments:
+            database_file: Full path to the database file
+        Returns:
+            dict or list, depending on the content of the file
+    """
+    with open(database_file, 'rb') as fin:
+        for opcode, arg, pos in pickletools.genops(fin):
+            if opcode.name in ['PROTO', 'FRAME']:
+                continue
+            if opcode.name in ['EMPTY_DICT', 'DICT']:
+                return dict
+            if opcode.name in ['EMPTY_LIST', 'LIST']:
+                return list
+            break
+    # the type could not be found from the first opcodes, so load the complete file
+    with open(database_file, 'rb') as fin:
+        return type(pickle.load(fin))
+
+
+def get_manifest_file(database_file):
+    """
+        Returns the path to the manifest of a list-based database
+        Arguments:
+            database_file: Full path to the main database file
+        Returns:
+            The full path to the manifest file
+    """
+    return database_file.replace('.pkl', '_manifest.pkl')
+
+
+def load_manifest(database_file, entries):
+    """
+        Loads the manifest of a list-based database. The manifest stores the number of rows of
+        each sub-database, so that the memory for the complete database can be allocated before
+        loading any sub-database.
+        Arguments:
+            database_file: Full path to the main database file
+            entries: list of current entries of the database
+        Returns:
+            A dictionary with the fields 'entries', 'num_rows', 'feats_size' and 'feats_dtype', or
+            None if the manifest does not exist or does not match the entries of the database
+    """
+    manifest_file = get_manifest_file(database_file)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, 'rb') as fin:
+        manifest = pickle.load(fin)
+    if manifest['entries'] != list(entries):
+        print ('The manifest %s is out of date and will be ignored' % manifest_file)
+        return None
+    return manifest
+
+
+def save_manifest(database_file, entries, num_rows, feats_size, feats_dtype):
+    """
+        Saves the manifest of a list-based database
+        Arguments:
+            database_file: Full path to the main database file
+            entries: list of entries of the database
+            num_rows: list with the number of rows of each entry
+            feats_size: length of the feature vectors, or None if the features were removed from the database
+            feats_dtype: name of the data type of the feature vectors, or None if the features were removed from the database
+    """
+    manifest = {'entries': list(entries), 'num_rows': list(num_rows), 'feats_size': feats_size, 'feats_dtype': feats_dtype}
+    save_atomically(manifest, get_manifest_file(database_file))
+
+
+def save_atomically(content, filename, dumper=pickle):
+    """
+        Saves an object to a file, making sure that readers of the file never see a partially written file
+        Arguments:
+            content: object to be saved
+            filename: Full path to the file
+            dumper: module used to save the object. Either pickle or dill.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fout:
+        dumper.dump(content, fout, pickle.HIGHEST_PROTOCOL)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def new_segment_name(database_file, entries):
+    """
+        Generates the name of a new segment of a list-based database
+        Arguments:
+            database_file: Full path to the main database file
+            entries: list of current entries of the database
+        Returns:
+            The file name of the new segment, relative to the directory of the main database file
+    """
+    base_name = os.path.basename(database_file).replace('.pkl', '')
+    segment_number = len(entries)
+    segment_name = '%s_%05d.pkl' % (base_name, segment_number)
+    while segment_name in entries or os.path.exists(get_entry_path(database_file, segment_name)):
+        segment_number = segment_number + 1
+        segment_name = '%s_%05d.pkl' % (base_name, segment_number)
+    return segment_name
+
+
+def convert_to_list_database(database_file, kdtrees_file=None):
+    """
+        Makes sure a database file is list-based, so that new segments can be appended to it
+        without rewriting the existing data. A dictionary-based database is converted by moving
+        it to a segment file, which is O(1) regardless of the size of the database. If specified,
+        a kd-trees file storing the kd-trees of a dictionary-based database is converted as well.
+        Arguments:
+            database_file: Full path to the main database file. It does not need to exist.
+            kdtrees_file: Full path to the kd-trees file of the database, or None
+        Returns:
+            The list of entries in the list-based database
+    """
+    if not os.path.exists(database_file):
+        return []
+
+    database_type = peek_database_type(database_file)
+    if database_type == list:
+        with open(database_file, 'rb') as fin:
+            return pickle.load(fin)
+    elif database_type != dict:
+        raise Exception('File %s contains corrupted information.' % database_file)
+
+    segment_name = new_segment_name(database_file, [])
+    print ('Moving dictionary-based database %s to segment %s' % (database_file, segment_name))
+    os.rename(database_file, get_entry_path(database_file, segment_name))
+    save_atomically([ segment_name ], database_file)
+
+    # the kd-trees of a dictionary-based database are stored directly in the kd-trees file,
+    # so move them to the kd-trees file of the new segment
+    if kdtrees_file and os.path.exists(kdtrees_file):
+        sub_kdtree_fname = 'kdtree_' + segment_name
+        os.rename(kdtrees_file, get_entry_path(kdtrees_file, sub_kdtree_fname))
+        save_atomically([ sub_kdtree_fname ], kdtrees_file, dill)
+
+    return [ segment_name ]
+
+
+def get_lock_file(database_file):
+    """
+        Returns the path to the file used to lock a database for writing
+        Arguments:
+            database_file: Full path to the main database file
+        Returns:
+            The full path to the lock file
+    """
+    return database_file.replace('.pkl', '.lock')
+
+
+@contextlib.contextmanager
+def database_lock(database_file):
+    """
+        Locks a database for writing, so that the processes adding entries to the list of a database
+        (the pipeline scripts, the merge of a sharded ingestion and the backend service) do not lose
+        each other's entries. The lock is not reentrant.
+        Arguments:
+            database_file: Full path to the main database file
+    """
+    with open(get_lock_file(database_file), 'a+') as flock:
+        if fcntl:
+            fcntl.flock(flock.fileno(), fcntl.LOCK_EX)
+        else:
+            flock.seek(0)
+            # blocks, retrying for a few seconds at a time
+            while True:
+                try:
+                    msvcrt.locking(flock.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(flock.fileno(), fcntl.LOCK_UN)
+            else:
+                flock.seek(0)
+                msvcrt.locking(flock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def append_segment(database_file, segment_content, kdtrees_file=None, kdtrees=None, before_saving=None):
+    """
+        Appends a new segment to a list-based database. The cost of the operation only
+        depends on the size of the new segment.
+        Arguments:
+            database_file: Full path to the main database file. It will be converted to a
+                           list-based database if needed, or created if it does not exist.
+            segment_content: dictionary with the 'paths', 'rois' and 'feats' of the new segment
+            kdtrees_file: Full path to the kd-trees file of the database, or None if the
+                          database is not using kd-trees
+            kdtrees: list of kd-trees of the new segment. Only used if kdtrees_file is specified.
+            before_saving: function called with the name of the new segment before the segment is saved,
+                           with the lock of the database held, or None
+        Returns:
+            The name of the new segment, as listed in the main database file
+    """
+    feats_size = None
+    feats_dtype = None
+    if segment_content.get('feats', None) is not None and len(segment_content['feats']) > 0:
+        feats = numpy.asarray(segment_content['feats'])
+        feats_size = feats.shape[-1]
+        feats_dtype = feats.dtype.name
+
+    with database_lock(database_file):
+        entries = convert_to_list_database(database_file, kdtrees_file)
+        segment_name = new_segment_name(database_file, entries)
+        if before_saving:
+            before_saving(segment_name)
+        save_atomically(segment_content, get_entry_path(database_file, segment_name))
+
+        if kdtrees_file:
+            kdtrees_entries = []
+            if os.path.exists(kdtrees_file):
+                with open(kdtrees_file, 'rb') as fin:
+                    kdtrees_entries = dill.load(fin)
+            sub_kdtree_fname = 'kdtree_' + segment_name
+            save_atomically(kdtrees, get_entry_path(kdtrees_file, sub_kdtree_fname), dill)
+            save_atomically(kdtrees_entries + [ sub_kdtree_fname ], kdtrees_file, dill)
+
+        append_entries(database_file, entries, [ segment_name ], [ len(segment_content['paths']) ], feats_size, feats_dtype)
+    return segment_name
+
+
+def append_entries(database_file, entries, new_entries, new_num_rows, feats_size, feats_dtype):
+    """
+        Adds the entries of existing sub-database files to a list-based database, keeping its
+        manifest up to date so that the database can still be loaded in parallel. Must be called
+        with the database_lock() of the database held, after reading the current entries.
+        Arguments:
+            database_file: Full path to the main database file
+            entries: list of current entries of the database, as returned by convert_to_list_database
+            new_entries: list of entries to be added, either file names relative to the directory
+                         of the main database file or full paths
+            new_num_rows: list with the number of rows of each new entry
+            feats_size: length of the feature vectors of the new entries, or None if unknown. Only
+                        used if the database is new.
+            feats_dtype: name of the data type of the feature vectors of the new entries, or None
+                         if unknown. Only used if the database is new.
+    """
+    manifest = None
+    if len(entries) == 0:
+        manifest = {'entries': [], 'num_rows': [], 'feats_size': feats_size, 'feats_dtype': feats_dtype}
+    elif os.path.exists(get_manifest_file(database_file)):
+        manifest = load_manifest(database_file, entries)
+    if manifest != None:
+        save_manifest(database_file, entries + list(new_entries), manifest['num_rows'] + list(new_num_rows),
+                      manifest['feats_size'], manifest['feats_dtype'])
+
+    save_atomically(entries + list(new_entries), database_file)
+
+
+def get_progress_file(database_file, source):
+    """
+        Returns the path to the file recording the progress of the ingestion of a source into a
+        database. Each source has its own progress file, so that several ingestions into the same
+        database can be resumed independently.
+        Arguments:
+            database_file: Full path to the main database file
+            source: string identifying the input of the ingestion
+        Returns:
+            The full path to the progress file
+    """
+    source_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+    return database_file.replace('.pkl', '_progress_%s.pkl' % source_hash)
+
+
+def get_ingested_files_file(database_file):
+    """
+        Returns the path to the file recording the identity of the files ingested into a database,
+        used to re-ingest only the files that changed
+        Arguments:
+            database_file: Full path to the main database file
+        Returns:
+            The full path to the ingested files manifest
+    """
+    return database_file.replace('.pkl', '_ingested.pkl')
+
+
+def load_ingested_files(database_file):
+    """
+        Loads the manifest of the files ingested into a database
+        Arguments:
+            database_file: Full path to the main database file
+        Returns:
+            A dictionary with the identity of each ingested file, indexed by its path, or an empty
+            dictionary if the manifest does not exist
+    """
+    ingested_files_file = get_ingested_files_file(database_file)
+    if not os.path.exists(ingested_files_file):
+        return {}
+    with open(ingested_files_file, 'rb') as fin:
+        return pickle.load(fin)
+
+
+def find_rows_by_path(database_file, paths):
+    """
+        Finds the rows of a database corresponding to a set of image paths, loading one
+        sub-database at a time
+        Arguments:
+            database_file: Full path to the main database file
+            paths: set of image paths, as stored in the database
+        Returns:
+            A tuple with an array of row ids and the total number of rows of the database
+    """
+    rows = []
+    num_rows = 0
+    if not os.path.exists(database_file):
+        return numpy.array(rows, dtype=int), num_rows
+    if peek_database_type(database_file) == list:
+        sub_databases = [ get_entry_path(database_file, entry) for entry in load_database_entries(database_file) ]
+    else:
+        sub_databases = [ database_file ]
+    for sub_database in sub_databases:
+        with open(sub_database, 'rb') as fin:
+            database_paths = pickle.load(fin)['paths']
+        for idx, path in enumerate(database_paths):
+            # some databases store each path in an array
+            if isinstance(path, numpy.ndarray):
+                path = path[0]
+            if path in paths:
+                rows.append(num_rows + idx)
+        num_rows = num_rows + len(database_paths)
+    return numpy.array(rows, dtype=int), num_rows
+
+
+def load_database_entries(database_file):
+    """
+        Returns the entries of a list-based database
+        Arguments:
+            database_file: Full path to the main database file
+        Returns:
+            The list of entries, or an empty list if the database does not exist or is not list-based
+    """
+    if not os.path.exists(database_file) or peek_database_type(database_file) != list:
+        return []
+    with open(database_file, 'rb') as fin:
+        return pickle.load(fin)
+
+
+class SegmentWriter(object):
+    """
+        Class used to add faces to a database in an append-only way, so that the cost of adding faces
+        does not depend on the size of the database. The faces are kept in memory until a checkpoint,
+        when they are appended to the database as a new segment. At each checkpoint, the number of input
+        items (e.g. images or shots) completely processed is saved to a progress file of the source
+        being ingested, so that an interrupted ingestion can be resumed from the last checkpoint.
+    """
+
+    def __init__(self, database_file, source, checkpoint_faces=settings.INGESTION_CHECKPOINT_FACES,
+                 checkpoint_items=settings.INGESTION_CHECKPOINT_ITEMS):
+        """
+            Initializes the writer and recovers the progress of a previous ingestion of the same source
+            Arguments:
+                database_file: Full path to the main database file. A dictionary-based database is
+                               converted to a list-based database before the first segment is appended.
+                source: string identifying the input of the ingestion, e.g. the path to the list of images.
+                        The progress of a previous ingestion is only recovered if it had the same source.
+                checkpoint_faces: number of faces kept in memory before a checkpoint
+                checkpoint_items: number of input items processed between checkpoints
+        """
+        if not database_file.endswith('.pkl'):
+            raise Exception('The name of the database file %s must end with .pkl' % database_file)
+        self.database_file = database_file
+        self.source = source
+        self.checkpoint_faces = checkpoint_faces
+        self.checkpoint_items = checkpoint_items
+        self.buffer = {'paths': [], 'rois': [], 'feats': []}
+        self.num_faces = 0
+        self.progress_file = get_progress_file(database_file, source)
+        self.processed = 0
+        self.processed = self.recover_progress_()
+        self.last_checkpoint = self.processed
+
+
+    def recover_progress_(self):
+        """
+            Reads the progress file of the source. If the ingestion was interrupted while appending
+            a segment, the segment is kept if it was added to the list of the database, since the
+            items it came from are done, and its file is removed otherwise. The segments appended
+            by other ingestions are never touched.
+            Returns:
+                The number of input items already processed
+        """
+        if not os.path.exists(self.progress_file):
+            return 0
+        with open(self.progress_file, 'rb') as fin:
+            progress = pickle.load(fin)
+        if progress['source'] != self.source:
+            print ('Ignoring the progress of the ingestion of %s into %s' % (progress['source'], self.database_file))
+            return 0
+
+        processed = progress['processed']
+        pending_segment = progress.get('pending_segment', None)
+        if pending_segment:
+            with database_lock(self.database_file):
+                if pending_segment in load_database_entries(self.database_file):
+                    print ('Segment %s was appended after the last checkpoint' % pending_segment)
+                    processed = progress['pending_processed']
+                elif os.path.exists(get_entry_path(self.database_file, pending_segment)):
+                    print ('Removing segment %s, which was not appended to the database' % pending_segment)
+                    os.remove(get_entry_path(self.database_file, pending_segment))
+            self.save_progress_(processed)
+
+        print ('Resuming the ingestion of %s after %d processed items' % (self.source, processed))
+        return processed
+
+
+    def save_progress_(self, processed, pending_segment=None):
+        """
+            Saves the progress file of the source
+            Arguments:
+                processed: number of input items whose faces are in the database
+                pending_segment: name of the segment about to be appended, with the faces of the items
+                                 processed since the last checkpoint, or None
+        """
+        progress = {'source': self.source, 'processed': processed,
+                    'pending_segment': pending_segment, 'pending_processed': self.processed}
+        save_atomically(progress, self.progress_file)
+
+
+    def add_face(self, path, roi, feat):
+        """
+            Adds a face to the database. It is not saved until the next checkpoint.
+            Arguments:
+                path: path of the image of the face, relative to the base path of the dataset
+                roi: bounding-box of the face, as a list [x1,y1,x2,y2]
+                feat: feature vector of the face
+        """
+        self.buffer['paths'].append(path)
+        self.buffer['rois'].append(roi)
+        self.buffer['feats'].append(feat)
+        self.num_faces = self.num_faces + 1
+
+
+    def item_done(self):
+        """
+            Records that all the faces of an input item have been added. Makes a checkpoint if needed.
+        """
+        self.processed = self.processed + 1
+        if len(self.buffer['paths']) >= self.checkpoint_faces or self.processed - self.last_checkpoint >= self.checkpoint_items:
+            self.checkpoint()
+
+
+    def checkpoint(self):
+        """
+            Appends the faces in memory to the database as a new segment, and saves the progress
+        """
+        if len(self.buffer['paths']) > 0:
+            segment = {'paths': self.buffer['paths'], 'rois': self.buffer['rois'], 'feats': numpy.array(self.buffer['feats'])}
+            # record the name of the segment before saving it, so that a resumed ingestion knows
+            # whether the faces of the items processed since the last checkpoint were saved
+            segment_name = append_segment(self.database_file, segment,
+                                          before_saving=lambda name: self.save_progress_(self.last_checkpoint, name))
+            print ('Saved %d faces to segment %s' % (len(segment['paths']), segment_name))
+            self.buffer = {'paths': [], 'rois': [], 'feats': []}
+        self.save_progress_(self.processed)
+        self.last_checkpoint = self.processed
+
+
+    def close(self):
+        """
+            Saves the remaining faces and finishes the ingestion, so it will not be resumed
+        """
+        self.checkpoint()
+        os.remove(self.progress_file)
@@ -12,12 +12,34 @@ MAX_RESULTS_RETURN = 1000
 
 MAX_RESULTS_SCORE = 0.9
 
+RANGE_SEARCH_MAX_DISTANCE = -1 # range search is disabled by default, i.e. when the value is <= 0
+
+RANGE_SEARCH_BLOCK_SIZE = 100000
+
 CUDA_ENABLED = False
 
 DEPENDENCIES_PATH = os.path.join(FILE_DIR, '..', 'dependencies')
 
 DATASET_FEATS_FILE = os.path.join(FILE_DIR, '..', 'features', 'database.pkl')
 
+DEFAULT_DATASET_NAME = 'default' # name of the dataset in DATASET_FEATS_FILE, which is used for requests to unknown datasets
+
+DATASETS = {} # additional datasets, e.g. {'name': {'feats_file': '/path/to/database.pkl', 'kdtrees_file': '/path/to/kdtrees.pkl'}}
+
+DATASETS_MEMORY_BUDGET = -1 # maximum number of bytes used by the loaded datasets. No limit if the value is <= 0
+
+RELOAD_MEMORY_BUDGET = -1 # maximum number of bytes used by the loaded datasets while reloading one of them. No limit if the value is <= 0
+
+RELOAD_ALLOWED_DIRS = [] # directories, besides the ones of the current files of a dataset, with the database files that the reloadDatabase request can switch the dataset to
+
+DATABASE_WATCH_INTERVAL = -1 # seconds between checks for modified database files, which are then reloaded. Disabled if the value is <= 0
+
+DATABASE_LOADING_WORKERS = 8 # number of processes used to load the sub-databases (and kd-tree files) of a list-based database
+
+DATABASE_LOADING_TMP_DIR = None # directory of the temporary file shared by the loading processes, e.g. '/dev/shm'. None means the system default. The system default is used as well if there is not enough free space for the features.
+
+DATABASE_LOADING_TIMEOUT = 600 # seconds to wait for a loading process to load one sub-database (or kd-tree file) before giving up
+
 FEATURES_MODEL_WEIGHTS = os.path.join(FILE_DIR, '..', 'models', 'senet50_256.pth')
 
 FEATURES_MODEL_DEF = os.path.join(FILE_DIR, '..', 'models', 'senet50_256.py')
@@ -30,6 +52,54 @@ FEATURES_EXTRACTION_TIMEOUT = 10
 
 NUMBER_OF_HELPER_WORKERS = 8
 
+CPU_RESERVED_CORES = 2 # cores reserved for the main process (ranking, face detection and the socket server). The rest are split among the helper workers
+
+CPU_AFFINITY_ENABLED = True # whether to pin each process to the cores assigned to it, besides limiting its number of threads
+
+INGEST_MERGE_INTERVAL = 300 # seconds between merges of the faces added with 'ingest' into the main database
+
+INGEST_PERSIST_MERGED_SEGMENTS = False # whether to append the merged faces to the database file as a new segment, so that they are kept after a restart
+
+INGESTION_CHECKPOINT_FACES = 10000 # faces buffered by the ingestion pipeline before writing them to the database as a new segment
+
+INGESTION_CHECKPOINT_ITEMS = 1000 # input images (or shots) processed by the ingestion pipeline between checkpoints of its progress
+
+INGESTION_CHUNK_SIZE = 1000 # images per chunk of work in a sharded ingestion. Each chunk is saved to its own sub-database.
+
+INGESTION_LEASE_DURATION = 600 # seconds a worker of a sharded ingestion can hold a chunk without renewing its lease
+
+INGESTION_MAX_ATTEMPTS = 3 # maximum number of times a chunk of a sharded ingestion is leased before it is marked as failed
+
+INGESTION_DEDUP_INDEX = None # path to the index of the hashes of the images ingested, used to skip near-duplicate images. Use None to ingest all the images.
+
+INGESTION_DEDUP_MAX_DISTANCE = 3 # maximum number of different bits between the perceptual hashes of two near-duplicate images (0 to 3)
+
+VIDEO_SAMPLING_RATE = 1 # frames per second of video in which faces are detected during the ingestion of a video, in shots where the content does not change
+
+VIDEO_MAX_SAMPLING_RATE = 4 # maximum frames per second of video in which faces are detected, in shots where the content changes
+
+VIDEO_SAMPLING_CHANGE = 0.2 # change of the colour histogram, as a fraction of the pixel values, that adds one sampled frame to a shot
+
+VIDEO_MIN_FRAMES_PER_SHOT = 1 # minimum number of sampled frames in each shot, however short it is
+
+VIDEO_SHOT_DETECTION_SCALE = 0.25 # scale of the frames decoded to detect the shot boundaries and the changes of content within the shots
+
+VIDEO_TRACKING_MIN_IOU = 0.5 # minimum IoU between the faces of consecutive frames to add them to the same face track
+
+VIDEO_TRACKING_MATCHING = 'first' # how faces are assigned to face tracks: 'first' (first face above the minimum IoU), 'greedy' (by decreasing IoU) or 'optimal'
+
+VIDEO_TRACKING_MAX_GAP = 0 # consecutive sampled frames in which a face can be missing without ending its face track
+
+VIDEO_TRACK_FEATURES_BUDGET = 0 # maximum number of faces per face track used to compute the features of the track, or 0 to use all of them. A budget of 5 is recommended for long videos.
+
+VIDEO_DETECTION_INTERVAL = 1 # faces are detected every this number of sampled frames. In between, they are followed by template matching.
+
+VIDEO_DETECTION_CHANGE_THRESHOLD = 0.1 # change of the colour histogram since the last detection, as a fraction of the pixel values, that triggers a new detection
+
+VIDEO_PROPAGATION_MIN_CONFIDENCE = 0.7 # minimum template matching score (NCC) to follow a face without detecting it again
+
+TOMBSTONES_COMPACTION_RATIO = 0.1 # minimum ratio of deleted faces for databaseutils.compact_database() to rewrite the database
+
 KDTREES_RANKING_ENABLED = False
 
 KDTREES_DATASET_SPLIT_SIZE = 100000
@@ -39,3 +109,17 @@ KDTREES_FILE =  os.path.join(FILE_DIR, '..', 'kdtrees.pkl')
 FACE_DETECTION_MODEL = os.path.join(DEPENDENCIES_PATH, 'Pytorch_Retinaface', 'weights' , 'Resnet50_Final.pth')
 
 FACE_DETECTION_NETWORK = 'resnet50' # options are 'mobile0.25' or 'resnet50'
+
+FACE_DETECTION_BATCH_MAX_PADDING = 1.5 # maximum ratio between the padded area of a batch of images input to the face detector and the area of the images. Larger batches are split.
+
+INFERENCE_BACKEND = 'eager' # options are 'eager', 'torchscript' or 'onnx'. The last two need the models exported with modelutils.py
+
+INFERENCE_PRECISION = 'float32' # options are 'float32', 'bfloat16' or 'int8'. The last one needs the models quantized with modelutils.py and only runs on the CPU
+
+EXPORTED_MODELS_DIR = os.path.join(FILE_DIR, '..', 'models', 'exported') # directory of the models exported with modelutils.py
+
+WARMUP_IMAGE_SIZES = [(480, 640), (720, 1280)] # (height, width) of the images used to warm up the face detector at start-up
+
+WARMUP_NUM_PASSES = 2 # number of forward passes per input size used to warm up each network at start-up
+
+HELPER_WORKERS_READY_TIMEOUT = 600 # seconds to wait for the helper workers to warm up at start-up before reporting the 'failed' status